@@ -0,0 +1,24 @@
+"""
+Benchmarks of the filament reconstruction from two polygons.
+"""
+from napari_filament_annotator.utils.geom import compute_polygon_intersection
+
+from .synthetic import synthetic_polygons
+
+
+class PolygonIntersection:
+    """
+    Intersection of two polygons drawn over the same filament from two view angles.
+    """
+    params = [5, 20, 50, 200]
+    param_names = ['n_rays']
+
+    def setup(self, n_rays):
+        self.polygons = synthetic_polygons((64, 256, 256), n_rays)
+        self.spacing = [0.2, 0.1, 0.1]
+
+    def time_compute_polygon_intersection(self, n_rays):
+        compute_polygon_intersection(self.polygons, self.spacing)
+
+    def peakmem_compute_polygon_intersection(self, n_rays):
+        compute_polygon_intersection(self.polygons, self.spacing)
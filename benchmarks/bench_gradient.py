@@ -0,0 +1,64 @@
+"""
+Benchmarks of the image gradient used by the active contours.
+
+Volumes are 64 x edge x edge voxels: thin along z, as typical for microscopy stacks.
+"""
+import numpy as np
+from napari_filament_annotator.utils.postproc import gradient
+from napari_filament_annotator.utils.tiled import TiledGradient
+
+from .synthetic import synthetic_volume, filament_curve
+
+SPACING = [0.2, 0.1, 0.1]
+
+
+class Gradient:
+    """
+    Gradient of the full volume, and gradient computed on demand around one filament.
+    """
+    params = [64, 256, 1024]
+    param_names = ['edge']
+    timeout = 300
+
+    def setup(self, edge):
+        self.img = synthetic_volume((64, edge, edge))
+        self.filament = filament_curve(self.img.shape, 50)[20:25]  # short filament segment
+
+    def time_gradient(self, edge):
+        gradient(self.img, SPACING)
+
+    def peakmem_gradient(self, edge):
+        gradient(self.img, SPACING)
+
+    def time_smoothed_gradient(self, edge):
+        gradient(self.img, SPACING, sigma=2)
+
+    def time_tiled_roi(self, edge):
+        TiledGradient(self.img, sigma=2, spacing=SPACING).roi(self.filament)
+
+    def peakmem_tiled_roi(self, edge):
+        TiledGradient(self.img, sigma=2, spacing=SPACING).roi(self.filament)
+
+    def track_tiled_roi_bytes(self, edge):
+        tiled = TiledGradient(self.img, sigma=2, spacing=SPACING)
+        tiled.roi(self.filament)
+        return int(tiled.nbytes)
+
+    track_tiled_roi_bytes.unit = 'bytes'
+
+
+class GradientDtype:
+    """
+    Full-volume gradient stored in single and half precision.
+    """
+    params = [np.float32, np.float16]
+    param_names = ['dtype']
+
+    def setup(self, dtype):
+        self.img = synthetic_volume((64, 256, 256))
+
+    def time_gradient(self, dtype):
+        gradient(self.img, SPACING, dtype=dtype)
+
+    def peakmem_gradient(self, dtype):
+        gradient(self.img, SPACING, dtype=dtype)
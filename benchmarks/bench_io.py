@@ -0,0 +1,67 @@
+"""
+Benchmarks of saving and loading annotations.
+"""
+import os
+import shutil
+import tempfile
+
+from napari_filament_annotator.utils.io import annotation_to_pandas, pandas_to_annotations, \
+    write_annotations, read_annotations
+
+from .synthetic import random_filaments
+
+
+class Conversion:
+    """
+    Conversion between the list of filaments and the csv table.
+    """
+    params = [10, 1000, 100000]
+    param_names = ['n_filaments']
+
+    def setup(self, n_filaments):
+        self.data = random_filaments(n_filaments)
+        self.df = annotation_to_pandas(self.data)
+
+    def time_annotation_to_pandas(self, n_filaments):
+        annotation_to_pandas(self.data)
+
+    def peakmem_annotation_to_pandas(self, n_filaments):
+        annotation_to_pandas(self.data)
+
+    def time_pandas_to_annotations(self, n_filaments):
+        pandas_to_annotations(self.df)
+
+    def peakmem_pandas_to_annotations(self, n_filaments):
+        pandas_to_annotations(self.df)
+
+
+class Files:
+    """
+    Writing and reading annotation files in the csv and npz formats.
+    """
+    params = ([10, 1000, 100000], ['.csv', '.npz'])
+    param_names = ['n_filaments', 'extension']
+    timeout = 300
+
+    def setup(self, n_filaments, extension):
+        self.data = random_filaments(n_filaments)
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, 'annotations' + extension)
+        write_annotations(self.filename, self.data)
+
+    def teardown(self, n_filaments, extension):
+        shutil.rmtree(self.path)
+
+    def time_write(self, n_filaments, extension):
+        write_annotations(self.filename, self.data)
+
+    def time_read(self, n_filaments, extension):
+        read_annotations(self.filename)
+
+    def peakmem_read(self, n_filaments, extension):
+        read_annotations(self.filename)
+
+    def track_file_size(self, n_filaments, extension):
+        return os.path.getsize(self.filename)
+
+    track_file_size.unit = 'bytes'
@@ -0,0 +1,101 @@
+"""
+Benchmarks of the active contour refinement of filaments.
+"""
+import numpy as np
+from napari_filament_annotator.utils.postproc import gradient, snap_to_bright, snap_many, BACKENDS
+
+from .synthetic import synthetic_volume, initial_snake
+
+SHAPE = (64, 256, 256)
+SPACING = np.array([0.2, 0.1, 0.1])
+
+
+class SnapToBright:
+    """
+    Refinement of one filament, for different numbers of points and evolution schemes.
+    """
+    params = ([10, 50, 200, 500], ['explicit', 'semi-implicit'])
+    param_names = ['n_points', 'evolution']
+
+    def setup(self, n_points, evolution):
+        self.grad = gradient(synthetic_volume(SHAPE), SPACING)
+        self.snake = initial_snake(SHAPE, n_points)
+
+    def time_snap_to_bright(self, n_points, evolution):
+        snap_to_bright(self.snake, grad=self.grad, spacing=SPACING, n_interp=1, evolution=evolution)
+
+    def peakmem_snap_to_bright(self, n_points, evolution):
+        snap_to_bright(self.snake, grad=self.grad, spacing=SPACING, n_interp=1, evolution=evolution)
+
+
+class SnapBackends:
+    """
+    Refinement of one and of many filaments with each available backend of the explicit evolution.
+    """
+    params = (list(BACKENDS), [1, 100])
+    param_names = ['backend', 'n_filaments']
+
+    def setup(self, backend, n_filaments):
+        self.grad = gradient(synthetic_volume(SHAPE), SPACING)
+        self.snakes = [initial_snake(SHAPE, 30, seed=i) for i in range(n_filaments)]
+        snap_many(self.snakes[:1], grad=self.grad, spacing=SPACING, n_iter=1, backend=backend)  # compile, if needed
+
+    def time_snap_many(self, backend, n_filaments):
+        snap_many(self.snakes, grad=self.grad, spacing=SPACING, n_interp=1, backend=backend)
+
+
+class SnapEarlyStopping:
+    """
+    Refinement of many filaments with early stopping, for each step schedule.
+    """
+    params = ['linear', 'adaptive']
+    param_names = ['schedule']
+
+    def setup(self, schedule):
+        self.grad = gradient(synthetic_volume(SHAPE), SPACING)
+        self.snakes = [initial_snake(SHAPE, 30, seed=i) for i in range(100)]
+
+    def time_snap_many(self, schedule):
+        snap_many(self.snakes, grad=self.grad, spacing=SPACING, n_interp=1, tol=0.01, schedule=schedule)
+
+    def track_iterations(self, schedule):
+        _, iterations = snap_many(self.snakes, grad=self.grad, spacing=SPACING, n_interp=1, tol=0.01,
+                                  schedule=schedule, return_iterations=True)
+        return float(iterations.mean())
+
+    track_iterations.unit = 'iterations'
+
+
+class SnapMultiscale:
+    """
+    Refinement of one filament on a gradient pyramid.
+    """
+    params = [1, 2, 3]
+    param_names = ['n_levels']
+
+    def setup(self, n_levels):
+        self.grad = gradient(synthetic_volume(SHAPE), SPACING)
+        self.snake = initial_snake(SHAPE, 50)
+
+    def time_snap_to_bright(self, n_levels):
+        snap_to_bright(self.snake, grad=self.grad, spacing=SPACING, n_interp=1, n_levels=n_levels,
+                       n_iter=1000 if n_levels == 1 else 200)
+
+
+class SnapMany:
+    """
+    Batched refinement of many filaments.
+    """
+    params = [10, 100, 1000]
+    param_names = ['n_filaments']
+    timeout = 300
+
+    def setup(self, n_filaments):
+        self.grad = gradient(synthetic_volume(SHAPE), SPACING)
+        self.snakes = [initial_snake(SHAPE, 30, seed=i) for i in range(n_filaments)]
+
+    def time_snap_many(self, n_filaments):
+        snap_many(self.snakes, grad=self.grad, spacing=SPACING, n_interp=1)
+
+    def peakmem_snap_many(self, n_filaments):
+        snap_many(self.snakes, grad=self.grad, spacing=SPACING, n_interp=1)
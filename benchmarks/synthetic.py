@@ -0,0 +1,65 @@
+"""
+Synthetic volumes, polygons and filaments for the benchmarks.
+"""
+import numpy as np
+from scipy import ndimage
+
+
+def filament_curve(shape, n_points):
+    """
+    Coordinates of a smooth curved filament across a volume, as an `n_points` x 3 array.
+    """
+    t = np.linspace(0, 1, n_points)
+    return np.array([(shape[0] - 1) * (0.2 + 0.6 * t),
+                     (shape[1] - 1) * (0.2 + 0.6 * t),
+                     (shape[2] - 1) * (0.5 + 0.3 * np.sin(6 * t))]).transpose()
+
+
+def synthetic_volume(shape, n_filaments=10, sigma=2, seed=0):
+    """
+    Volume with bright smoothed filaments on a noisy background.
+    """
+    rng = np.random.default_rng(seed)
+    img = np.zeros(shape, dtype=np.float32)
+    for i in range(n_filaments):
+        coords = filament_curve(shape, 4 * max(shape))
+        coords[:, 1:] = np.clip(coords[:, 1:] + rng.uniform(-0.2, 0.2, 2) * np.array(shape[1:]),
+                                0, np.array(shape[1:]) - 1)
+        img[tuple(np.int_(np.round(coords)).transpose())] = 1
+    img = ndimage.gaussian_filter(img, sigma)
+    img += rng.normal(0, 0.01, shape).astype(np.float32)
+    return img
+
+
+def synthetic_polygons(shape, n_rays):
+    """
+    Two polygons of `n_rays` rays each, drawn over the same filament from the top (along z) and from the side
+        (along y), as in `compute_polygon_intersection`.
+    """
+    coords = filament_curve(shape, n_rays)
+    top_near = coords.copy()
+    top_near[:, 0] = 0
+    top_far = coords.copy()
+    top_far[:, 0] = shape[0] - 1
+    side_near = coords.copy()
+    side_near[:, 1] = 0
+    side_far = coords.copy()
+    side_far[:, 1] = shape[1] - 1
+    return [[top_near, top_far], [side_near, side_far]]
+
+
+def initial_snake(shape, n_points, noise=3, seed=0):
+    """
+    Filament coordinates with random displacements of the inner points, as an initial active contour.
+    """
+    snake = filament_curve(shape, n_points)
+    snake[1:-1] += np.random.default_rng(seed).uniform(-noise, noise, snake[1:-1].shape)
+    return np.clip(snake, 0, np.array(shape) - 1)
+
+
+def random_filaments(n, seed=0):
+    """
+    `n` random filaments of 2 to 30 points each.
+    """
+    rng = np.random.default_rng(seed)
+    return [(rng.random((rng.integers(2, 30), 3)) * 100).astype(np.float32) for _ in range(n)]
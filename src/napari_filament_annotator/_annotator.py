@@ -1,10 +1,21 @@
 import itertools
+import os
+import tempfile
 
 import numpy as np
-from scipy import ndimage
+from napari.qt.threading import thread_worker
+from napari.utils.colormaps.standardize_color import transform_color
 
-from .utils.geom import compute_polygon_intersection
-from .utils.postproc import snap_to_bright, gradient
+from .utils.cache import GradientCache, gradient_key
+from .utils.geom import compute_polygon_intersection, PolygonBuffer, trim_path
+from .utils.journal import Journal
+from .utils.postproc import snap_to_bright, snap_to_bright_steps, snap_many, allocate_gradient, is_lazy
+from .utils.profiling import Profiler
+from .utils.spatial import FilamentIndex
+from .utils.tiled import TiledGradient
+
+# iterations between the checks for a cancelled background refinement, if no preview is shown
+CANCEL_EVERY = 50
 
 
 class Annotator:
@@ -12,14 +23,44 @@ class Annotator:
     Annotator
     """
 
-    def __init__(self, viewer, img_layer, params):
+    def __init__(self, viewer, img_layer, params, precompute=False, cache_dir=None, image=None, maxval=None,
+                 journal=None):
         self.params = params
-        img = img_layer.data.copy().astype(np.float32)
-        img = ndimage.gaussian_filter(img, sigma=params.sigma)
-        self.grad = gradient(img, img_layer.scale)  # calculate the gradient for the active contour
-
-        self.near_points = []  # store near points of the currently drawn polygon
-        self.far_points = []  # store far points of the currently drawn polygon
+        # gradient for the active contour, calculated on demand around each filament
+        # from the unmasked image; bright voxels are masked out when the gradient is sampled
+        image = img_layer.data if image is None else image
+        # lazy images (e.g. larger than memory) are never computed in full:
+        # tiles are computed on demand around the filaments, and the gradient is ready right away
+        precompute = precompute and not is_lazy(image)
+        store = None
+        if params.grad_memmap and cache_dir is None and not is_lazy(image):  # keep all computed tiles on disk
+            self._tmpdir = tempfile.TemporaryDirectory()
+            store = allocate_gradient(image.shape, params.grad_dtype,
+                                      os.path.join(self._tmpdir.name, 'gradient.npy'))
+        self.grad = TiledGradient(image, sigma=params.sigma, spacing=img_layer.scale,
+                                  max_bytes=int(params.cache_mb * 2 ** 20), dtype=params.grad_dtype, store=store,
+                                  maxval=maxval)
+        # gradient saved on disk for future sessions with the same image
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = GradientCache(cache_dir, max_bytes=int(params.disk_cache_gb * 2 ** 30))
+            if not precompute:
+                self._open_cache()
+        # if the gradient is precomputed in the background, filaments are refined once it is ready
+        self.gradient_ready = not precompute
+        self.queue = []  # indices of the filaments waiting for refinement
+        self.jobs = {}  # index of the filament: worker refining it in the background
+        self.states = {}  # index of the filament: latest state of its background refinement
+        # log of the added, deleted and edited filaments, to recover the annotations after a crash
+        self.journal = Journal(journal) if journal is not None else None
+        # spatial index of the filaments, to pick the nearest filament and find duplicates;
+        # filaments are resampled to about one voxel (along the coarsest axis) between vertices
+        self.index = FilamentIndex(spacing=img_layer.scale[-3:], step=np.max(img_layer.scale[-3:]))
+        # timing of the annotation stages, if enabled in the parameters
+        self.profiler = Profiler(enabled=params.profile)
+
+        self.drawing = PolygonBuffer()  # store near and far points of the currently drawn polygon
+        self.drawn = False  # whether the currently drawn polygon is already added to the shapes layer
         self.polygons = []  # store near and far points of the last 1-2 polygons (to compute intersections)
         self.annotation_layer = viewer.add_shapes(_get_bbox(img_layer.data.shape),
                                                   name='annotations',
@@ -31,6 +72,43 @@ class Annotator:
         self.viewer = viewer
         self.add_callbacks()
 
+    @property
+    def near_points(self):
+        """Near points of the currently drawn polygon."""
+        return self.drawing.near
+
+    @near_points.setter
+    def near_points(self, points):
+        self.drawing.set_near(points)
+
+    @property
+    def far_points(self):
+        """Far points of the currently drawn polygon."""
+        return self.drawing.far
+
+    @far_points.setter
+    def far_points(self, points):
+        self.drawing.set_far(points)
+
+    def precompute_gradient(self):
+        """
+        Open the gradient cache on disk, if any, and compute the gradient tiles in advance.
+
+        Yields
+        ------
+        tuple:
+            Number of computed tiles and the total number of tiles to compute.
+        """
+        if self.cache is not None:
+            self._open_cache()
+        yield from self.grad.precompute()
+
+    def _open_cache(self):
+        key = gradient_key(self.grad.img, self.grad.sigma, self.grad.spacing, self.grad.dtype, self.grad.tile_shape)
+        entry = self.cache.open(key, self.grad.shape, self.grad.dtype, self.grad.ntiles)
+        if entry is not None:  # otherwise, the gradient does not fit in the cache and is kept in memory
+            self.grad.set_store(*entry)
+
     def add_callbacks(self):
         self.annotation_layer.mouse_drag_callbacks.append(self._draw_polygon)
         self.annotation_layer.mouse_drag_callbacks.append(self._calculate_intersection)
@@ -38,6 +116,8 @@ class Annotator:
         self.annotation_layer.bind_key('p', self.delete_the_last_point)
         self.annotation_layer.bind_key('f', self.delete_the_first_filament_point)
         self.annotation_layer.bind_key('l', self.delete_the_last_filament_point)
+        self.annotation_layer.bind_key('s', self.select_nearest_filament)
+        self.annotation_layer.bind_key('a', self.accept_refinement)
 
     def _draw_polygon(self, layer, event):
         """
@@ -49,25 +129,28 @@ class Annotator:
         yield
         if 'Control' in event.modifiers:  # draw a polygon if "Control" is pressed
             # get the near and far points at the mouse position
-            near_point, far_point = layer.get_ray_intersections(
-                event.position,
-                event.view_direction,
-                event.dims_displayed
-            )
+            with self.profiler.stage('ray_intersections'):
+                near_point, far_point = layer.get_ray_intersections(
+                    event.position,
+                    event.view_direction,
+                    event.dims_displayed
+                )
             # append to the array of near and far points
             if (near_point is not None) and (far_point is not None):
-                self.near_points.append(near_point)
-                self.far_points.append(far_point)
+                self.drawing.append(near_point, far_point)
 
             # draw a polygon from the array of near and far points
             if len(self.near_points) > 0 and len(self.far_points) > 0:
-                self.draw_polygon(layer)
+                with self.profiler.stage('draw_polygon'):
+                    self.draw_polygon(layer)
+            self._show_profile(layer)
 
         yield
 
     def draw_polygon(self, layer, color: str = 'red'):
         """
         Draw a polygon between provided near and far points.
+        The polygon that is being drawn is updated in place, without rebuilding the other shapes.
 
         Parameters
         ----------
@@ -80,29 +163,22 @@ class Annotator:
         -------
         Updated shapes layer
         """
-        near_points = self.near_points.copy()
-        far_points = self.far_points.copy()
-        if len(near_points) < 2:  # if only one point, add a temporary point for display purposes
-            near_points.append(np.array(near_points[0]) + self.params.line_width)
-            far_points.append(np.array(far_points[0]) + self.params.line_width)
-
-        # reverse the far points and combine near and far points into a polygon
-        far_points_reverse = far_points.copy()
-        far_points_reverse.reverse()
-        polygon = np.array(near_points + far_points_reverse)
-
-        # remove the old polygon belonging to the same annotation
-        if np.array((layer.data[-1][0] == polygon[0])).all():
-            layer.selected_data = set(range(layer.nshapes - 1, layer.nshapes))
-            layer.remove_selected()
-
-        # add the updated polygon
-        layer.add(
-            polygon,
-            shape_type='polygon',
-            edge_width=self.params.line_width,
-            edge_color=color
-        )
+        # far points in reverse order, followed by the near points
+        polygon = self.drawing.polygon
+        if len(self.drawing) < 2:  # if only one point, add a temporary point for display purposes
+            polygon = np.concatenate([polygon[:1] + self.params.line_width, polygon,
+                                      polygon[-1:] + self.params.line_width])
+
+        if self.drawn:  # update the polygon belonging to the same annotation
+            _update_shape(layer, layer.nshapes - 1, polygon, edge_color=color)
+        else:
+            layer.add(
+                polygon,
+                shape_type='polygon',
+                edge_width=self.params.line_width,
+                edge_color=color
+            )
+            self.drawn = True
 
     def _calculate_intersection(self, layer, event):
         """
@@ -111,33 +187,285 @@ class Annotator:
         yield
         while event.type == 'mouse_move':
             if 'Control' not in event.modifiers:  # Only execute if "Control" is not pressed
-                # add the last annotation to the polygon array and clear the annotation arrays
-                self.calculate_intersection(layer)
+                # add the last annotation to the polygon array and clear the annotation arrays;
+                # the filament is refined in the background, not to freeze the viewer
+                self.calculate_intersection(layer, asynchronous=True)
 
             yield
 
-    def calculate_intersection(self, layer):
+    def calculate_intersection(self, layer, asynchronous=False):
+        """
+        Add the currently drawn polygon and calculate the filament, if this is the second polygon.
+
+        Parameters
+        ----------
+        layer : napari.layers.Shapes
+            napari shapes layer with annotations
+        asynchronous : bool, optional
+            If True, the filament is refined in a worker thread: the unrefined filament is shown right away
+                and replaced by the refined filament when it is ready.
+        """
         if len(self.near_points) > 0:
             self.polygons.append([self.near_points.copy(), self.far_points.copy()])
-        self.near_points.clear()
-        self.far_points.clear()
+        self.drawing.clear()
+        self.drawn = False
 
         # if there are 2 or more polygons, calculate their intersection
         if len(self.polygons) >= 2:
-            filament = compute_polygon_intersection(self.polygons, layer.scale)
-            filament = snap_to_bright(snake=filament, grad=self.grad,
-                                      spacing=layer.scale, **vars(self.params))
+            with self.profiler.stage('polygon_intersection'):
+                filament, stats = compute_polygon_intersection(self.polygons, layer.scale, return_stats=True)
+            self.profiler.record('tetragon_intersections', stats['time_intersect'])
+            self.profiler.record('tetragon_matching', stats['time_match'])
+            self.profiler.count('tetragon_pairs', stats['pairs'] - stats['pruned'])
+            refined = self.gradient_ready and not asynchronous
+            if refined:
+                with self.profiler.stage('snap_to_bright'):
+                    filament, iterations = snap_to_bright(snake=filament, grad=self.grad, spacing=layer.scale,
+                                                          return_iterations=True, **vars(self.params))
+                self.profiler.count('iterations', iterations)
 
             # remove the 2 polygons from the shapes layer
-            layer.selected_data = set(range(layer.nshapes - 2, layer.nshapes))
-            layer.remove_selected()
-
-            # add the calculated filament
-            layer.add(filament, shape_type='path', edge_color='green', edge_width=self.params.line_width)
+            with self.profiler.stage('layer_remove'):
+                layer.selected_data = set(range(layer.nshapes - 2, layer.nshapes))
+                layer.remove_selected()
+
+            # add the calculated filament; show the unrefined filament in yellow until it is refined
+            with self.profiler.stage('layer_add'):
+                layer.add(filament, shape_type='path', edge_color='green' if refined else 'yellow',
+                          edge_width=self.params.line_width)
+            index = layer.nshapes - 1
+            self._filament_added(index - 1, filament)  # the first shape is the image bounding box
+            if not self.gradient_ready:  # refine once the gradient is ready
+                self.queue.append(index)
+            elif not refined:
+                self.refine_in_background(layer, index, filament)
 
             # clear the polygons array
             self.polygons.pop()
             self.polygons.pop()
+            self._show_profile(layer)
+
+    def set_gradient_ready(self, layer=None, asynchronous=False):
+        """
+        Mark the gradient as ready and refine the filaments that were added before.
+
+        Parameters
+        ----------
+        layer : napari.layers.Shapes, optional
+            napari shapes layer with annotations; the annotation layer of the annotator, if None.
+        asynchronous : bool, optional
+            If True, each filament is refined in a worker thread (see `refine_in_background`).
+        """
+        layer = self.annotation_layer if layer is None else layer
+        self.gradient_ready = True
+        filaments = [np.array(_get_shape_data(layer, index)) for index in self.queue]
+        if asynchronous:
+            for index, filament in zip(self.queue, filaments):
+                self.refine_in_background(layer, index, filament)
+            self.queue.clear()
+            return
+        with self.profiler.stage('snap_many'):
+            filaments, iterations = snap_many(filaments, grad=self.grad, spacing=layer.scale,
+                                              return_iterations=True, **vars(self.params))
+        self.profiler.count('iterations', np.sum(iterations))
+        for index, filament in zip(self.queue, filaments):
+            _update_shape(layer, index, filament, edge_color='green')
+            self._filament_edited(index - 1, filament)
+        self.queue.clear()
+
+    def refine_in_background(self, layer, index, filament):
+        """
+        Refine a filament in a worker thread and update its shape when the refinement is done.
+        If `preview_every` is set in the parameters, the intermediate states of the filament are shown as well;
+            the latest state is kept in any case, to accept the refinement early (see `accept_refinement`).
+
+        Parameters
+        ----------
+        layer : napari.layers.Shapes
+            napari shapes layer with annotations
+        index : int
+            Index of the filament shape in the layer.
+        filament : np.ndarray
+            Unrefined filament coordinates.
+        """
+        params = dict(vars(self.params))  # parameters at the time the filament is drawn
+        preview_every = params.get('preview_every') or 0
+
+        def refine():
+            yield  # the job can be cancelled before it starts
+            # the worker can only be stopped when it yields, so it yields regularly even without the preview
+            with self.profiler.stage('snap_to_bright'):
+                refined, iterations = yield from snap_to_bright_steps(
+                    snake=filament, grad=self.grad, spacing=layer.scale, every=preview_every or CANCEL_EVERY,
+                    return_iterations=True, **params)
+            self.profiler.count('iterations', iterations)
+            return refined
+
+        worker = thread_worker(refine)()
+        worker.yielded.connect(lambda state: self._refinement_step(layer, index, worker, state, preview_every > 0))
+        worker.returned.connect(lambda refined: self._refinement_done(layer, index, worker, refined))
+        self.jobs[index] = worker
+        worker.start()
+
+    def _refinement_step(self, layer, index, worker, filament, preview):
+        if filament is not None and self.jobs.get(index) is worker:
+            self.states[index] = filament
+            if preview:
+                _update_shape(layer, index, filament)
+
+    def _refinement_done(self, layer, index, worker, filament):
+        if self.jobs.get(index) is not worker:  # the filament was deleted in the meantime
+            return
+        del self.jobs[index]
+        self.states.pop(index, None)
+        _update_shape(layer, index, filament, edge_color='green')
+        self._filament_edited(index - 1, filament)
+        self._show_profile(layer)
+
+    def accept_refinement(self, layer):
+        """
+        Stop the running refinements and keep the latest state of the filaments.
+        The filaments without an intermediate state yet continue to be refined.
+        """
+        for index in list(self.jobs):
+            filament = self.states.get(index)
+            if filament is None:
+                continue
+            self.cancel_refinement(index)
+            _update_shape(layer, index, filament, edge_color='green')
+            self._filament_edited(index - 1, filament)
+
+    def cancel_refinement(self, index):
+        """
+        Cancel the background refinement of a filament, if it is running.
+        """
+        worker = self.jobs.pop(index, None)
+        self.states.pop(index, None)
+        if worker is not None:
+            worker.quit()
+
+    def save_profile(self, filename):
+        """
+        Save the timing statistics of the session and the gradient memory footprint to a json file.
+        """
+        store = self.grad.store
+        self.profiler.save(filename,
+                           gradient_cache_bytes=int(self.grad.nbytes),
+                           gradient_store_bytes=int(store.nbytes) if store is not None else 0,
+                           gradient_tiles_cached=len(self.grad._cache),
+                           gradient_tiles_stored=int(np.sum(self.grad.computed)),
+                           n_filaments=int(self.annotation_layer.nshapes - 1))
+
+    def _show_profile(self, layer):
+        # show the timings of the latest stages in the status bar
+        if self.profiler.enabled:
+            summary = self.profiler.summary()
+            if len(summary) > 0:
+                layer.status = summary
+
+    def close_journal(self):
+        """
+        Stop logging the annotation changes, e.g. when another annotation layer takes over the journal.
+        """
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def add_filaments(self, data, log=True):
+        """
+        Add existing filaments to the annotation layer.
+
+        Parameters
+        ----------
+        data : list
+            List of filaments, each of shape N x 3.
+        log : bool, optional
+            If True, the filaments are added to the journal.
+        """
+        layer = self.annotation_layer
+        if len(data) > 0:
+            layer.add(data, shape_type='path', edge_color='green', edge_width=self.params.line_width)
+        indices = range(layer.nshapes - len(data) - 1, layer.nshapes - 1)
+        self.index.add_many(indices, data)
+        if log and self.journal is not None:
+            for index, filament in zip(indices, data):
+                self.journal.add(index, filament)
+
+    def _filament_added(self, index, filament):
+        self.index.add(index, filament)
+        if self.journal is not None:
+            self.journal.add(index, filament)
+
+    def _filament_edited(self, index, filament):
+        self.index.add(index, filament)
+        if self.journal is not None:
+            self.journal.edit(index, filament)
+
+    def _filament_deleted(self, index):
+        self.index.remove(index)
+        if self.journal is not None:
+            self.journal.delete(index)
+
+    def nearest_filament(self, points):
+        """
+        Find the filament nearest to any of the given points.
+
+        Parameters
+        ----------
+        points : np.ndarray
+            M x 3 array of coordinates (or a single point), in voxels.
+
+        Returns
+        -------
+        int:
+            Index of the nearest filament in the annotation layer, or None if there are no filaments.
+        float:
+            Distance to the filament, in the units of the voxel size.
+        """
+        keys, dist = self.index.nearest(np.atleast_2d(points))
+        i = np.argmin(dist)
+        if keys[i] < 0:
+            return None, np.inf
+        return int(keys[i]) + 1, dist[i]
+
+    def select_nearest_filament(self, layer):
+        """
+        Select the filament nearest to the mouse cursor (to the line of sight through the cursor in 3D)
+        """
+        position = self.viewer.cursor.position
+        displayed = list(self.viewer.dims.displayed)
+        view_direction = np.zeros(len(position))  # camera view direction in all dimensions
+        if len(displayed) == 3:
+            view_direction[displayed] = self.viewer.camera.view_direction
+        near_point, far_point = layer.get_ray_intersections(position, view_direction, displayed)
+        if near_point is not None and far_point is not None:
+            n = int(np.ceil(np.linalg.norm(np.array(far_point) - np.array(near_point)))) + 1
+            points = np.linspace(near_point, far_point, n)
+        else:
+            points = np.array(layer.world_to_data(position))
+        index, dist = self.nearest_filament(points)
+        if index is not None:
+            layer.selected_data = {index}
+            layer.status = rf"selected filament {index - 1} (distance {dist:.2f})"
+
+    def find_duplicates(self, tolerance, min_overlap=0.8):
+        """
+        Find filaments that duplicate other filaments.
+
+        Parameters
+        ----------
+        tolerance : float
+            Distance tolerance, in the units of the voxel size.
+        min_overlap : float, optional
+            Minimal fraction of a filament within `tolerance` of the other filament.
+
+        Returns
+        -------
+        pd.DataFrame:
+            Overlapping filaments ('filament'), the filaments they overlap ('other'), and the overlap fraction;
+                filaments are numbered in the order they are saved.
+        """
+        return self.index.duplicates(tolerance, min_overlap=min_overlap)
 
     def delete_the_last_shape(self, layer, show_message=True):
         """
@@ -151,12 +479,18 @@ class Annotator:
             layer.selected_data = set(range(layer.nshapes - 1, layer.nshapes))
             layer.remove_selected()
 
-            if len(self.near_points) > 0:  # if any points in the near/far points array, clear them
-                self.near_points.clear()
-                self.far_points.clear()
+            if self.drawn or len(self.near_points) > 0:  # if a polygon is being drawn, clear its points
+                self.drawing.clear()
+                self.drawn = False
 
             elif len(self.polygons) > 0:  # otherwise, clear the polygons array
                 self.polygons.pop()
+
+            else:  # otherwise, a filament was deleted
+                if layer.nshapes in self.queue:  # cancel the refinement of the deleted filament
+                    self.queue.remove(layer.nshapes)
+                self.cancel_refinement(layer.nshapes)
+                self._filament_deleted(layer.nshapes - 1)
         else:
             msg = 'no shapes to delete'
 
@@ -170,24 +504,73 @@ class Annotator:
 
         """
         if len(self.near_points) > 0 and len(self.far_points) > 0:
-            self.near_points.pop()
-            self.far_points.pop()
+            self.drawing.pop()
             if len(self.near_points) > 0:
                 self.draw_polygon(layer)
             else:
                 self.delete_the_last_shape(layer, show_message=False)
 
     def delete_the_last_filament_point(self, layer):
-        """Remove the last point in the last filament"""
-        if layer.nshapes > 1:
-            data = layer.data[-1][:-1]
-            layer.data = layer.data[:-1] + [data]
+        """Remove the last point (or the last `trim_length` of the arc length) in the last filament"""
+        self._trim_last_filament(layer, end=-1)
 
     def delete_the_first_filament_point(self, layer):
-        """Remove the first point in the last filament"""
+        """Remove the first point (or the first `trim_length` of the arc length) in the last filament"""
+        self._trim_last_filament(layer, end=0)
+
+    def _trim_last_filament(self, layer, end):
+        # only the last shape is updated, if it is a filament (not a polygon being drawn); at least two points are kept
+        if self.drawn or len(self.polygons) > 0 or layer.shape_type[-1] != 'path':
+            return
         if layer.nshapes > 1:
-            data = layer.data[-1][1:]
-            layer.data = layer.data[:-1] + [data]
+            index = layer.nshapes - 1
+            data = trim_path(_get_shape_data(layer, index), self.params.trim_length, layer.scale, end)
+            if len(data) >= 2:
+                _update_shape(layer, index, data)
+                self._filament_edited(index - 1, data)
+
+
+def _shape_list(layer):
+    """
+    Shape list of a shapes layer, to access and edit a single shape in place.
+
+    The shape list is private in napari: None is returned if it is not available,
+        and the shapes are accessed through the public API instead (which rebuilds all shapes of the layer).
+    """
+    shapes = getattr(layer, '_data_view', None)
+    if callable(getattr(shapes, 'edit', None)) and hasattr(shapes, 'shapes'):
+        return shapes
+    return None
+
+
+def _update_shape(layer, index, data, edge_color=None):
+    """
+    Replace the vertices of a single shape, without rebuilding the other shapes of the layer.
+    """
+    if edge_color is not None:
+        edge_color = transform_color(edge_color)[0]
+    shapes = _shape_list(layer)
+    if shapes is not None:
+        shapes.edit(index, data, edge_color=edge_color)
+        layer.refresh()
+        return
+    data_all = list(layer.data)
+    data_all[index] = np.asarray(data)
+    layer.data = data_all
+    if edge_color is not None:
+        colors = np.array(layer.edge_color)
+        colors[index] = edge_color
+        layer.edge_color = colors
+
+
+def _get_shape_data(layer, index):
+    """
+    Vertices of a single shape, without collecting the data of all shapes of the layer.
+    """
+    shapes = _shape_list(layer)
+    if shapes is not None:
+        return shapes.shapes[index].data
+    return layer.data[index]
 
 
 def _get_bbox(shape):
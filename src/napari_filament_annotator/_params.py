@@ -16,30 +16,84 @@ class Params():
     def set_smoothing(self, sigma_um):
         self.sigma = sigma_um / self.scale
 
-    def set_linewidth(self, line_width):
+    def set_cache(self, cache_mb=1024, grad_dtype='float32', grad_memmap=False, disk_cache_gb=10, cache_dir=''):
+        self.cache_mb = cache_mb
+        self.grad_dtype = grad_dtype
+        self.grad_memmap = grad_memmap
+        self.disk_cache_gb = disk_cache_gb
+        self.cache_dir = cache_dir
+
+    def set_profile(self, profile=False):
+        self.profile = profile
+
+    def set_linewidth(self, line_width, trim_length=0):
         self.line_width = line_width
+        self.trim_length = trim_length
 
     def set_coef(self, alpha=0.01, beta=0.1, gamma=1):
         self.alpha = alpha
         self.beta = beta
         self.gamma = gamma
 
-    def set_ac_parameters(self, n_iter=100, n_interp=5, end_coef=0.01):
+    def set_ac_parameters(self, n_iter=100, n_interp=5, end_coef=0.01, evolution='explicit',
+                          n_levels=1, level_iter=100, preview_every=0, backend='numpy', tol=0, schedule='linear'):
         self.n_iter = n_iter
         self.n_interp = n_interp
         self.end_coef = end_coef
+        self.evolution = evolution
+        self.n_levels = n_levels
+        self.level_iter = level_iter
+        self.preview_every = preview_every
+        self.backend = backend
+        self.tol = tol
+        self.schedule = schedule
 
     def save(self, filename):
         os.makedirs(os.path.dirname(filename), exist_ok=True)
-        params = dict(voxel_size_xy=self.scale[-1],
-                      voxel_size_z=self.scale[0],
-                      sigma_um=self.sigma[-1] * self.scale[-1],
-                      line_width=self.line_width,
-                      alpha=self.alpha,
-                      beta=self.beta,
-                      gamma=self.gamma,
-                      n_iter=self.n_iter,
-                      n_interp=self.n_interp,
-                      end_coef=self.end_coef)
         with open(filename, 'w') as f:
-            json.dump(params, f)
+            json.dump(self.to_dict(), f)
+
+    def to_dict(self):
+        """Parameters as a json-serializable dictionary, in the format of the parameter file."""
+        return dict(voxel_size_xy=self.scale[-1],
+                    voxel_size_z=self.scale[0],
+                    sigma_um=self.sigma[-1] * self.scale[-1],
+                    cache_mb=self.cache_mb,
+                    grad_dtype=self.grad_dtype,
+                    grad_memmap=self.grad_memmap,
+                    disk_cache_gb=self.disk_cache_gb,
+                    cache_dir=self.cache_dir,
+                    profile=self.profile,
+                    line_width=self.line_width,
+                    trim_length=self.trim_length,
+                    alpha=self.alpha,
+                    beta=self.beta,
+                    gamma=self.gamma,
+                    n_iter=self.n_iter,
+                    n_interp=self.n_interp,
+                    end_coef=self.end_coef,
+                    evolution=self.evolution,
+                    n_levels=self.n_levels,
+                    level_iter=self.level_iter,
+                    preview_every=self.preview_every,
+                    backend=self.backend,
+                    tol=self.tol,
+                    schedule=self.schedule)
+
+    def load(self, filename):
+        with open(filename, 'r') as f:
+            params = json.load(f)
+        self.set_scale([params['voxel_size_z'], params['voxel_size_xy'], params['voxel_size_xy']])
+        self.set_smoothing(params['sigma_um'])
+        self.set_cache(params.get('cache_mb', 1024), grad_dtype=params.get('grad_dtype', 'float32'),
+                       grad_memmap=params.get('grad_memmap', False), disk_cache_gb=params.get('disk_cache_gb', 10),
+                       cache_dir=params.get('cache_dir', ''))
+        self.set_profile(params.get('profile', False))
+        self.set_linewidth(params['line_width'], trim_length=params.get('trim_length', 0))
+        self.set_coef(alpha=params['alpha'], beta=params['beta'], gamma=params['gamma'])
+        self.set_ac_parameters(n_iter=params['n_iter'], n_interp=params['n_interp'],
+                               end_coef=params['end_coef'], evolution=params.get('evolution', 'explicit'),
+                               n_levels=params.get('n_levels', 1), level_iter=params.get('level_iter', 100),
+                               preview_every=params.get('preview_every', 0),
+                               backend=params.get('backend', 'numpy'), tol=params.get('tol', 0),
+                               schedule=params.get('schedule', 'linear'))
@@ -0,0 +1,176 @@
+"""
+Refine saved annotations with new parameters, without opening the images in napari
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from skimage import io
+
+from ._params import Params
+from .utils.io import read_annotations, write_annotations, ANNOTATION_EXTENSIONS
+from .utils.postproc import gradient, snap_many
+
+IMAGE_EXTENSIONS = ('.tif', '.tiff')
+# refinement parameters saved for each filament to npz files
+REFINEMENT_PARAMS = ('alpha', 'beta', 'gamma', 'n_iter', 'n_interp', 'end_coef', 'evolution')
+
+
+def refine_file(image_file, annotation_file, output_file, params):
+    """
+    Refine all filaments of one image with the given parameters.
+
+    Parameters
+    ----------
+    image_file : str
+        3D input image.
+    annotation_file : str
+        CSV or npz file with the annotations of the image.
+    output_file : str
+        CSV or npz file to save the refined annotations; the parameters, and the refinement parameters
+            and number of iterations of each filament, are saved to npz files.
+    params : Params
+        Parameters for the gradient calculation and the active contour refinement.
+
+    Returns
+    -------
+    dict:
+        Image name, number of refined filaments, total number of active contour iterations,
+            and the time (in seconds) to load the data, compute the gradient, refine and save the filaments.
+    """
+    timing = dict(name=os.path.basename(image_file))
+    start = time.perf_counter()
+    img = io.imread(image_file)
+    data, labels = read_annotations(annotation_file)
+    timing['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grad = gradient(ndimage.gaussian_filter(img.astype(np.float32), sigma=params.sigma), params.scale)
+    timing['gradient'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    filaments, iterations = snap_many([np.array(d, dtype=float) for d in data], grad=grad,
+                                      spacing=params.scale, return_iterations=True, **vars(params))
+    timing['refine'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    metadata = pd.DataFrame({name: getattr(params, name) for name in REFINEMENT_PARAMS}, index=range(len(filaments)))
+    metadata['iterations'] = iterations
+    write_annotations(output_file, filaments, labels, params=params.to_dict(), metadata=metadata)
+    timing['save'] = time.perf_counter() - start
+    timing['filaments'] = len(filaments)
+    timing['iterations'] = int(np.sum(iterations))
+    return timing
+
+
+def find_files(image_dir, annotation_dir=None):
+    """
+    List the images in a directory that have an annotation file (csv or npz) with the same name.
+
+    Returns
+    -------
+    list of tuples:
+        Pairs of image and annotation filenames.
+    list:
+        Images without annotations.
+    """
+    annotation_dir = image_dir if annotation_dir is None else annotation_dir
+    pairs = []
+    missing = []
+    for image_file in sorted(glob(os.path.join(image_dir, '*'))):
+        name, ext = os.path.splitext(os.path.basename(image_file))
+        if ext.lower() not in IMAGE_EXTENSIONS:
+            continue
+        annotation_files = [os.path.join(annotation_dir, name + ext) for ext in ANNOTATION_EXTENSIONS]
+        annotation_files = [fn for fn in annotation_files if os.path.exists(fn)]
+        if len(annotation_files) > 0:
+            pairs.append((image_file, annotation_files[0]))
+        else:
+            missing.append(image_file)
+    return pairs, missing
+
+
+def refine_all(image_dir, params_file, output_dir, annotation_dir=None, n_workers=1, n_interp=1):
+    """
+    Refine the annotations of all images in a directory, distributing the images over a process pool.
+
+    Parameters
+    ----------
+    image_dir : str
+        Directory with the images.
+    params_file : str
+        Parameter file saved by the annotator widget.
+    output_dir : str
+        Directory to save the refined annotations.
+    annotation_dir : str, optional
+        Directory with the annotation files (csv or npz), named as the images. Default: the image directory.
+    n_workers : int, optional
+        Number of worker processes.
+    n_interp : int, optional
+        Number of points to interpolate between each pair of annotated points, overriding the parameter file.
+        Default: 1, to keep the number of points of the saved (already interpolated) filaments.
+        Set to None to use the value from the parameter file.
+
+    Returns
+    -------
+    list of dict:
+        Timing summary for each image.
+    """
+    params = Params()
+    params.load(params_file)
+    if n_interp is not None:
+        params.n_interp = n_interp
+    pairs, missing = find_files(image_dir, annotation_dir)
+    for image_file in missing:
+        print(rf"Skipped {image_file}: no annotations found")
+
+    jobs = [(image_file, annotation_file, os.path.join(output_dir, os.path.basename(annotation_file)), params)
+            for image_file, annotation_file in pairs]
+    summary = []
+    start = time.perf_counter()
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(refine_file, *job) for job in jobs]
+            for future in as_completed(futures):
+                summary.append(future.result())
+                _print_progress(summary[-1], len(summary), len(jobs))
+    else:
+        for job in jobs:
+            summary.append(refine_file(*job))
+            _print_progress(summary[-1], len(summary), len(jobs))
+    print(rf"Refined {sum([s['filaments'] for s in summary])} filaments in {len(summary)} images "
+          rf"in {time.perf_counter() - start:.1f} s")
+    return summary
+
+
+def _print_progress(timing, i, n):
+    print(rf"[{i}/{n}] {timing['name']}: {timing['filaments']} filaments, {timing['iterations']} iterations; "
+          rf"load {timing['load']:.1f} s, gradient {timing['gradient']:.1f} s, "
+          rf"refine {timing['refine']:.1f} s, save {timing['save']:.1f} s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Refine saved filament annotations with new parameters")
+    parser.add_argument('image_dir', help="Directory with the images")
+    parser.add_argument('params', help="Parameter file (json) saved by the annotator widget")
+    parser.add_argument('output_dir', help="Directory to save the refined annotations")
+    parser.add_argument('--annotations', default=None,
+                        help="Directory with the annotation files (csv or npz), named as the images "
+                             "(default: the image directory)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--n-interp', type=int, default=1,
+                        help="Number of points to interpolate between annotated points "
+                             "(default: 1, saved filaments are already interpolated)")
+    args = parser.parse_args(argv)
+    refine_all(args.image_dir, args.params, args.output_dir, annotation_dir=args.annotations,
+               n_workers=args.workers, n_interp=args.n_interp)
+
+
+if __name__ == '__main__':
+    main()
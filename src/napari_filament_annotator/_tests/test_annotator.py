@@ -1,12 +1,15 @@
 import json
 import os
+from types import SimpleNamespace
 
 import numpy as np
 import pandas as pd
 import pytest
-from napari_filament_annotator import AnnotatorWidget
+from napari_filament_annotator import AnnotatorWidget, _annotator
 from napari_filament_annotator.utils.const import COLS
-from napari_filament_annotator.utils.io import annotation_to_pandas
+from napari_filament_annotator.utils.io import annotation_to_pandas, read_annotations, write_annotations
+from napari_filament_annotator.utils.journal import Journal, replay
+from qtpy.QtWidgets import QMessageBox
 
 
 # make_napari_viewer is a pytest fixture that returns a napari viewer object
@@ -40,6 +43,16 @@ def test_time_series(annotator_widget):
     assert annotator_widget.annotation_layer_exists() is False
 
 
+def test_lazy_image(annotator_widget):
+    da = pytest.importorskip('dask.array')
+    img = np.random.randint(0, 100, (50, 100, 100)).astype(np.uint16)
+    annotator_widget.viewer.add_image(da.from_array(img, chunks=(10, 50, 50)))
+    annotator_widget.add_annotation_layer()
+    # the gradient is not precomputed for lazy images, but computed on demand
+    assert annotator_widget.annotator.gradient_ready
+    assert not annotator_widget.annotator.grad.computed.any()
+
+
 def test_add_delete(annotator, polygons):
     layer = annotator.annotation_layer
     assert layer.nshapes == 1
@@ -57,6 +70,23 @@ def test_add_delete(annotator, polygons):
     assert layer.nshapes == 1
 
 
+def test_draw_incremental(annotator, polygons):
+    layer = annotator.annotation_layer
+    near, far = np.array(polygons[0][0]), np.array(polygons[0][1])
+    for i in range(len(near)):
+        annotator.drawing.append(near[i], far[i])
+        annotator.draw_polygon(layer)
+        assert layer.nshapes == 2  # the drawn polygon is updated in place
+    assert (layer.data[-1] == np.concatenate([far[::-1], near])).all()
+
+    for _ in range(len(near)):
+        annotator.delete_the_last_point(layer)
+    assert layer.nshapes == 1
+    annotator.drawing.append(near[0], far[0])
+    annotator.draw_polygon(layer)
+    assert layer.nshapes == 2
+
+
 def test_intersection(annotator, polygons):
     layer = annotator.annotation_layer
     annotator.near_points = polygons[0][0].copy()
@@ -81,10 +111,309 @@ def test_intersection(annotator, polygons):
     assert (points[1:-1] == layer.data[-1]).all()
 
 
+def test_trim_length(annotator):
+    layer = annotator.annotation_layer
+    layer.add(np.array([[5, 5, 5], [5, 5, 9], [5, 5, 13]], dtype=float), shape_type='path')
+    annotator.params.trim_length = 1.5
+    annotator.delete_the_last_filament_point(layer)
+    annotator.delete_the_last_filament_point(layer)
+    assert np.allclose(layer.data[-1], [[5, 5, 5], [5, 5, 9], [5, 5, 10]])
+    annotator.delete_the_first_filament_point(layer)
+    assert np.allclose(layer.data[-1], [[5, 5, 6.5], [5, 5, 9], [5, 5, 10]])
+    annotator.params.trim_length = 0
+    annotator.delete_the_last_filament_point(layer)
+    annotator.delete_the_last_filament_point(layer)  # the last two points are kept
+    assert np.allclose(layer.data[-1], [[5, 5, 6.5], [5, 5, 9]])
+    assert layer.nshapes == 2
+
+
+def test_trim_polygon(annotator, polygons, tmp_path):
+    # polygons being drawn or waiting for the second polygon are not trimmed
+    layer = annotator.annotation_layer
+    annotator.journal = Journal(os.path.join(tmp_path, 'trim.journal'))
+    annotator.near_points = polygons[0][0].copy()
+    annotator.far_points = polygons[0][1].copy()
+    annotator.draw_polygon(layer)
+    polygon = layer.data[-1].copy()
+    annotator.delete_the_last_filament_point(layer)
+    assert (layer.data[-1] == polygon).all()
+    annotator.calculate_intersection(layer)
+    assert len(annotator.polygons) == 1
+    annotator.delete_the_first_filament_point(layer)
+    assert (layer.data[-1] == polygon).all()
+    annotator.journal.close()
+    assert replay(annotator.journal.filename) == []
+    assert len(annotator.index) == 0
+
+
+def test_shapes_public_api(annotator, polygons, monkeypatch):
+    # without the private shape list of napari, the shapes are edited through the public API
+    monkeypatch.setattr(_annotator, '_shape_list', lambda layer: None)
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = False
+    for polygon in polygons:
+        near, far = np.array(polygon[0]), np.array(polygon[1])
+        for i in range(len(near)):
+            annotator.drawing.append(near[i], far[i])
+            annotator.draw_polygon(layer)
+            assert layer.nshapes == len(annotator.polygons) + 2
+        assert (layer.data[-1] == np.concatenate([far[::-1], near])).all()
+        assert layer.shape_type[-1] == 'polygon'
+        annotator.calculate_intersection(layer)
+    n_points = len(layer.data[-1])
+    annotator.set_gradient_ready()
+    assert len(layer.data[-1]) > n_points
+    assert np.allclose(layer.edge_color[-1], [0, 128 / 255, 0, 1])
+    assert layer.shape_type[-1] == 'path'
+    annotator.params.trim_length = 0
+    filament = layer.data[-1].copy()
+    annotator.delete_the_last_filament_point(layer)
+    assert (layer.data[-1] == filament[:-1]).all()
+    assert np.allclose(_annotator._get_shape_data(layer, 1), filament[:-1])
+    assert np.allclose(layer.edge_color[-1], [0, 128 / 255, 0, 1])
+
+
+def test_queued_refinement(annotator, polygons):
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = False
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer)
+    assert layer.nshapes == 2
+    assert annotator.queue == [1]
+    n_points = len(layer.data[-1])
+
+    annotator.set_gradient_ready()
+    assert len(annotator.queue) == 0
+    assert layer.nshapes == 2
+    assert len(layer.data[-1]) > n_points
+
+
+def test_async_refinement(annotator, polygons, qtbot):
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = True
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer, asynchronous=True)
+    assert layer.nshapes == 2
+    assert list(annotator.jobs) == [1]
+    n_points = len(layer.data[-1])
+    qtbot.waitUntil(lambda: len(annotator.jobs) == 0, timeout=10000)
+    assert len(layer.data[-1]) > n_points
+
+    # deleting the filament cancels its refinement
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer, asynchronous=True)
+    assert list(annotator.jobs) == [2]
+    worker = annotator.jobs[2]
+    annotator.delete_the_last_shape(layer)
+    assert len(annotator.jobs) == 0
+    qtbot.waitUntil(lambda: not worker.is_running, timeout=10000)
+    assert layer.nshapes == 2
+
+
+def test_cancel_without_preview(annotator, polygons, qtbot):
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = True
+    annotator.params.n_iter = 10 ** 6
+    annotator.params.preview_every = 0
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer, asynchronous=True)
+    worker = annotator.jobs[1]
+    qtbot.waitUntil(lambda: worker.is_running, timeout=10000)
+    annotator.delete_the_last_shape(layer)
+    qtbot.waitUntil(lambda: not worker.is_running, timeout=10000)
+    assert layer.nshapes == 1
+
+
+def test_queued_async_refinement(annotator, polygons, qtbot):
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = False
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer)
+    n_points = len(layer.data[-1])
+    annotator.set_gradient_ready(asynchronous=True)
+    assert len(annotator.queue) == 0
+    assert list(annotator.jobs) == [1]
+    qtbot.waitUntil(lambda: len(annotator.jobs) == 0, timeout=10000)
+    assert len(layer.data[-1]) > n_points
+    assert np.allclose(layer.edge_color[-1], [0, 128 / 255, 0, 1])
+
+
+def test_preview(annotator, polygons, qtbot):
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = True
+    annotator.params.n_iter = 10 ** 6
+    annotator.params.preview_every = 5
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer, asynchronous=True)
+    n_points = len(layer.data[-1])
+    qtbot.waitUntil(lambda: len(layer.data[-1]) > n_points, timeout=10000)  # the interpolated filament is shown
+    worker = annotator.jobs[1]
+    annotator.accept_refinement(layer)
+    assert len(annotator.jobs) == 0
+    accepted = layer.data[-1].copy()
+    qtbot.waitUntil(lambda: not worker.is_running, timeout=10000)
+    assert (layer.data[-1] == accepted).all()
+    assert np.allclose(layer.edge_color[-1], [0, 128 / 255, 0, 1])
+
+
+def test_accept_without_preview(annotator, polygons, qtbot):
+    layer = annotator.annotation_layer
+    annotator.gradient_ready = True
+    annotator.params.n_iter = 10 ** 6
+    annotator.params.preview_every = 0
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer, asynchronous=True)
+    unrefined = layer.data[-1].copy()
+    annotator.accept_refinement(layer)  # nothing to accept yet: the refinement continues
+    assert list(annotator.jobs) == [1]
+    qtbot.waitUntil(lambda: 1 in annotator.states, timeout=10000)
+    assert (layer.data[-1] == unrefined).all()  # no preview is shown
+    worker = annotator.jobs[1]
+    state = annotator.states[1]
+    annotator.accept_refinement(layer)
+    assert len(annotator.jobs) == len(annotator.states) == 0
+    assert np.allclose(layer.data[-1], state)
+    assert len(layer.data[-1]) > len(unrefined)
+    assert np.allclose(layer.edge_color[-1], [0, 128 / 255, 0, 1])
+    qtbot.waitUntil(lambda: not worker.is_running, timeout=10000)
+
+
+def test_journal(annotator, polygons, tmp_path):
+    layer = annotator.annotation_layer
+    annotator.journal = Journal(os.path.join(tmp_path, 'annotator.journal'))
+    annotator.gradient_ready = False
+    annotator.add_filaments([np.array([[5, 5, 5], [5, 5, 9], [5, 5, 13]], dtype=float)])
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer)
+    annotator.set_gradient_ready()
+    annotator.delete_the_last_filament_point(layer)
+    annotator.add_filaments([np.array([[1, 1, 1], [2, 2, 2]], dtype=float)])
+    annotator.delete_the_last_shape(layer)
+    annotator.journal.close()
+    data = replay(annotator.journal.filename)
+    assert len(data) == layer.nshapes - 1 == 2
+    for d, f in zip(data, layer.data[1:]):
+        assert np.allclose(d, f)
+
+
+def test_nearest_filament(annotator, polygons):
+    layer = annotator.annotation_layer
+    annotator.add_filaments([np.array([[5, 5, 5], [5, 5, 9], [5, 5, 13]], dtype=float),
+                             np.array([[5, 20, 5], [5, 20, 20]], dtype=float)])
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer)
+    assert annotator.nearest_filament([5, 19, 10])[0] == 2
+    assert annotator.nearest_filament(layer.data[3][1])[0] == 3
+    assert annotator.nearest_filament(np.array([[5, 5, 3], [50, 50, 50]]))[0] == 1
+    annotator.delete_the_last_shape(layer)
+    assert annotator.nearest_filament(layer.data[2][0])[0] == 2
+    annotator.select_nearest_filament(layer)
+
+    annotator.add_filaments([layer.data[1] + 0.1])
+    report = annotator.find_duplicates(0.5)
+    assert set(report['filament']) == {0, 2}
+
+
+def test_find_duplicates(annotator_widget_with_image):
+    annotator_widget_with_image.find_duplicates()
+    annotator_widget_with_image.add_annotation_layer()
+    filament = np.array([[5, 5, 5], [5, 5, 9], [5, 5, 13]], dtype=float)
+    annotator_widget_with_image.annotator.add_filaments([filament, filament[::-1], filament + 20])
+    annotator_widget_with_image.find_duplicates(tolerance_um=0.5)
+    colors = annotator_widget_with_image.annotation_layer.edge_color
+    assert (colors[1] == colors[2]).all() and (colors[1] != colors[3]).any()
+
+
+def test_profile(annotator_widget_with_image, polygons, tmp_path):
+    annotator_widget_with_image.add_annotation_layer()
+    annotator_widget_with_image.magic_profile_param.profile.value = True
+    annotator = annotator_widget_with_image.annotator
+    assert annotator.profiler.enabled
+    annotator.gradient_ready = True
+    layer = annotator.annotation_layer
+    for polygon in polygons:
+        annotator.near_points = polygon[0].copy()
+        annotator.far_points = polygon[1].copy()
+        annotator.draw_polygon(layer)
+        annotator.calculate_intersection(layer)
+    assert 'snap_to_bright' in layer.status and 'tetragon_pairs' in layer.status
+    annotator_widget_with_image.get_annotation_filename(os.path.join(tmp_path, 'profiled.csv'))
+    with open(os.path.join(tmp_path, 'profiled_profile.json')) as f:
+        report = json.load(f)
+    assert report['stages']['polygon_intersection']['count'] == 1
+    assert report['counts']['iterations'] == annotator.params.n_iter
+    assert report['gradient_cache_bytes'] > 0 and report['n_filaments'] == 1
+
+
+def test_recover_from_journal(annotator_widget_with_image, paths, tmp_path, monkeypatch):
+    widget = annotator_widget_with_image
+    layer = SimpleNamespace(source=SimpleNamespace(path=os.path.join(tmp_path, 'recover.tif')))
+    fn = os.path.join(tmp_path, 'recover.journal')
+    asked = []
+    monkeypatch.setattr(widget, '_confirm_recovery', lambda n: asked.append(n) or QMessageBox.Yes)
+    monkeypatch.setattr(widget, '_confirm_discard_journal', lambda error: QMessageBox.Yes)
+
+    # unsaved changes are recovered
+    journal = Journal(fn)
+    journal.add(0, paths[0])
+    journal.close()
+    assert widget._recover_from_journal(layer)[1] == [paths[0].tolist()] and asked == [1]
+
+    # no recovery is offered after the annotations are saved, and the journal is cleared
+    journal = Journal(fn)
+    journal.restart(os.path.join(tmp_path, 'recover.csv'))
+    journal.close()
+    assert widget._recover_from_journal(layer) == (fn, []) and asked == [1]
+    assert not os.path.exists(fn)
+
+    # a journal that cannot be replayed (the saved annotations were moved) can be discarded
+    journal = Journal(fn)
+    journal.restart(os.path.join(tmp_path, 'moved.csv'))
+    journal.delete(0)
+    journal.close()
+    assert widget._recover_from_journal(layer) == (fn, [])
+    assert not os.path.exists(fn)
+
+    # a new annotation layer of the same image takes over the journal
+    widget.add_annotation_layer()
+    widget.annotator.journal = Journal(fn)
+    previous = widget.annotator
+    widget._recover_from_journal(layer)
+    assert previous.journal is None
+
+
 def test_params(annotator, tmp_path):
     # test that all parameters are set
-    params = ['scale', 'sigma', 'line_width', 'alpha',
-              'beta', 'gamma', 'n_iter', 'n_interp', 'end_coef']
+    params = ['scale', 'sigma', 'cache_mb', 'grad_dtype', 'grad_memmap', 'disk_cache_gb', 'cache_dir', 'profile',
+              'line_width', 'trim_length', 'alpha', 'beta', 'gamma', 'n_iter', 'n_interp', 'end_coef', 'evolution',
+              'n_levels', 'level_iter', 'preview_every', 'backend', 'tol', 'schedule']
     for param in params:
         assert param in vars(annotator.params)
     assert len(annotator.params.scale) == len(annotator.params.sigma) == 3
@@ -105,9 +434,61 @@ def test_add_annotation_layer(annotator_widget):
     assert annotator_widget.annotation_layer_exists()
 
 
-def test_maxval(annotator_widget_with_image):
-    annotator_widget_with_image.sld.setValue(50)
-    assert annotator_widget_with_image.get_image_layer().data.max() == 50
+def test_maxval(annotator_widget_with_image, qtbot):
+    widget = annotator_widget_with_image
+    image = widget.get_image_layer().data.copy()
+    widget.sld.setValue(50)
+    qtbot.waitUntil(lambda: widget.get_image_layer().data.max() == 50)
+    assert (widget.image == image).all()  # the original image is not modified
+
+    widget.add_annotation_layer()
+    assert widget.annotator.grad.maxval == 50
+    assert widget.annotator.grad.img is widget.image
+    widget.sld.setValue(widget.sld.maximum())
+    widget.set_maxval()
+    assert widget.annotator.grad.maxval is None
+    assert (widget.get_image_layer().data == image).all()
+
+
+def test_intensity_stats(make_napari_viewer):
+    image = np.random.randint(0, 1000, (5, 20, 30)).astype(np.uint16)
+    viewer = make_napari_viewer()
+    viewer.add_image(image)
+    widget = AnnotatorWidget(viewer)
+    assert (widget._cumhist == np.cumsum(np.bincount(image.ravel()))).all()
+    assert widget.sld.maximum() == image.max()
+    assert widget._masked is None  # nothing is masked yet
+    assert widget.get_image_layer().data is image
+
+
+def test_mask_float_image(make_napari_viewer):
+    image = np.random.rand(5, 20, 30) * 100
+    viewer = make_napari_viewer()
+    viewer.add_image(image)
+    widget = AnnotatorWidget(viewer)
+    assert widget._cumhist is None
+    for maxval in [80, 30]:
+        widget.sld.setValue(maxval)
+        widget.set_maxval()
+        data = widget.get_image_layer().data
+        assert data.max() <= maxval
+        assert (data == np.where(image > maxval, 0, image)).all()
+    widget.sld.setValue(widget.sld.maximum())
+    widget.set_maxval()
+    assert widget.get_image_layer().data is image
+
+
+def test_mask_large_intensities(make_napari_viewer):
+    image = np.random.randint(0, 1000, (5, 20, 30)).astype(np.uint32)
+    image[0, 0, 0] = 2 ** 31
+    viewer = make_napari_viewer()
+    viewer.add_image(image)
+    widget = AnnotatorWidget(viewer)
+    assert widget._cumhist is None  # no histogram of 2 ** 31 bins
+    assert widget.get_image_layer().data is image
+    widget.sld.setValue(500)
+    widget.set_maxval()
+    assert (widget.get_image_layer().data == np.where(image > 500, 0, image)).all()
 
 
 def test_io(annotator_widget_with_image, tmp_path, paths):
@@ -122,6 +503,21 @@ def test_io(annotator_widget_with_image, tmp_path, paths):
     df2 = pd.read_csv(fn)
     assert (df[COLS].values == df2[COLS].values).all()
 
+    fn = os.path.join(tmp_path, 'annotations.npz')
+    annotator_widget_with_image.get_annotation_filename(fn)
+    data, labels, params = read_annotations(fn, return_params=True)
+    assert len(data) == len(labels) == len(paths)
+    assert params == annotator_widget_with_image.params.to_dict()
+    annotator_widget_with_image.load_annotations(fn)
+    assert len(annotator_widget_with_image.annotation_layer.data) - 1 == 2 * len(paths)
+
+    # per-filament metadata is shown as the properties of the loaded filaments
+    fn = os.path.join(tmp_path, 'metadata.npz')
+    write_annotations(fn, paths, metadata=pd.DataFrame(dict(iterations=np.arange(len(paths)))))
+    annotator_widget_with_image.load_annotations(fn)
+    layer = annotator_widget_with_image.viewer.layers[-1]
+    assert (layer.properties['iterations'] == np.arange(len(paths))).all()
+
 
 def test_param_io(annotator_widget, tmp_path):
     fn = os.path.join(tmp_path, 'params.json')
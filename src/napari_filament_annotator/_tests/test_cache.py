@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+from napari_filament_annotator.utils.cache import GradientCache, gradient_key
+from napari_filament_annotator.utils.postproc import gradient
+from napari_filament_annotator.utils.tiled import TiledGradient
+from scipy import ndimage
+
+
+def test_gradient_key():
+    img = np.random.randint(0, 100, (10, 20, 20))
+    key = gradient_key(img, 1, [1, 1, 1], np.float32, (8, 16, 16))
+    assert key == gradient_key(img.copy(), 1, [1, 1, 1], np.float32, (8, 16, 16))
+    assert key != gradient_key(img, 2, [1, 1, 1], np.float32, (8, 16, 16))
+    assert key != gradient_key(img, 1, [2, 1, 1], np.float32, (8, 16, 16))
+    img[0, 0, 0] += 1
+    assert key != gradient_key(img, 1, [1, 1, 1], np.float32, (8, 16, 16))
+
+
+def test_gradient_key_lazy():
+    da = pytest.importorskip('dask.array')
+    img = np.random.randint(0, 100, (10, 20, 20))
+    lazy = da.from_array(img, chunks=(5, 10, 10))
+    key = gradient_key(lazy, 1, [1, 1, 1], np.float32, (8, 16, 16))
+    assert key == gradient_key(da.from_array(img, chunks=(5, 10, 10)), 1, [1, 1, 1], np.float32, (8, 16, 16))
+    assert key != gradient_key(lazy + 1, 1, [1, 1, 1], np.float32, (8, 16, 16))
+
+
+def test_reopen(tmp_path):
+    img = np.random.randint(0, 100, (10, 20, 20))
+    cache = GradientCache(os.path.join(tmp_path, 'cache_reopen'))
+    key = gradient_key(img, 1, [1, 1, 1], np.float32, (8, 16, 16))
+
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16))
+    tiled.region((0, 0, 0), (5, 10, 10))
+    tiled.set_store(*cache.open(key, img.shape, np.float32, tiled.ntiles))
+    assert tiled.computed.sum() == 1  # the tile computed before opening the cache
+    for _ in tiled.precompute():
+        pass
+    del tiled
+
+    # tiles are read from the cache in a new session
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16))
+    tiled.set_store(*cache.open(key, img.shape, np.float32, tiled.ntiles))
+    assert tiled.computed.all()
+    tiled._compute_tile = None
+    grad = gradient(ndimage.gaussian_filter(img.astype(np.float32), 1))
+    assert np.allclose(tiled.region((0, 0, 0), img.shape), grad, atol=1e-5)
+
+
+def test_eviction(tmp_path):
+    shape = (10, 20, 20)
+    grad_bytes = 3 * np.prod(shape) * 4
+    cache = GradientCache(os.path.join(tmp_path, 'cache_eviction'), max_bytes=2.5 * grad_bytes)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.open(key, shape, np.float32, (2, 2, 2))
+        os.utime(os.path.join(cache.directory, key), (i, i))
+    keys = [key for key, _ in cache.entries()]
+    assert keys == ['b', 'c']
+
+
+def test_too_large(tmp_path):
+    shape = (10, 20, 20)
+    cache = GradientCache(os.path.join(tmp_path, 'cache_too_large'), max_bytes=10000)
+    cache.open('a', (2, 5, 5), np.float32, (1, 1, 1))
+    assert cache.open('b', shape, np.float32, (2, 2, 2)) is None
+    assert [key for key, _ in cache.entries()] == ['a']  # the cache is not emptied either
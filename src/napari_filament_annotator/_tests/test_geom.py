@@ -1,6 +1,7 @@
 import numpy as np
-
-from napari_filament_annotator.utils.geom import tetragon_intersection, compute_polygon_intersection
+import pytest
+from napari_filament_annotator.utils.geom import tetragon_intersection, tetragon_intersections, broad_phase, \
+    compute_polygon_intersection, PolygonBuffer, trim_path
 
 
 def test_tetragon_intersection(tetragons):
@@ -17,3 +18,87 @@ def test_polygon_intersection(polygons):
     assert isinstance(x, np.ndarray)
     assert len(x.shape) == 2
     assert x.shape[1] == 3
+
+
+def test_tetragon_intersections(tetragons):
+    p1, p2 = tetragons
+    inter = tetragon_intersections([p1], [p2])
+    assert inter.shape == (1, 1, 2, 3)
+    ref = tetragon_intersection(p1, p2)
+    assert np.allclose(np.sort(inter[0, 0], axis=0), np.sort(ref, axis=0))
+
+
+def test_no_intersection(tetragons):
+    p1, p2 = tetragons
+    inter = tetragon_intersections([p1], [np.array(p2) + [0, 0, 100]])
+    assert (inter == -1).all()
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'geometry3d'])
+def test_polygon_intersection_backends(polygons, backend):
+    x = compute_polygon_intersection(polygons, backend=backend)
+    x_ref = compute_polygon_intersection(polygons, backend='geometry3d')
+    assert np.allclose(x, x_ref)
+
+
+def test_unknown_backend(polygons):
+    with pytest.raises(ValueError):
+        compute_polygon_intersection(polygons, backend='unknown')
+
+
+def test_broad_phase(polygons):
+    x, stats = compute_polygon_intersection(polygons, return_stats=True)
+    assert np.allclose(x, compute_polygon_intersection(polygons, backend='geometry3d'))
+    assert stats['pairs'] == (len(polygons[0][0]) - 1) * (len(polygons[1][0]) - 1)
+    assert 0 < stats['pruned'] < stats['pairs']
+    assert stats['time_intersect'] > 0 and stats['time_match'] > 0
+
+    # pairs discarded by the broad phase have no intersection
+    t1 = np.array([polygons[0][0][:-1], polygons[0][0][1:], polygons[0][1][1:], polygons[0][1][:-1]]).swapaxes(0, 1)
+    t2 = np.array([polygons[1][0][:-1], polygons[1][0][1:], polygons[1][1][1:], polygons[1][1][:-1]]).swapaxes(0, 1)
+    inter = tetragon_intersections(t1, t2)
+    candidates = np.zeros(inter.shape[:2], dtype=bool)
+    candidates[broad_phase(t1, t2)] = True
+    assert (inter[~candidates] == -1).all()
+
+
+def test_broad_phase_sweep():
+    # the same pairs as testing the bounding boxes of all pairs
+    rng = np.random.default_rng(0)
+    for n1, n2 in [(50, 70), (1, 30), (30, 1), (0, 5)]:
+        t1 = rng.uniform(0, 100, (n1, 1, 3)) + rng.uniform(0, 20, (n1, 4, 3))
+        t2 = rng.uniform(0, 100, (n2, 1, 3)) + rng.uniform(0, 20, (n2, 4, 3)) * [1, 1, 5]
+        lo1, hi1 = t1.min(1), t1.max(1)
+        lo2, hi2 = t2.min(1), t2.max(1)
+        expected = np.nonzero(np.all((lo1[:, None] <= hi2[None]) & (lo2[None] <= hi1[:, None]), axis=-1))
+        ind1, ind2 = broad_phase(t1, t2, tol=0)
+        assert (ind1 == expected[0]).all() and (ind2 == expected[1]).all()
+
+
+def test_polygon_buffer(polygons):
+    near, far = np.array(polygons[1][0]), np.array(polygons[1][1])
+    buffer = PolygonBuffer(capacity=2)
+    for n, f in zip(near, far):
+        buffer.append(n, f)
+    assert len(buffer) == len(near)
+    assert (buffer.near == near).all() and (buffer.far == far).all()
+    assert (buffer.polygon == np.concatenate([far[::-1], near])).all()
+    buffer.pop()
+    assert (buffer.polygon == np.concatenate([far[-2::-1], near[:-1]])).all()
+    buffer.set_near(near)
+    buffer.set_far(far)
+    assert (buffer.near == near).all() and (buffer.far == far).all()
+    buffer.clear()
+    assert len(buffer) == len(buffer.polygon) == 0
+
+
+def test_trim_path():
+    path = np.array([[0, 0, 0], [0, 0, 2], [0, 0, 3], [0, 2, 3]], dtype=float)
+    assert (trim_path(path) == path[:-1]).all()
+    assert (trim_path(path, end=0) == path[1:]).all()
+    assert np.allclose(trim_path(path, 1), [[0, 0, 0], [0, 0, 2], [0, 0, 3], [0, 1, 3]])
+    assert np.allclose(trim_path(path, 2), path[:3])
+    assert np.allclose(trim_path(path, 2.5), [[0, 0, 0], [0, 0, 2], [0, 0, 2.5]])
+    assert np.allclose(trim_path(path, 0.5, end=0), [[0, 0, 0.5], [0, 0, 2], [0, 0, 3], [0, 2, 3]])
+    assert np.allclose(trim_path(path, 1, spacing=[1, 0.5, 1]), path[:3])
+    assert len(trim_path(path, 10)) == 1
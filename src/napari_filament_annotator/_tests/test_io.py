@@ -1,6 +1,11 @@
+import os
+
+import numpy as np
 import pandas as pd
-from napari_filament_annotator.utils.const import COL_NAME
-from napari_filament_annotator.utils.io import annotation_to_pandas, pandas_to_annotations
+import pytest
+from napari_filament_annotator.utils.const import COL_NAME, COLS
+from napari_filament_annotator.utils.io import annotation_to_pandas, pandas_to_annotations, write_annotations, \
+    read_annotations
 
 
 def test_conversion(paths):
@@ -13,3 +18,104 @@ def test_conversion(paths):
     assert sum([len(path) for path in paths]) == len(df)
     for i in range(len(paths)):
         assert (paths[i] == paths2[i]).all()
+
+
+def annotation_to_pandas_reference(data, labels=None):
+    # loop implementation, to test that the output is identical
+    df = pd.DataFrame()
+    if len(data) > 0:
+        for i, d in enumerate(data):
+            cur_df = pd.DataFrame(d, columns=COLS)
+            cur_df[COL_NAME] = i if labels is None else labels[i]
+            df = pd.concat([df, cur_df], ignore_index=True)
+    return df
+
+
+def pandas_to_annotations_reference(df):
+    # loop implementation, to test that the output is identical
+    data = []
+    labels = []
+    if len(df) > 0:
+        for s in df[COL_NAME].unique():
+            d = df[df[COL_NAME] == s][COLS].values
+            data.append(d)
+            labels.append(s)
+    return data, labels
+
+
+def random_paths(n, dtype=np.float32, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(rng.random((rng.integers(2, 30), 3)) * 100).astype(dtype) for _ in range(n)]
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('labels', [None, 'int', 'str'])
+def test_identical_csv(dtype, labels):
+    paths = random_paths(50, dtype)
+    if labels == 'int':
+        labels = list(np.random.default_rng(1).permutation(100)[:50])
+    elif labels == 'str':
+        labels = [f'filament{i}' for i in range(50)]
+    csv = annotation_to_pandas(paths, labels).to_csv(index=False)
+    assert csv == annotation_to_pandas_reference(paths, labels).to_csv(index=False)
+    assert annotation_to_pandas([]).to_csv(index=False) == annotation_to_pandas_reference([]).to_csv(index=False)
+
+    # interleaved IDs
+    df = annotation_to_pandas(paths, labels).sample(frac=1, random_state=0)
+    data, ids = pandas_to_annotations(df)
+    data_ref, ids_ref = pandas_to_annotations_reference(df)
+    assert ids == ids_ref
+    assert len(data) == len(data_ref)
+    for d, d_ref in zip(data, data_ref):
+        assert d.dtype == d_ref.dtype
+        assert (d == d_ref).all()
+
+
+@pytest.mark.parametrize('ext', ['.csv', '.npz'])
+def test_read_write(tmp_path, ext):
+    paths = random_paths(20)
+    fn = os.path.join(tmp_path, 'annotations' + ext)
+    write_annotations(fn, paths, labels=list(range(10, 30)), params=dict(n_iter=100))
+    data, labels, params = read_annotations(fn, return_params=True)
+    assert labels == list(range(10, 30))
+    assert params == (dict(n_iter=100) if ext == '.npz' else {})
+    assert len(data) == len(paths)
+    for d, path in zip(data, paths):
+        assert np.allclose(d, path)
+
+    write_annotations(fn, [])
+    assert read_annotations(fn) == ([], [])
+
+
+@pytest.mark.parametrize('ext', ['.csv', '.npz'])
+def test_metadata(tmp_path, ext):
+    paths = random_paths(20)
+    fn = os.path.join(tmp_path, 'metadata' + ext)
+    metadata = pd.DataFrame(dict(n_iter=np.arange(20), evolution=['explicit'] * 10 + ['semi-implicit'] * 10))
+    write_annotations(fn, paths, metadata=metadata)
+    data, labels, loaded = read_annotations(fn, return_metadata=True)
+    assert len(data) == len(loaded) == 20
+    if ext == '.npz':
+        assert (loaded == metadata).all().all()
+    else:
+        assert len(loaded.columns) == 0
+    with pytest.raises(ValueError):
+        write_annotations(fn, paths, metadata=metadata[:5])
+
+
+def test_npz_memmap(tmp_path):
+    fn = os.path.join(tmp_path, 'annotations.npz')
+    write_annotations(fn, random_paths(5))
+    data, labels = read_annotations(fn)
+    assert all([isinstance(d.base.base, np.memmap) for d in data])  # views of the memory-mapped file
+    assert all([d.dtype == np.float32 for d in data])
+    assert labels == list(range(5))
+    assert all([(d == path).all() for d, path in zip(data, random_paths(5))])
+    with np.load(fn) as f:
+        assert (np.concatenate(data) == f['vertices']).all()
+        assert (f['offsets'] == np.cumsum([0] + [len(d) for d in data])).all()
+
+
+def test_unknown_extension(tmp_path):
+    with pytest.raises(ValueError):
+        write_annotations(os.path.join(tmp_path, 'annotations.txt'), random_paths(5))
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+from napari_filament_annotator.utils.io import write_annotations, read_annotations
+from napari_filament_annotator.utils.journal import Journal, replay, compact, unsaved_changes
+
+
+def test_replay(paths, tmp_path):
+    fn = os.path.join(tmp_path, 'replay.journal')
+    journal = Journal(fn)
+    for i, p in enumerate(paths):
+        journal.add(i, p)
+    journal.edit(1, paths[0])
+    journal.delete(0)
+    journal.add(0, paths[2])
+    journal.close()
+    data = replay(fn)
+    assert len(data) == len(paths)
+    for d, p in zip(data, [paths[2], paths[0]] + list(paths[2:])):
+        assert np.allclose(d, p)
+
+    # an incomplete last record is ignored
+    with open(fn, 'a') as f:
+        f.write('{"op": "delete", "ind')
+    assert len(replay(fn)) == len(paths)
+
+
+def test_restart(paths, tmp_path):
+    fn = os.path.join(tmp_path, 'restart.journal')
+    saved = os.path.join(tmp_path, 'saved.csv')
+    write_annotations(saved, paths)
+    journal = Journal(fn)
+    journal.add(0, paths[0])
+    journal.restart(saved)
+    journal.delete(0)
+    journal.close()
+    data = replay(fn)
+    assert len(data) == len(paths) - 1
+    for d, p in zip(data, paths[1:]):
+        assert np.allclose(d, p)
+
+
+def test_unsaved_changes(paths, tmp_path):
+    fn = os.path.join(tmp_path, 'unsaved.journal')
+    journal = Journal(fn)
+    journal.add(0, paths[0])
+    journal.edit(0, paths[1])
+    assert unsaved_changes(fn) == 2
+    journal.restart(os.path.join(tmp_path, 'saved.csv'))
+    assert unsaved_changes(fn) == 0
+    journal.delete(0)
+    journal.close()
+    assert unsaved_changes(fn) == 1
+
+
+def test_compact(paths, tmp_path):
+    fn = os.path.join(tmp_path, 'compact.journal')
+    journal = Journal(fn, fsync=True)
+    for i, p in enumerate(paths):
+        journal.add(i, p)
+        journal.edit(i, p[::-1])
+    journal.close()
+    output_file = os.path.join(tmp_path, 'compact.npz')
+    data = compact(fn, output_file, params=dict(line_width=2))
+    loaded, _, params = read_annotations(output_file, return_params=True)
+    assert params['line_width'] == 2
+    assert len(data) == len(loaded) == len(paths)
+    for d, p in zip(loaded, paths):
+        assert np.allclose(d, p[::-1])
+    with open(fn) as f:
+        assert len(f.readlines()) == 1  # the journal restarts from the compacted file
+    assert len(replay(fn)) == len(paths)
@@ -1,6 +1,11 @@
+import os
+
 import numpy as np
 import pytest
-from napari_filament_annotator.utils.postproc import snap_to_bright, gradient
+from napari_filament_annotator.utils.postproc import snap_to_bright, snap_many, gradient, allocate_gradient, \
+    _evolve_snake, _interpolate, gradient_pyramid, snap_to_bright_steps, BACKENDS, get_backend
+from scipy import ndimage
+from scipy.spatial.distance import cdist
 
 
 @pytest.fixture
@@ -16,6 +21,43 @@ def init_snake(img_snake):
     return snake, init
 
 
+def test_gradient(img_snake, tmp_path):
+    img, _ = img_snake
+    grad = gradient(img, spacing=[0.5, 0.1, 0.1])
+    assert grad.shape == (3,) + img.shape
+    assert grad.dtype == np.float32
+    assert grad.flags.c_contiguous
+    assert gradient(img, dtype=np.float16).dtype == np.float16
+    out = allocate_gradient(img.shape, filename=os.path.join(tmp_path, 'gradient.npy'))
+    assert gradient(img, spacing=[0.5, 0.1, 0.1], out=out) is out
+    assert np.allclose(np.load(os.path.join(tmp_path, 'gradient.npy')), grad)
+
+
+@pytest.mark.parametrize('sigma', [None, 1, [0.5, 2, 2]])
+def test_lazy_gradient(img_snake, sigma):
+    da = pytest.importorskip('dask.array')
+    img, _ = img_snake
+    spacing = [0.5, 0.1, 0.1]
+    smoothed = img.astype(np.float32) if sigma is None else ndimage.gaussian_filter(img.astype(np.float32), sigma)
+    grad = gradient(smoothed, spacing)
+    lazy = gradient(da.from_array(img, chunks=(4, 16, 16)), spacing, sigma=sigma)
+    assert isinstance(lazy, da.Array)
+    assert lazy.shape == grad.shape
+    assert np.allclose(lazy.compute(), grad, atol=1e-5)
+    assert np.allclose(lazy[:, 3:9, 10:30, 5:20].compute(), grad[:, 3:9, 10:30, 5:20], atol=1e-5)
+    out = allocate_gradient(img.shape)
+    assert gradient(da.from_array(img, chunks=(4, 16, 16)), spacing, out=out, sigma=sigma) is out
+    assert np.allclose(out, grad, atol=1e-5)
+
+
+def test_snapping_lazy(init_snake, grad):
+    da = pytest.importorskip('dask.array')
+    _, init = init_snake
+    params = dict(n_iter=100, end_coef=0, n_interp=3, margin=100)
+    assert (snap_to_bright(init, grad=da.from_array(grad, chunks=(3, 4, 16, 16)), **params) ==
+            snap_to_bright(init, grad=grad, **params)).all()
+
+
 def test_snapping(img_snake, init_snake, grad):
     img, _ = img_snake
     snake, init = init_snake
@@ -40,3 +82,169 @@ def test_snapping_interp(init_snake, grad):
     assert len(snake2) == (len(snake) - 1) * 5 + 1
     assert (snake[0] == snake2[0]).all()
     assert (snake[-1] == snake2[-1]).all()
+
+
+def test_snapping_semi_implicit(init_snake, grad):
+    snake, init = init_snake
+    snake2 = snap_to_bright(init, grad=grad, alpha=0.01, beta=0.1, gamma=1,
+                            n_iter=30, end_coef=0, n_interp=0, evolution='semi-implicit')
+    assert len(snake) == len(snake2)
+    assert (snake[0] == snake2[0]).all()
+    assert (snake[-1] == snake2[-1]).all()
+    dist = np.mean(np.sqrt(np.sum((snake - snake2) ** 2, axis=1)))
+    assert dist < 3
+
+    with pytest.raises(ValueError):
+        snap_to_bright(init, grad=grad, evolution='unknown')
+
+
+def test_gradient_pyramid(grad):
+    pyramid, scales = gradient_pyramid(grad, 3)
+    assert pyramid[0] is grad
+    assert pyramid[1].shape == (3, 10, 25, 25)  # the z axis is too small to be downsampled
+    assert pyramid[2].shape == (3, 10, 13, 13)
+    assert (scales[2] == [1, 4, 4]).all()
+    assert pyramid[2].dtype == grad.dtype
+    assert np.allclose(pyramid[1][:, 0, 0, 0], grad[:, 0, :2, :2].mean(axis=(1, 2)))
+
+
+@pytest.mark.parametrize('level_iter', [50, [30, 50]])
+def test_snapping_multiscale(img_snake, init_snake, grad, level_iter):
+    snake, init = init_snake
+    snake2 = snap_to_bright(init, grad=grad, n_iter=50, end_coef=0, n_interp=0, n_levels=3, level_iter=level_iter)
+    assert len(snake) == len(snake2)
+    assert (snake[0] == snake2[0]).all()
+    assert (snake[-1] == snake2[-1]).all()
+    # the points can move along the filament: measure the distance to the filament
+    dist = cdist(snake2, _interpolate(snake.astype(float), 10)).min(1).mean()
+    assert dist < 1
+    refined = snap_many([init, snake[5:]], grad=grad, n_iter=50, end_coef=0, n_interp=0, n_levels=3)
+    assert (refined[0] == snap_to_bright(init, grad=grad, n_iter=50, end_coef=0, n_interp=0, n_levels=3)).all()
+
+
+@pytest.mark.parametrize('evolution', ['explicit', 'semi-implicit'])
+@pytest.mark.parametrize('n_levels', [1, 3])
+def test_snapping_steps(init_snake, grad, evolution, n_levels):
+    _, init = init_snake
+    params = dict(grad=grad, n_iter=100, end_coef=0, n_interp=3, evolution=evolution, n_levels=n_levels,
+                  level_iter=30)
+    steps = snap_to_bright_steps(init, every=20, **params)
+    states = []
+    while True:
+        try:
+            states.append(next(steps))
+        except StopIteration as stop:
+            final = stop.value
+            break
+    assert len(states) == 4 + (n_levels - 1)  # after 20, 40, 60 and 80 iterations, and 20 on each coarse level
+    assert all([len(state) == len(final) for state in states])
+    assert (final == snap_to_bright(init, **params)).all()
+    assert not (states[-1] == final).all()
+
+
+@pytest.mark.parametrize('evolution', ['explicit', 'semi-implicit'])
+def test_snap_many(init_snake, grad, evolution):
+    snake, init = init_snake
+    snakes = [init.astype(float), snake[5:].astype(float), init[::-1][:20].astype(float)]
+    params = dict(spacing=[0.5, 0.1, 0.1], n_iter=100, end_coef=0.1, n_interp=3, evolution=evolution)
+    refined = snap_many(snakes, grad=grad, **params)
+    assert len(refined) == len(snakes)
+    for s, r in zip(snakes, refined):
+        assert (snap_to_bright(s, grad=grad, **params) == r).all()
+    assert snap_many([], grad=grad) == []
+
+
+@pytest.mark.parametrize('backend', list(BACKENDS))
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('gamma', [1, 0.7])
+def test_backends(img_snake, init_snake, backend, dtype, gamma):
+    snake, init = init_snake
+    grad = gradient(img_snake[0], dtype=dtype)
+    params = dict(grad=grad, spacing=[0.5, 0.1, 0.1], gamma=gamma, n_iter=100, end_coef=0.1, n_interp=3)
+    snakes = [init.astype(float), snake[5:].astype(float), init[::-1][:20].astype(float)]
+    for r, expected in zip(snap_many(snakes, backend=backend, **params), snap_many(snakes, **params)):
+        assert (r == expected).all()
+    states = list(snap_to_bright_steps(init, every=30, backend=backend, **params))
+    expected = list(snap_to_bright_steps(init, every=30, **params))
+    assert len(states) == len(expected) == 3
+    assert all([(s == e).all() for s, e in zip(states, expected)])
+    assert (snap_to_bright(init, n_levels=2, backend=backend, **params) ==
+            snap_to_bright(init, n_levels=2, **params)).all()
+    params.update(tol=0.01, schedule='adaptive', return_iterations=True)
+    refined, iterations = snap_many(snakes, backend=backend, **params)
+    expected, expected_iterations = snap_many(snakes, **params)
+    assert (iterations == expected_iterations).all()
+    assert all([(r == e).all() for r, e in zip(refined, expected)])
+
+
+def test_numba_backend():
+    pytest.importorskip('numba')
+    assert 'numba' in BACKENDS
+
+
+def test_unknown_backend(init_snake, grad):
+    _, init = init_snake
+    with pytest.raises(ValueError):
+        get_backend('cuda')
+    with pytest.raises(ValueError):
+        snap_to_bright(init, grad=grad, backend='cuda')
+
+
+@pytest.mark.parametrize('evolution', ['explicit', 'semi-implicit'])
+def test_early_stopping(init_snake, grad, evolution):
+    snake, init = init_snake
+    params = dict(grad=grad, n_iter=1000, end_coef=0, n_interp=0, evolution=evolution, return_iterations=True)
+    _, iterations = snap_to_bright(init, **params)
+    assert iterations == 1000
+    refined, iterations = snap_to_bright(init, tol=0.01, schedule='adaptive', **params)
+    assert iterations < 200
+    assert np.mean(np.sqrt(np.sum((snake - refined) ** 2, axis=1))) < 3
+    _, iterations_linear = snap_to_bright(init, tol=0.01, **params)
+    assert iterations < iterations_linear <= 1000
+    _, iterations = snap_to_bright(init, tol=0.01, schedule='adaptive', n_levels=2, level_iter=50, **params)
+    assert iterations < 1050
+
+    # each snake stops separately, with the same result as on its own
+    snakes = [init.astype(float), snake[5:].astype(float), init[::-1][:20].astype(float)]
+    params.update(tol=0.01, schedule='adaptive')
+    refined, iterations = snap_many(snakes, **params)
+    for s, r, it in zip(snakes, refined, iterations):
+        expected, expected_iterations = snap_to_bright(s, **params)
+        assert (r == expected).all() and it == expected_iterations
+    with pytest.raises(ValueError):
+        snap_to_bright(init, grad=grad, schedule='exponential')
+
+
+def evolve_snake_reference(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef):
+    # reference implementation of the active contour iterations, with a new array for every operation
+    def derivatives(x):
+        x = np.concatenate([x[1:3][::-1], x, x[-3:-1][::-1]])
+        d2 = np.roll(x, 1, 0) + np.roll(x, -1, 0) - 2 * x
+        d4 = np.roll(x, 2, 0) - 4 * np.roll(x, 1, 0) + 6 * x - 4 * np.roll(x, -1, 0) + np.roll(x, -2, 0)
+        return d2[2:-2], d4[2:-2]
+
+    coef = np.ones_like(snake)
+    coef[0] = end_coef
+    coef[-1] = end_coef
+    c = np.arange(1, n_iter + 1)[::-1] / n_iter
+    for it in range(n_iter):
+        coord = tuple(np.int_(np.round(snake)).transpose())
+        fimg = np.array([grad[i][coord] for i in range(len(grad))])
+        fimg = - fimg.transpose()
+        fimg = fimg / fimg.max()
+        d2, d4 = derivatives(snake * spacing)
+        fsnake = d2 * alpha + d4 * beta
+        fsnake = fsnake / np.max(fsnake)
+        snake = snake - c[it] * coef * (fimg * gamma + fsnake) / (gamma + 1)
+        shape = np.array(grad[0].shape) - 1
+        snake = np.array([np.max([[0, 0, 0], np.min([shape, snake[i]], axis=0)], axis=0)
+                          for i in range(len(snake))])
+    return snake
+
+
+@pytest.mark.parametrize('end_coef', [0, 0.1])
+def test_evolve_snake_reference(init_snake, grad, end_coef):
+    _, init = init_snake
+    init = _interpolate(init.astype(float), 3)
+    params = (100, grad, np.array([0.5, 0.1, 0.1]), 0.01, 0.1, 1, end_coef)
+    assert (_evolve_snake(init, *params) == evolve_snake_reference(init, *params)).all()
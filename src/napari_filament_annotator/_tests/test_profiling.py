@@ -0,0 +1,59 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from napari_filament_annotator.utils.profiling import Profiler
+
+
+def test_profiler(tmp_path):
+    profiler = Profiler(enabled=True)
+    for i in range(20):
+        with profiler.stage('sleep'):
+            time.sleep(0.001 * (i % 2 + 1))
+        profiler.record('recorded', 0.5)
+        profiler.count('pairs', 3)
+    assert profiler.summary().startswith('sleep: ')
+    assert profiler.summary() == ''
+    report = profiler.report(grad_bytes=10)
+    assert report['stages']['sleep']['count'] == 20
+    assert report['stages']['sleep']['p50_ms'] <= report['stages']['sleep']['p95_ms']
+    assert report['stages']['sleep']['p95_ms'] >= 2
+    assert np.isclose(report['stages']['recorded']['total_ms'], 10000)
+    assert report['counts'] == dict(pairs=60)
+    assert report['grad_bytes'] == 10
+
+    fn = os.path.join(tmp_path, 'profile.json')
+    profiler.save(fn)
+    with open(fn) as f:
+        assert json.load(f)['counts'] == dict(pairs=60)
+
+
+def test_disabled():
+    profiler = Profiler()
+    with profiler.stage('stage'):
+        pass
+    profiler.count('pairs')
+    assert profiler.report() == dict(stages={}, counts={})
+    assert profiler.summary() == ''
+
+
+def test_threads():
+    profiler = Profiler(enabled=True)
+
+    def work():
+        for _ in range(10000):
+            profiler.record('stage', 0.001)
+            profiler.count('pairs')
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(100):
+        profiler.summary()
+    for thread in threads:
+        thread.join()
+    report = profiler.report()
+    assert report['stages']['stage']['count'] == 40000
+    assert report['counts'] == dict(pairs=40000)
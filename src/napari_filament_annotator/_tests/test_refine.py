@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from napari_filament_annotator._params import Params
+from napari_filament_annotator._refine import main, find_files
+from napari_filament_annotator.utils.const import COLS, COL_NAME
+from napari_filament_annotator.utils.io import annotation_to_pandas, read_annotations, write_annotations
+from skimage import io
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path, img_snake):
+    img, snake = img_snake
+    image_dir = os.path.join(tmp_path, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    for name in ['img1', 'img2']:
+        io.imsave(os.path.join(image_dir, name + '.tif'), np.uint8(img / img.max() * 255), check_contrast=False)
+        annotation_to_pandas([snake, snake[10:]], labels=[3, 7]).to_csv(os.path.join(image_dir, name + '.csv'),
+                                                                        index=False)
+    io.imsave(os.path.join(image_dir, 'img3.tif'), np.uint8(img), check_contrast=False)
+
+    params = Params()
+    params.set_scale([0.3, 0.1, 0.1])
+    params.set_smoothing(0.1)
+    params.set_cache()
+    params.set_profile()
+    params.set_linewidth(0.5)
+    params.set_coef()
+    params.set_ac_parameters(n_iter=50, n_interp=3)
+    params_file = os.path.join(tmp_path, 'params', 'params.json')
+    params.save(params_file)
+    return image_dir, params_file
+
+
+def test_find_files(dataset):
+    image_dir, _ = dataset
+    pairs, missing = find_files(image_dir)
+    assert len(pairs) == 2
+    assert len(missing) == 1
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_refine(dataset, tmp_path, workers):
+    image_dir, params_file = dataset
+    output_dir = os.path.join(tmp_path, rf'refined_{workers}')
+    main([image_dir, params_file, output_dir, '--workers', str(workers)])
+    for name in ['img1', 'img2']:
+        df = pd.read_csv(os.path.join(image_dir, name + '.csv'))
+        df2 = pd.read_csv(os.path.join(output_dir, name + '.csv'))
+        assert len(df) == len(df2)
+        assert (df[COL_NAME].values == df2[COL_NAME].values).all()
+        assert not np.allclose(df[COLS].values, df2[COLS].values)
+    assert not os.path.exists(os.path.join(output_dir, 'img3.csv'))
+
+
+def test_refine_npz(dataset, tmp_path):
+    image_dir, params_file = dataset
+    annotation_dir = os.path.join(tmp_path, 'npz_annotations')
+    os.makedirs(annotation_dir, exist_ok=True)
+    data, labels = read_annotations(os.path.join(image_dir, 'img1.csv'))
+    write_annotations(os.path.join(annotation_dir, 'img1.npz'), data, labels)
+    output_dir = os.path.join(tmp_path, 'refined_npz')
+    main([image_dir, params_file, output_dir, '--annotations', annotation_dir])
+    refined, refined_labels, metadata = read_annotations(os.path.join(output_dir, 'img1.npz'), return_metadata=True)
+    assert refined_labels == labels
+    assert len(metadata) == len(refined)
+    assert (metadata['n_iter'] == 50).all() and (metadata['iterations'] == 50).all()
+
+
+def test_refine_n_interp(dataset, tmp_path):
+    image_dir, params_file = dataset
+    output_dir = os.path.join(tmp_path, 'refined_interp')
+    main([image_dir, params_file, output_dir, '--n-interp', '2'])
+    df = pd.read_csv(os.path.join(image_dir, 'img1.csv'))
+    df2 = pd.read_csv(os.path.join(output_dir, 'img1.csv'))
+    assert len(df2) > len(df)
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from napari_filament_annotator.utils.spatial import FilamentIndex, _densify
+from scipy.spatial.distance import cdist
+
+
+@pytest.fixture
+def filaments():
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(0, 100, (200, 3))
+    directions = rng.normal(size=(200, 3))
+    directions = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    return [s + np.arange(10)[:, np.newaxis] * d for s, d in zip(starts, directions)]
+
+
+def nearest_reference(filaments, point, spacing):
+    dist = [np.min(cdist([point * spacing], f * spacing)) for f in filaments.values()]
+    return list(filaments.keys())[np.argmin(dist)], np.min(dist)
+
+
+def test_densify():
+    points = np.array([[0, 0, 0], [0, 0, 2.5], [0, 3, 2.5]], dtype=float)
+    dense = _densify(points, 1)
+    assert len(dense) == 3 + 3 + 1
+    assert (dense[0] == points[0]).all() and (dense[-1] == points[-1]).all()
+    assert np.max(np.linalg.norm(np.diff(dense, axis=0), axis=1)) <= 1
+
+
+@pytest.mark.parametrize('rebuild_fraction', [0, 0.1, 10])
+def test_nearest(filaments, rebuild_fraction):
+    spacing = np.array([0.5, 0.1, 0.1])
+    index = FilamentIndex(spacing=spacing, rebuild_fraction=rebuild_fraction)
+    reference = {}
+    index.add_many(range(100), filaments[:100])
+    reference.update(zip(range(100), filaments[:100]))
+    for i in range(100, 200):
+        index.add(i, filaments[i])
+        reference[i] = filaments[i]
+    for i in range(0, 200, 3):
+        index.remove(i)
+        reference.pop(i)
+    for i in range(1, 200, 7):
+        index.add(i, filaments[i][::-1] + 5)
+        reference[i] = filaments[i][::-1] + 5
+    assert len(index) == len(reference)
+
+    points = np.random.uniform(0, 100, (50, 3))
+    keys, dist = index.nearest(points)
+    for point, key, d in zip(points, keys, dist):
+        ref_key, ref_dist = nearest_reference(reference, point, spacing)
+        assert key == ref_key
+        assert np.isclose(d, ref_dist)
+    assert index.nearest(points[0])[0] == keys[0]
+
+    index.clear()
+    assert index.nearest(points[0]) == (-1, np.inf)
+
+
+def test_duplicates(filaments):
+    index = FilamentIndex(step=0.5)
+    index.add_many(range(len(filaments)), filaments)
+    index.add(200, filaments[10] + 0.1)  # duplicate
+    index.add(201, filaments[20][:5] - 0.1)  # overlaps the first half of filament 20
+    index.add(202, filaments[30] + 5)
+    report = index.duplicates(0.5, min_overlap=0.8)
+    pairs = set(zip(report['filament'], report['other']))
+    assert {(10, 200), (200, 10), (201, 20)}.issubset(pairs)
+    assert (20, 201) not in pairs
+    assert (report['overlap'] >= 0.8).all()
+    assert len(FilamentIndex().duplicates(1)) == 0
+
+
+def test_duplicates_dense():
+    # many vertices of the same filament within the tolerance
+    filament = np.array([[5, 5, 5], [5, 5, 15], [5, 15, 25]], dtype=float)
+    index = FilamentIndex(spacing=[0.1, 0.1, 0.1], step=0.1)
+    index.add(0, filament)
+    index.add(1, filament + [0, 8, 0])
+    index.add(2, filament + [0, 30, 0])
+    report = index.duplicates(1)
+    assert set(zip(report['filament'], report['other'])) == {(0, 1), (1, 0)}
+    assert np.allclose(report['overlap'], 1)
@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pytest
+from napari_filament_annotator.utils.postproc import snap_to_bright, gradient, allocate_gradient
+from napari_filament_annotator.utils.tiled import TiledGradient
+from scipy import ndimage
+
+
+@pytest.fixture
+def img():
+    return np.random.randint(0, 100, (20, 50, 60))
+
+
+@pytest.mark.parametrize('sigma', [0, 1, [0.5, 2, 2]])
+def test_tiles_match_full_image(img, sigma):
+    spacing = [0.5, 0.1, 0.1]
+    grad = np.array(gradient(ndimage.gaussian_filter(img.astype(np.float32), sigma), spacing))
+    tiled = TiledGradient(img, sigma=sigma, spacing=spacing, tile_shape=(8, 16, 32))
+    assert np.allclose(tiled.region((0, 0, 0), img.shape), grad, atol=1e-5)
+    assert np.allclose(tiled.region((3, 10, 7), (17, 41, 55)), grad[:, 3:17, 10:41, 7:55], atol=1e-5)
+
+
+def test_cache_budget(img):
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16), max_bytes=3 * 8 * 16 * 16 * 4 * 2)
+    tiled.region((0, 0, 0), img.shape)
+    assert 2 <= len(tiled._cache) < np.prod(tiled.ntiles)
+    assert tiled.nbytes <= tiled.max_bytes
+
+
+def test_roi(img):
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16))
+    grad, offset = tiled.roi(np.array([[5, 20, 20], [10, 30, 25]]), margin=3)
+    assert (offset == [2, 17, 17]).all()
+    assert grad.shape == (3, 12, 17, 12)
+
+
+def test_snapping_tiled(img_snake):
+    img, snake = img_snake
+    tiled = TiledGradient(img, tile_shape=(4, 16, 16))
+    snake2 = snap_to_bright(snake, grad=gradient(img), n_iter=100, end_coef=0, n_interp=3)
+    snake3 = snap_to_bright(snake, grad=tiled, n_iter=100, end_coef=0, n_interp=3, margin=50)
+    assert np.allclose(snake2, snake3)
+
+
+def test_float16(img):
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16), dtype=np.float16)
+    grad = tiled.region((0, 0, 0), img.shape)
+    assert grad.dtype == np.float16
+    assert tiled.nbytes == grad.nbytes
+    assert np.allclose(grad, gradient(ndimage.gaussian_filter(img.astype(np.float32), 1)), rtol=1e-2, atol=1e-2)
+
+
+def test_store(img, tmp_path):
+    store = allocate_gradient(img.shape, filename=os.path.join(tmp_path, 'gradient.npy'))
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16), max_bytes=3 * 8 * 16 * 16 * 4, store=store)
+    for _ in tiled.precompute():
+        pass
+    assert tiled.computed.all()
+    grad = gradient(ndimage.gaussian_filter(img.astype(np.float32), 1))
+    assert np.allclose(np.load(os.path.join(tmp_path, 'gradient.npy'), mmap_mode='r'), grad, atol=1e-5)
+    # evicted tiles are read back from the store
+    assert np.allclose(tiled.region((0, 0, 0), img.shape), grad, atol=1e-5)
+
+
+def test_store_lazy_image(img, tmp_path):
+    da = pytest.importorskip('dask.array')
+    store = allocate_gradient(img.shape, filename=os.path.join(tmp_path, 'gradient_lazy.npy'))
+    tiled = TiledGradient(da.from_array(img, chunks=(8, 16, 16)), sigma=1, tile_shape=(8, 16, 16),
+                          max_bytes=3 * 8 * 16 * 16 * 4 * 2, store=store)
+    for _ in tiled.precompute():
+        pass
+    assert tiled.computed.sum() == 2  # only the memory budget is precomputed for lazy images
+
+
+def test_lazy_image(img):
+    da = pytest.importorskip('dask.array')
+    lazy = da.from_array(img, chunks=(5, 20, 20))
+    tiled = TiledGradient(lazy, sigma=1, spacing=[0.5, 0.1, 0.1])
+    assert tuple(tiled.tile_shape) == (35, 140, 140)  # multiple of the chunk shape
+    grad = gradient(ndimage.gaussian_filter(img.astype(np.float32), 1), [0.5, 0.1, 0.1])
+    tiled = TiledGradient(lazy, sigma=1, spacing=[0.5, 0.1, 0.1], tile_shape=(5, 20, 20))
+    assert np.allclose(tiled.region((3, 10, 7), (17, 41, 55)), grad[:, 3:17, 10:41, 7:55], atol=1e-5)
+    assert tiled.computed.sum() == 0 and len(tiled._cache) == 4 * 3 * 3
+
+
+def test_maxval(img):
+    tiled = TiledGradient(img, sigma=1, tile_shape=(8, 16, 16))
+    grad = tiled.region((0, 0, 0), img.shape)
+    tiled.maxval = 90
+    masked = tiled.region((0, 0, 0), img.shape)
+    bright = ndimage.maximum_filter(img > 90, size=2 * tiled.halo + 1)
+    assert (masked[:, bright] == 0).all()
+    assert (masked[:, ~bright] == grad[:, ~bright]).all()
+    tiled.maxval = None
+    assert (tiled.region((0, 0, 0), img.shape) == grad).all()
@@ -8,15 +8,21 @@ from pathlib import Path
 
 import napari
 import numpy as np
-import pandas as pd
 from magicgui import magicgui
+from napari.qt.threading import thread_worker
 from napari.utils.notifications import show_info
-from qtpy.QtCore import Qt
-from qtpy.QtWidgets import QVBoxLayout, QHBoxLayout, QPushButton, QWidget, QMessageBox, QLabel, QSlider
+from qtpy.QtCore import Qt, QTimer
+from qtpy.QtWidgets import QVBoxLayout, QHBoxLayout, QPushButton, QWidget, QMessageBox, QLabel, QSlider, \
+    QProgressBar
 
-from ._annotator import Annotator
+from ._annotator import Annotator, _update_shape, _get_shape_data
 from ._params import Params
-from .utils.io import annotation_to_pandas, pandas_to_annotations
+from .utils.io import read_annotations, write_annotations
+from .utils.journal import replay, unsaved_changes
+from .utils.postproc import max_intensity, mask_bright, is_lazy, BACKENDS
+
+# largest intensity of integer images to count the masked pixels with a histogram
+MAX_HIST_INTENSITY = 2 ** 16
 
 TEXT_PROP = {
     'text': 'label',
@@ -36,8 +42,15 @@ class AnnotatorWidget(QWidget):
         super().__init__()
         self.viewer = napari_viewer
         self.annotation_layer = None
+        self.annotator = None
         image_layer = self.get_image_layer()
         self.image = image_layer.data if image_layer is not None else None
+        # intensity statistics of the image and buffers for masking, computed once
+        self._max_intensity = None
+        self._cumhist = None
+        self._masked = None
+        self._mask = None
+        self._nmasked = 0
         path = image_layer.source.path if image_layer is not None else None
         self.datapath = os.path.dirname(path) if path is not None else '.'
         self.filename = path[:-len(path.split('.')[-1]) - 1] + '.csv' if path is not None else 'annotations.csv'
@@ -50,6 +63,8 @@ class AnnotatorWidget(QWidget):
         """Set annotation parameters"""
         self.voxel_params()
         self.sigma_param()
+        self.cache_param()
+        self.profile_param()
         self.display_params()
         self.ac_parameters1()
         self.ac_parameters2()
@@ -79,15 +94,55 @@ class AnnotatorWidget(QWidget):
         """
         self.params.set_smoothing(sigma_um)
 
-    def display_params(self, line_width: float = 0.5):
+    def cache_param(self, cache_mb: float = 1024, grad_dtype: str = 'float32', grad_memmap: bool = False,
+                    disk_cache_gb: float = 10, cache_dir: str = ''):
+        """
+        Specify the memory budget and storage for the gradient.
+
+        Parameters
+        ----------
+        cache_mb : float
+            Memory (in MB) to keep the image gradient for active contour refinement.
+            The gradient is calculated on demand in tiles, and the least recently used tiles are discarded.
+        grad_dtype : str
+            Precision to store the gradient: "float32" or "float16" (half the memory).
+        grad_memmap : bool
+            Keep all computed gradient tiles in a file on disk, to annotate images larger than the memory.
+        disk_cache_gb : float
+            Size limit (in GB) of the gradient cache on disk, which is reused when the same image is opened again.
+            Set to 0 to disable the cache.
+        cache_dir : str
+            Directory of the gradient cache. If empty, the ".gradient_cache" directory next to the image is used.
+        """
+        self.params.set_cache(cache_mb, grad_dtype=grad_dtype, grad_memmap=grad_memmap,
+                              disk_cache_gb=disk_cache_gb, cache_dir=cache_dir)
+
+    def profile_param(self, profile: bool = False):
+        """
+        Specify whether to profile the annotation.
+
+        Parameters
+        ----------
+        profile : bool
+            Time each annotation stage: the latest timings are shown in the status bar,
+            and the session statistics are saved next to the annotations.
+        """
+        self.params.set_profile(profile)
+        if self.annotator is not None:
+            self.annotator.profiler.enabled = profile
+
+    def display_params(self, line_width: float = 0.5, trim_length: float = 0.0):
         """
 
         Parameters
         ----------
         line_width : float
             Width of the annotation lines in the viewer.
+        trim_length : float
+            Length (in the units of the voxel size) to trim from the filament ends with the "f" and "l" keys.
+            Set to 0 to delete one point at a time.
         """
-        self.params.set_linewidth(line_width)
+        self.params.set_linewidth(line_width, trim_length=trim_length)
 
     def ac_parameters1(self, alpha: float = 0.01, beta: float = 0.1, gamma: float = 1):
         """
@@ -103,7 +158,10 @@ class AnnotatorWidget(QWidget):
         """
         self.params.set_coef(alpha=alpha, beta=beta, gamma=gamma)
 
-    def ac_parameters2(self, n_iter: int = 1000, n_interp: int = 3, end_coef: float = 0.0):
+    def ac_parameters2(self, n_iter: int = 1000, n_interp: int = 3, end_coef: float = 0.0,
+                       evolution: str = 'explicit', n_levels: int = 1, level_iter: int = 100,
+                       preview_every: int = 50, backend: str = 'numpy', tol: float = 0.0,
+                       schedule: str = 'linear'):
         """
 
         Parameters
@@ -116,9 +174,28 @@ class AnnotatorWidget(QWidget):
         end_coef : float
             Coefficient (between 0 and 1) to scale the forces applied to the contour end points.
             Set to 0 to fix the end points.
+        evolution : str
+            Active contour evolution mode: "explicit" or "semi-implicit".
+            The semi-implicit mode converges in tens of iterations instead of a thousand.
+        n_levels : int
+            Number of resolution levels; if greater than 1, the contour is first evolved on downsampled gradients.
+        level_iter : int
+            Number of iterations at each downsampled level.
+        preview_every : int
+            Show the filament every this number of iterations while it is refined (0 to disable);
+            press "a" to accept the current state and stop the refinement.
+        backend : str
+            Implementation of the explicit evolution: "numpy" or "numba" (compiled; available if numba is installed).
+        tol : float
+            Stop the refinement when no point moved by this distance (in voxels) in the last iteration
+            (0 to always do all iterations).
+        schedule : str
+            Step size schedule: "linear" (decreasing with each iteration) or
+            "adaptive" (halved each time the contour oscillates; stops soon after the contour settles if `tol` is set).
         """
-        self.params.set_ac_parameters(n_iter=n_iter, n_interp=n_interp,
-                                      end_coef=end_coef)
+        self.params.set_ac_parameters(n_iter=n_iter, n_interp=n_interp, end_coef=end_coef, evolution=evolution,
+                                      n_levels=n_levels, level_iter=level_iter, preview_every=preview_every,
+                                      backend=backend, tol=tol, schedule=schedule)
 
     def load_annotations(self, filename=Path('.')):
         """
@@ -126,21 +203,21 @@ class AnnotatorWidget(QWidget):
         Parameters
         ----------
         filename : Path
-            Filename to load annoations
+            Filename to load annoations (csv or npz)
 
         """
-        df = pd.read_csv(filename)
-        data, labels = pandas_to_annotations(df)
+        data, labels, metadata = read_annotations(filename, return_metadata=True)
+        properties = {name: metadata[name].to_numpy() for name in metadata.columns}  # e.g. refinement parameters
+        properties['label'] = labels
         self.viewer.add_shapes(data, name='existing_annotations',
                                shape_type='path', edge_color='green',
                                edge_width=self.params.line_width,
                                scale=self.viewer.layers[0].scale,
                                blending='additive',
-                               properties={'label': labels}, text=TEXT_PROP)
+                               properties=properties, text=TEXT_PROP)
         if not self.annotation_layer_exists():
             self.add_annotation_layer()
-        self.annotation_layer.add(data, shape_type='path', edge_color='green',
-                                  edge_width=self.params.line_width)
+        self.annotator.add_filaments(data)
 
     def load_parameters(self, filename=Path('.')):
         """
@@ -157,13 +234,58 @@ class AnnotatorWidget(QWidget):
         self.magic_voxel_params.voxel_size_xy.value = params.voxel_size_xy
         self.magic_voxel_params.voxel_size_z.value = params.voxel_size_z
         self.magic_sigma_param.sigma_um.value = params.sigma_um
+        if hasattr(params, 'cache_mb'):
+            self.magic_cache_param.cache_mb.value = params.cache_mb
+        if hasattr(params, 'grad_dtype'):
+            self.magic_cache_param.grad_dtype.value = params.grad_dtype
+            self.magic_cache_param.grad_memmap.value = params.grad_memmap
+        if hasattr(params, 'disk_cache_gb'):
+            self.magic_cache_param.disk_cache_gb.value = params.disk_cache_gb
+            self.magic_cache_param.cache_dir.value = params.cache_dir
+        if hasattr(params, 'profile'):
+            self.magic_profile_param.profile.value = params.profile
         self.magic_display_params.line_width.value = params.line_width
+        if hasattr(params, 'trim_length'):
+            self.magic_display_params.trim_length.value = params.trim_length
         self.magic_ac_parameters1.alpha.value = params.alpha
         self.magic_ac_parameters1.beta.value = params.beta
         self.magic_ac_parameters1.gamma.value = params.gamma
         self.magic_ac_parameters2.n_iter.value = params.n_iter
         self.magic_ac_parameters2.n_interp.value = params.n_interp
         self.magic_ac_parameters2.end_coef.value = params.end_coef
+        if hasattr(params, 'evolution'):
+            self.magic_ac_parameters2.evolution.value = params.evolution
+        if hasattr(params, 'n_levels'):
+            self.magic_ac_parameters2.n_levels.value = params.n_levels
+            self.magic_ac_parameters2.level_iter.value = params.level_iter
+        if hasattr(params, 'preview_every'):
+            self.magic_ac_parameters2.preview_every.value = params.preview_every
+        if getattr(params, 'backend', None) in BACKENDS:
+            self.magic_ac_parameters2.backend.value = params.backend
+        if hasattr(params, 'tol'):
+            self.magic_ac_parameters2.tol.value = params.tol
+            self.magic_ac_parameters2.schedule.value = params.schedule
+
+    def find_duplicates(self, tolerance_um: float = 0.2, min_overlap: float = 0.8):
+        """
+        Highlight the filaments that duplicate other filaments.
+
+        Parameters
+        ----------
+        tolerance_um : float
+            Maximal distance between duplicated filaments, in microns.
+        min_overlap : float
+            Minimal fraction of a filament that lies within the tolerance from another filament.
+        """
+        if not self.annotation_layer_exists():
+            return
+        report = self.annotator.find_duplicates(tolerance_um, min_overlap=min_overlap)
+        for index in np.unique(report['filament']):
+            _update_shape(self.annotation_layer, index + 1, _get_shape_data(self.annotation_layer, index + 1),
+                          edge_color='magenta')
+        print(rf"{report['filament'].nunique()} duplicated filaments")
+        if len(report) > 0:
+            print(report)
 
     def get_param_filename(self, filename=Path('.')):
         """
@@ -186,26 +308,88 @@ class AnnotatorWidget(QWidget):
         Parameters
         ----------
         filename : Path
-            Filename to save annotations
+            Filename to save annotations (csv or npz)
         """
         self.filename = filename
         self.save_annotations()
 
     def save_annotations(self):
+        data = []
         if self.annotation_layer is not None and self.annotation_layer.nshapes > 1:
-            annotation_to_pandas(self.annotation_layer.data[1:]).to_csv(self.filename, index=False)
-        else:
-            pd.DataFrame().to_csv(self.filename, index=False)
+            data = self.annotation_layer.data[1:]
+        write_annotations(self.filename, data, params=self.params.to_dict())
+        if self.annotator is not None and self.annotator.journal is not None:
+            self.annotator.journal.restart(self.filename)  # later changes apply to the saved annotations
+        if self.annotator is not None and self.annotator.profiler.enabled:
+            self.annotator.save_profile(os.path.splitext(self.filename)[0] + '_profile.json')
         print(rf"Saved to: {self.filename}")
 
     def set_maxval(self):
+        """
+        Mask out the image pixels brighter than the slider value.
+
+        The masked image is written to a buffer allocated once; for images with an intensity histogram,
+            only if the number of masked pixels changes.
+        For the active contour, the bright pixels are masked out when the gradient is sampled.
+        """
         maxval = self.sld.value()
         img_layer = self.get_image_layer()
         if img_layer is not None:
             if self.image is None:
                 self.image = img_layer.data
-                self.sld.setMaximum(self.image.max())
-            img_layer.data = np.where(self.image > maxval, 0, self.image)
+            if self._max_intensity is None:
+                self._set_intensity_stats()
+            if is_lazy(self.image):
+                img_layer.data = mask_bright(self.image, maxval)
+            else:
+                self._mask_image(img_layer, maxval)
+            if self.annotator is not None:
+                self.annotator.grad.maxval = self._grad_maxval()
+
+    def _set_intensity_stats(self):
+        # histogram of non-negative integer images with a small intensity range (e.g. 8 and 16 bit),
+        # to count the masked pixels without going through the image;
+        # accumulated plane by plane, as bincount converts its input to intp
+        self._max_intensity = max_intensity(self.image)
+        if not is_lazy(self.image) and np.issubdtype(self.image.dtype, np.integer) and self.image.size > 0 \
+                and self._max_intensity < MAX_HIST_INTENSITY and self.image.min() >= 0:
+            hist = np.zeros(int(self._max_intensity) + 1, dtype=np.int64)
+            for index in np.ndindex(self.image.shape[:-2]):
+                hist += np.bincount(self.image[index].ravel(), minlength=len(hist))
+            self._cumhist = np.cumsum(hist)
+        # the slider range is limited to 32-bit integers
+        self.sld.setMaximum(int(min(self._max_intensity, np.iinfo(np.int32).max)))
+
+    def _mask_image(self, img_layer, maxval):
+        nmasked = None
+        if self._cumhist is not None:
+            nmasked = self._cumhist[-1] - self._cumhist[int(np.clip(maxval, 0, len(self._cumhist) - 1))]
+        elif maxval >= self.sld.maximum():  # the slider at its maximum shows the whole image
+            nmasked = 0
+        if nmasked == 0:  # show the original image; the buffers are only allocated once pixels are masked
+            self._nmasked = nmasked
+            if img_layer.data is not self.image:
+                img_layer.data = self.image
+            return
+        if self._cumhist is not None and nmasked == self._nmasked:  # the same pixels are masked
+            return
+        if self._masked is None:
+            self._masked = np.empty_like(self.image)
+            self._mask = np.empty(self.image.shape, dtype=bool)
+        np.greater(self.image, maxval, out=self._mask)
+        np.copyto(self._masked, self.image)
+        np.copyto(self._masked, 0, where=self._mask)
+        self._nmasked = nmasked
+        if img_layer.data is self._masked:
+            img_layer.refresh()
+        else:
+            img_layer.data = self._masked
+
+    def _grad_maxval(self):
+        # intensity above which the image is masked out for the active contour; None if nothing is masked
+        if self.image is None or self.sld.value() >= self.sld.maximum():
+            return None
+        return self.sld.value()
 
     def get_image_layer(self):
         if len(self.viewer.layers) > 0 and isinstance(self.viewer.layers[0], napari.layers.Image):
@@ -233,14 +417,79 @@ class AnnotatorWidget(QWidget):
                 if answer == QMessageBox.No:
                     return
             if len(img_layer.data.shape) == 3:
-                self.annotator = Annotator(self.viewer, img_layer, self.params)
+                journal, recovered = self._recover_from_journal(img_layer)
+                image = self.image if self.image is not None else img_layer.data
+                self.annotator = Annotator(self.viewer, img_layer, self.params, precompute=True,
+                                           cache_dir=self._get_cache_dir(img_layer),
+                                           image=image, maxval=self._grad_maxval(), journal=journal)
                 self.annotation_layer = self.annotator.annotation_layer
+                self.annotator.add_filaments(recovered, log=False)
+                if not self.annotator.gradient_ready:  # lazy images are not precomputed
+                    self._precompute_gradient(self.annotator)
             else:
                 show_info("Only 3D gray-scale images are currently supported! "
                           rf"The current image has {len(img_layer.data.shape)} dimensions.")
         else:
             show_info("No images open! Please open an image first")
 
+    def _recover_from_journal(self, img_layer):
+        """
+        Journal of the annotation changes (next to the image), and the filaments recovered from it.
+        The journal is only kept if the image is opened from a file.
+        Recovery is only offered if the journal has changes that were not saved;
+            otherwise, or if the recovery is declined, the journal is cleared.
+        """
+        path = img_layer.source.path
+        if path is None:
+            return None, []
+        journal = os.path.splitext(path)[0] + '.journal'
+        if self.annotator is not None and self.annotator.journal is not None \
+                and self.annotator.journal.filename == journal:
+            self.annotator.close_journal()  # the new annotation layer takes over the journal
+        recovered = []
+        if os.path.exists(journal):
+            try:
+                discard = unsaved_changes(journal) == 0
+                if not discard:
+                    recovered = replay(journal)
+                    discard = self._confirm_recovery(len(recovered)) == QMessageBox.No
+            except (OSError, ValueError, KeyError, IndexError) as error:  # e.g. the saved annotations were moved
+                if self._confirm_discard_journal(error) == QMessageBox.No:
+                    return None, []  # the journal is kept as it is, and the changes are not logged
+                discard = True
+            if discard:
+                recovered = []
+                os.remove(journal)
+        return journal, recovered
+
+    def _get_cache_dir(self, img_layer):
+        """
+        Directory of the gradient cache on disk, or None if the cache is disabled.
+        """
+        if self.params.disk_cache_gb <= 0:
+            return None
+        if len(self.params.cache_dir) > 0:
+            return self.params.cache_dir
+        if img_layer.source.path is not None:
+            return os.path.join(os.path.dirname(img_layer.source.path), '.gradient_cache')
+        return None
+
+    def _precompute_gradient(self, annotator):
+        """
+        Compute the image gradient in a worker thread, showing the progress.
+        """
+        worker = thread_worker(annotator.precompute_gradient)()
+        worker.yielded.connect(self._show_gradient_progress)
+        worker.finished.connect(lambda: annotator.set_gradient_ready(asynchronous=True))
+        worker.finished.connect(self.progress.hide)
+        self.progress.setValue(0)
+        self.progress.show()
+        worker.start()
+
+    def _show_gradient_progress(self, progress):
+        self.progress.setMaximum(progress[1])
+        self.progress.setValue(progress[0])
+
     def setup_ui(self):
         layout = QVBoxLayout()
         self.setLayout(layout)
@@ -259,6 +508,11 @@ class AnnotatorWidget(QWidget):
         layout.addLayout(l1)
         self.magic_sigma_param = magicgui(self.sigma_param, layout='vertical', auto_call=True)
         self._add_magic_function(self.magic_sigma_param, l1)
+        self.magic_cache_param = magicgui(self.cache_param, layout='vertical', auto_call=True,
+                                          grad_dtype={"choices": ['float32', 'float16']})
+        self._add_magic_function(self.magic_cache_param, l1)
+        self.magic_profile_param = magicgui(self.profile_param, layout='vertical', auto_call=True)
+        self._add_magic_function(self.magic_profile_param, l1)
         self.magic_voxel_params = magicgui(self.voxel_params, layout='vertical', auto_call=True)
         self._add_magic_function(self.magic_voxel_params, layout)
 
@@ -267,11 +521,14 @@ class AnnotatorWidget(QWidget):
         layout.addLayout(l2)
         l2.addWidget(QLabel("Mask out bright pixels"))
         self.sld = QSlider(Qt.Horizontal)
-        self.sld.valueChanged.connect(self.set_maxval)
-        img_layer = self.get_image_layer()
-        if img_layer is not None:
-            self.sld.setMaximum(img_layer.data.max())
-            self.sld.setValue(img_layer.data.max())
+        # apply the mask once the slider stops moving
+        self.mask_timer = QTimer()
+        self.mask_timer.setSingleShot(True)
+        self.mask_timer.setInterval(150)
+        self.mask_timer.timeout.connect(self.set_maxval)
+        self.sld.valueChanged.connect(lambda _: self.mask_timer.start())
+        if self.get_image_layer() is not None:
+            self._set_intensity_stats()
         self.sld.setValue(self.sld.maximum())
         l2.addWidget(self.sld, Qt.Horizontal)
         self.set_maxval()
@@ -281,6 +538,12 @@ class AnnotatorWidget(QWidget):
         btn.clicked.connect(self.add_annotation_layer)
         layout.addWidget(btn)
 
+        # Progress of the gradient calculation
+        self.progress = QProgressBar()
+        self.progress.setFormat("Computing gradient: %p%")
+        self.progress.hide()
+        layout.addWidget(self.progress)
+
         # Display parameters
         l3 = QHBoxLayout()
         layout.addLayout(l3)
@@ -294,10 +557,17 @@ class AnnotatorWidget(QWidget):
         layout.addLayout(l4)
 
         self.magic_ac_parameters1 = magicgui(self.ac_parameters1, layout='vertical', auto_call=True)
-        self.magic_ac_parameters2 = magicgui(self.ac_parameters2, layout='vertical', auto_call=True)
+        self.magic_ac_parameters2 = magicgui(self.ac_parameters2, layout='vertical', auto_call=True,
+                                             evolution={"choices": ['explicit', 'semi-implicit']},
+                                             backend={"choices": list(BACKENDS)},
+                                             schedule={"choices": ['linear', 'adaptive']})
         self._add_magic_function(self.magic_ac_parameters1, l4)
         self._add_magic_function(self.magic_ac_parameters2, l4)
 
+        # Find duplicated filaments
+        self._add_magic_function(magicgui(self.find_duplicates, layout='horizontal', call_button="Find duplicates"),
+                                 layout)
+
         # Save parameters
         l5 = QHBoxLayout()
         layout.addLayout(l5)
@@ -317,7 +587,7 @@ class AnnotatorWidget(QWidget):
         self._add_magic_function(magicgui(self.load_annotations, layout='vertical', auto_call=True,
                                           filename={"mode": "r",
                                                     "label": "Load existing annotations:",
-                                                    "filter": "*.csv",
+                                                    "filter": "*.csv *.npz",
                                                     "value": self.datapath}),
                                  l6)
 
@@ -327,7 +597,7 @@ class AnnotatorWidget(QWidget):
         self._add_magic_function(magicgui(self.get_annotation_filename, layout='vertical', auto_call=True,
                                           filename={"mode": "w",
                                                     "label": "Save annotations:",
-                                                    "filter": "*.csv",
+                                                    "filter": "*.csv *.npz",
                                                     "value": self.filename}),
                                  l7)
         btn_save = QPushButton("Save annotations")
@@ -347,6 +617,26 @@ class AnnotatorWidget(QWidget):
         # self.viewer.layers.events.removed.connect(function.reset_choices)
         _layout.addWidget(function.native)
 
+    def _confirm_recovery(self, n_filaments):
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Question)
+
+        msg.setWindowTitle("Unsaved annotations found")
+        msg.setText(rf"The autosave journal of this image has unsaved changes ({n_filaments} filaments). "
+                    "Do you want to restore them?")
+        msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        return msg.exec_()
+
+    def _confirm_discard_journal(self, error):
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Warning)
+
+        msg.setWindowTitle("Autosave journal cannot be read")
+        msg.setText(rf"The autosave journal of this image cannot be restored ({error}). "
+                    "Do you want to discard it? Otherwise, it is kept, but the new changes are not saved to it.")
+        msg.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        return msg.exec_()
+
     def _confirm_adding_second_layer(self):
         msg = QMessageBox()
         msg.setIcon(QMessageBox.Question)
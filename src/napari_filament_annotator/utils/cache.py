@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from .postproc import is_lazy
+
+
+def gradient_key(img, sigma, spacing, dtype, tile_shape):
+    """
+    Key of the image gradient: a hash of the image data and of the gradient parameters.
+
+    For lazy arrays (dask or zarr), the identity of the array (dask graph name or zarr store location) is hashed
+        instead of the data, so that the whole image is not read to compute the key.
+
+    Parameters
+    ----------
+    img : array-like
+        Input 3D image.
+    sigma : float, tuple, list or array
+        Gaussian sigma (in voxels) to smooth the image.
+    spacing : tuple, list or array
+        Voxel size, (z, y, x).
+    dtype : data-type
+        Data type to store the gradient.
+    tile_shape : tuple
+        Shape of the gradient tiles.
+
+    Returns
+    -------
+    str:
+        Hexadecimal key.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps(dict(shape=[int(s) for s in img.shape],
+                             img_dtype=str(img.dtype),
+                             sigma=np.ravel(sigma).tolist(),
+                             spacing=np.ravel(spacing).tolist(),
+                             dtype=str(np.dtype(dtype)),
+                             tile_shape=[int(s) for s in tile_shape])).encode())
+    if is_lazy(img) and _lazy_token(img) is not None:
+        h.update(_lazy_token(img).encode())
+    else:
+        for i in range(len(img)):  # hash plane by plane, to avoid copying the whole image
+            h.update(np.ascontiguousarray(img[i]))
+    return h.hexdigest()
+
+
+def _lazy_token(img):
+    if hasattr(img, 'dask') and hasattr(img, 'name'):  # dask array: the name is a hash of its source
+        return 'dask:' + img.name
+    if hasattr(img, 'store') and hasattr(img, 'path'):  # zarr array
+        return 'zarr:' + json.dumps([str(img.store), str(img.path), str(img.chunks)])
+    return None
+
+
+class GradientCache:
+    """
+    Directory with memory-mapped image gradients, reused between sessions.
+
+    Each entry is a subdirectory named by the gradient key (see `gradient_key`), with the gradient
+        array and the mask of the tiles that were already computed.
+    The least recently used entries are deleted when the total size exceeds the size limit.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory.
+    max_bytes : int, optional
+        Size limit of the cache, in bytes.
+    """
+
+    def __init__(self, directory, max_bytes=10 * 2 ** 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def open(self, key, shape, dtype, ntiles):
+        """
+        Open the cached gradient, or create a new cache entry.
+        No entry is created if the gradient alone exceeds the size limit.
+
+        Parameters
+        ----------
+        key : str
+            Gradient key.
+        shape : tuple
+            Image shape.
+        dtype : data-type
+            Data type to store the gradient.
+        ntiles : tuple
+            Number of gradient tiles along each axis.
+
+        Returns
+        -------
+        np.memmap:
+            Memory-mapped gradient of shape 3 x image shape.
+        np.memmap:
+            Memory-mapped mask of the tiles that are already computed.
+        None:
+            If the gradient does not fit in the cache.
+        """
+        path = os.path.join(self.directory, key)
+        fn_grad = os.path.join(path, 'gradient.npy')
+        fn_computed = os.path.join(path, 'computed.npy')
+        if os.path.exists(fn_grad) and os.path.exists(fn_computed):
+            os.utime(path)  # mark as recently used
+            return np.load(fn_grad, mmap_mode='r+'), np.load(fn_computed, mmap_mode='r+')
+
+        grad_bytes = np.prod(shape) * len(shape) * np.dtype(dtype).itemsize
+        if grad_bytes > self.max_bytes:  # keep the gradient in memory
+            return None
+        self.evict(grad_bytes)
+        os.makedirs(path, exist_ok=True)
+        computed = np.lib.format.open_memmap(fn_computed, mode='w+', dtype=bool, shape=tuple(ntiles))
+        grad = np.lib.format.open_memmap(fn_grad, mode='w+', dtype=dtype, shape=(len(shape),) + tuple(shape))
+        return grad, computed
+
+    def entries(self):
+        """
+        List the cache entries, from the least to the most recently used.
+
+        Returns
+        -------
+        list of tuples:
+            Key and size (in bytes) of each entry.
+        """
+        if not os.path.exists(self.directory):
+            return []
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if os.path.isdir(path):
+                size = sum([os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path)])
+                entries.append((os.path.getmtime(path), key, size))
+        return [(key, size) for _, key, size in sorted(entries)]
+
+    def evict(self, needed=0):
+        """
+        Delete the least recently used entries, until the cache has room for `needed` bytes.
+        """
+        entries = self.entries()
+        total = sum([size for _, size in entries])
+        for key, size in entries:
+            if total + needed <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
@@ -1,9 +1,146 @@
+import time
+
 import numpy as np
 from Geometry3D import *
 from scipy.optimize import linear_sum_assignment
 from scipy.spatial.distance import cdist
 
 
+class PolygonBuffer:
+    """
+    Growable buffer with the near and far points of the polygon that is being drawn.
+
+    The points are stored in one array as far points (in reverse order) followed by the near points,
+        which is the polygon contour: new points are written at both ends of the used range,
+        so adding a point is O(1) (amortized) and the polygon is available without copying.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Initial number of near (and far) points that fit into the buffer.
+    ndim : int, optional
+        Number of coordinates of each point.
+    """
+
+    def __init__(self, capacity=64, ndim=3):
+        self.capacity = capacity
+        self.ndim = ndim
+        self._data = np.empty((2 * capacity, ndim))
+        self.n_near = 0
+        self.n_far = 0
+
+    def __len__(self):
+        return self.n_near
+
+    @property
+    def near(self):
+        """np.ndarray: N x D view of the near points."""
+        return self._data[self.capacity:self.capacity + self.n_near]
+
+    @property
+    def far(self):
+        """np.ndarray: N x D view of the far points."""
+        return self._data[self.capacity - self.n_far:self.capacity][::-1]
+
+    @property
+    def polygon(self):
+        """np.ndarray: view of the polygon vertices: far points in reverse order, followed by the near points."""
+        return self._data[self.capacity - self.n_far:self.capacity + self.n_near]
+
+    def append(self, near_point, far_point):
+        """
+        Add a pair of near and far points.
+        """
+        if max(self.n_near, self.n_far) >= self.capacity:
+            self._grow(2 * self.capacity)
+        self._data[self.capacity + self.n_near] = near_point
+        self._data[self.capacity - self.n_far - 1] = far_point
+        self.n_near += 1
+        self.n_far += 1
+
+    def pop(self):
+        """
+        Remove the last pair of near and far points.
+        """
+        self.n_near = max(self.n_near - 1, 0)
+        self.n_far = max(self.n_far - 1, 0)
+
+    def clear(self):
+        """
+        Remove all points.
+        """
+        self.n_near = 0
+        self.n_far = 0
+
+    def set_near(self, points):
+        """
+        Replace the near points.
+        """
+        points = np.array(points, dtype=float).reshape(-1, self.ndim)
+        if len(points) > self.capacity:
+            self._grow(len(points))
+        self._data[self.capacity:self.capacity + len(points)] = points
+        self.n_near = len(points)
+
+    def set_far(self, points):
+        """
+        Replace the far points.
+        """
+        points = np.array(points, dtype=float).reshape(-1, self.ndim)
+        if len(points) > self.capacity:
+            self._grow(len(points))
+        self._data[self.capacity - len(points):self.capacity] = points[::-1]
+        self.n_far = len(points)
+
+    def _grow(self, capacity):
+        data = np.empty((2 * capacity, self.ndim))
+        data[capacity - self.n_far:capacity + self.n_near] = self.polygon
+        self._data = data
+        self.capacity = capacity
+
+
+def trim_path(points, length=0, spacing=None, end=-1):
+    """
+    Trim a path at one end, by one point or by an arc length.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        N x 3 array of the path coordinates.
+    length : float, optional
+        Arc length to trim, in the units of `spacing`.
+        The new end point is interpolated on the path.
+        If 0, one point is removed.
+    spacing : tuple, list or array, optional
+        Voxel size, (z, y, x).
+    end : int, optional
+        End to trim: 0 for the start, -1 for the end of the path.
+
+    Returns
+    -------
+    np.ndarray:
+        M x 3 array of the trimmed path.
+        Only the first point is left if the path is shorter than `length`.
+    """
+    points = np.asarray(points)
+    if end == 0:
+        return trim_path(points[::-1], length, spacing)[::-1]
+    if length <= 0:
+        return points[:-1]
+    spacing = np.ones(points.shape[1]) if spacing is None else np.array(spacing)
+    segments = np.sqrt(np.sum((np.diff(points, axis=0) * spacing) ** 2, axis=1))[::-1]  # from the end
+    cumlength = np.cumsum(segments)
+    k = np.searchsorted(cumlength, length)  # index of the segment with the new end point, from the end
+    if k >= len(segments):
+        return points[:1]
+    remaining = (cumlength[k] - length) / segments[k]  # fraction of the segment that is kept
+    start = points[len(points) - k - 2]
+    if remaining == 0:
+        return points[:len(points) - k - 1]
+    new_end = start + (points[len(points) - k - 1] - start) * remaining
+    return np.concatenate([points[:len(points) - k - 1], new_end[None].astype(points.dtype)])
+
+
 def tetragon_intersection(p1, p2):
     """
     Calculate intersection of two tetragons in 3D
@@ -36,7 +173,154 @@ def tetragon_intersection(p1, p2):
         return None
 
 
-def compute_polygon_intersection(polygons, spacing=None):
+def tetragon_intersections(p1, p2, eps=1e-9):
+    """
+    Calculate intersections between two sets of planar convex tetragons in 3D, for all pairs at once.
+
+    Each tetragon is intersected with the plane of the other one, which gives a segment
+        on the line where the two planes meet.
+    The intersection of the tetragons is the overlap of these two segments.
+
+    Parameters
+    ----------
+    p1 : array
+        Array of N tetragons, of shape N x 4 x 3.
+    p2 : array
+        Array of M tetragons, of shape M x 4 x 3.
+    eps : float, optional
+        Relative tolerance to detect degenerate tetragons, parallel planes and touching segments.
+
+    Returns
+    -------
+    np.ndarray:
+        Array of shape N x M x 2 x 3 with the start and end of each intersection segment.
+        Set to -1 for the pairs that do not intersect.
+    """
+    p1 = np.asarray(p1, dtype=float)
+    p2 = np.asarray(p2, dtype=float)
+    if p1.shape[-2:] != (4, 3) or p2.shape[-2:] != (4, 3):
+        raise ValueError("Input tetragon shape must be (4, 3)")
+    return _intersect_pairs(p1[:, None], p2[None], eps)
+
+
+def _intersect_pairs(p1, p2, eps=1e-9):
+    # intersect tetragons p1[k] and p2[k]; arrays of shape ... x 4 x 3 are broadcast against each other
+    scale = max(np.abs(p1).max(), np.abs(p2).max(), 1)
+    tol = eps * scale
+
+    n1, d1, valid1 = _plane(p1, tol)
+    n2, d2, valid2 = _plane(p2, tol)
+
+    # direction of the line where the two planes meet
+    u = np.cross(n1, n2)
+    norm = np.linalg.norm(u, axis=-1)
+    valid = valid1 & valid2 & (norm > eps)
+    u = u / np.where(norm > eps, norm, 1)[..., None]
+
+    # segments where each tetragon crosses the plane of the other tetragon, parametrized along the line
+    start1, end1, s_start1, s_end1, found1 = _plane_section(p1, n2, d2, u, tol)
+    start2, end2, s_start2, s_end2, found2 = _plane_section(p2, n1, d1, u, tol)
+
+    # overlap of the two segments
+    lo = np.maximum(s_start1, s_start2)
+    hi = np.minimum(s_end1, s_end2)
+    valid = valid & found1 & found2 & (lo <= hi + tol)
+    length = s_end1 - s_start1
+    length = np.where(length > 0, length, 1)
+    inter = np.stack([start1 + ((lo - s_start1) / length)[..., None] * (end1 - start1),
+                      start1 + ((hi - s_start1) / length)[..., None] * (end1 - start1)],
+                     axis=-2)
+    inter[~valid] = -1
+    return inter
+
+
+def broad_phase(p1, p2, tol=1e-6):
+    """
+    Select pairs of tetragons that may intersect, based on their axis-aligned bounding boxes.
+
+    The boxes are swept along one axis: the boxes of p2 are sorted by their lower bound, and each box of p1
+        is only compared with the boxes of p2 that start between its own bounds (extended by the largest box
+        of p2), so that only the pairs near the crossing region are materialized.
+    The axis with the fewest such candidate pairs is used.
+
+    Parameters
+    ----------
+    p1 : array
+        Array of N tetragons, of shape N x 4 x 3.
+    p2 : array
+        Array of M tetragons, of shape M x 4 x 3.
+    tol : float, optional
+        Tolerance to extend the bounding boxes, to keep pairs that only touch.
+
+    Returns
+    -------
+    tuple of np.ndarray:
+        Indices of the tetragons in p1 and p2 for the pairs with overlapping bounding boxes,
+            sorted by the index in p1, then in p2.
+    """
+    lo1, hi1 = np.min(p1, axis=1), np.max(p1, axis=1)
+    lo2, hi2 = np.min(p2, axis=1), np.max(p2, axis=1)
+    if len(lo1) == 0 or len(lo2) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    # range of the boxes of p2 (sorted by the lower bound) that may overlap each box of p1, along each axis
+    order = np.argsort(lo2, axis=0, kind='stable')
+    sorted_lo2 = np.take_along_axis(lo2, order, axis=0)
+    extent = np.max(hi2 - lo2, axis=0)
+    first = np.empty(lo1.shape, dtype=np.intp)
+    last = np.empty(lo1.shape, dtype=np.intp)
+    for axis in range(lo1.shape[1]):
+        first[:, axis] = np.searchsorted(sorted_lo2[:, axis], lo1[:, axis] - extent[axis] - tol)
+        last[:, axis] = np.searchsorted(sorted_lo2[:, axis], hi1[:, axis] + tol, side='right')
+    counts = np.maximum(last - first, 0)
+    axis = np.argmin(counts.sum(0))
+    counts = counts[:, axis]
+
+    # candidate pairs along the selected axis, tested on all axes
+    ind1 = np.repeat(np.arange(len(lo1)), counts)
+    position = np.arange(len(ind1)) - np.repeat(np.cumsum(counts) - counts - first[:, axis], counts)
+    ind2 = order[position, axis]
+    overlap = np.all((lo1[ind1] <= hi2[ind2] + tol) & (lo2[ind2] <= hi1[ind1] + tol), axis=-1)
+    ind1, ind2 = ind1[overlap], ind2[overlap]
+    sort = np.lexsort((ind2, ind1))
+    return ind1[sort], ind2[sort]
+
+
+def _plane(p, tol):
+    # normal from the cross product of the diagonals, which also works for tetragons with a repeated vertex
+    normal = np.cross(p[..., 2, :] - p[..., 0, :], p[..., 3, :] - p[..., 1, :])
+    norm = np.linalg.norm(normal, axis=-1)
+    valid = norm > tol * tol
+    normal = normal / np.where(valid, norm, 1)[..., None]
+    d = np.sum(normal * p.mean(-2), axis=-1)
+    return normal, d, valid
+
+
+def _plane_section(p, normal, d, u, tol):
+    # signed distance of the tetragon vertices to the plane
+    dist = np.sum(p * normal[..., None, :], axis=-1) - d[..., None]
+    on_plane = np.abs(dist) <= tol
+    dist_next = np.roll(dist, -1, axis=-1)
+    crossing = (dist * dist_next < 0) & ~on_plane & ~np.roll(on_plane, -1, axis=-1)
+
+    # points where the edges cross the plane, and the vertices lying in the plane
+    t = dist / np.where(crossing, dist - dist_next, 1)
+    edge_points = p + t[..., None] * (np.roll(p, -1, axis=-2) - p)
+    candidates = np.concatenate(np.broadcast_arrays(p, edge_points), axis=-2)
+    found = np.concatenate(np.broadcast_arrays(on_plane, crossing), axis=-1)
+
+    # the section is the segment between the extreme candidates along the line
+    s = np.sum(candidates * u[..., None, :], axis=-1)
+    imin = np.argmin(np.where(found, s, np.inf), axis=-1)[..., None]
+    imax = np.argmax(np.where(found, s, -np.inf), axis=-1)[..., None]
+    start = np.take_along_axis(candidates, imin[..., None], axis=-2)[..., 0, :]
+    end = np.take_along_axis(candidates, imax[..., None], axis=-2)[..., 0, :]
+    s_start = np.take_along_axis(s, imin, axis=-1)[..., 0]
+    s_end = np.take_along_axis(s, imax, axis=-1)[..., 0]
+    return start, end, s_start, s_end, found.any(-1)
+
+
+def compute_polygon_intersection(polygons, spacing=None, backend='numpy', return_stats=False):
     """
     Compute intersection of two polygons.
 
@@ -49,11 +333,21 @@ def compute_polygon_intersection(polygons, spacing=None):
             N is the number of points, 3 is the dimension of the image.
     spacing : tuple, list or array
         Voxel size, (z, y, x).
+    backend : str, optional
+        Backend to intersect the tetragons that constitute the polygons:
+            "numpy" (vectorized, default) or "geometry3d" (reference implementation with Geometry3D).
+    return_stats : bool, optional
+        If True, also return the number of tetragon pairs and the number of pairs
+            discarded by the bounding box test before the exact intersection.
 
     Returns
     -------
     np.ndarray of shape M x 3
         List of M points for the polygon intersection.
+    dict, optional
+        Number of tetragon pairs ("pairs") and of discarded pairs ("pruned"), and the time (in seconds)
+            to intersect the tetragons ("time_intersect") and to match them ("time_match"),
+            if `return_stats` is True.
     """
     # near and far points of the both polygons
     npt1 = polygons[0][0]
@@ -67,23 +361,39 @@ def compute_polygon_intersection(polygons, spacing=None):
     spacing = np.array(spacing)
 
     # calculate intersections for each pair of tetragons that constitute the provided polygons
-    intersections = []
-    for i in range(len(npt1) - 1):
-        for j in range(len(npt2) - 1):
-            p1 = [npt1[i], npt1[i + 1], fpt1[i + 1], fpt1[i]]
-            p2 = [npt2[j], npt2[j + 1], fpt2[j + 1], fpt2[j]]
-            inter = tetragon_intersection(p1, p2)
+    start = time.perf_counter()
+    tetragons1 = _get_tetragons(npt1, fpt1)
+    tetragons2 = _get_tetragons(npt2, fpt2)
+    # only test the pairs with overlapping bounding boxes; set to -1 if no intersection exists
+    ind1, ind2 = broad_phase(tetragons1, tetragons2)
+    if backend == 'numpy':
+        intersections = _intersect_pairs(tetragons1[ind1], tetragons2[ind2])
+    elif backend == 'geometry3d':
+        intersections = np.ones([len(ind1), 2, 3]) * -1
+        for k, (i, j) in enumerate(zip(ind1, ind2)):
+            inter = tetragon_intersection(tetragons1[i], tetragons2[j])
             if inter is not None:
-                intersections.append(inter)
-            else:
-                intersections.append(np.ones([2, 3]) * -1)  # set to -1 if no intersection exists
+                intersections[k] = inter
+    else:
+        raise ValueError(rf"Unknown backend: {backend}; must be 'numpy' or 'geometry3d'")
+    npairs = len(tetragons1) * len(tetragons2)
+    stats = dict(pairs=npairs, pruned=npairs - len(ind1), time_intersect=time.perf_counter() - start)
 
     # select the largest intersections
-    intersections = np.array(intersections).reshape(len(npt1) - 1, len(npt2) - 1, 2, 3)
-    l = np.sqrt(np.sum((intersections[:, :, 0] - intersections[:, :, 1]) ** 2, -1))  # length of each intersection
-    inds = linear_sum_assignment(l, maximize=True)  # match tetragons based on the intersection length
-    overlap = intersections[inds[0], inds[1]]
-    overlap = np.array([o for o in overlap if np.min(o) >= 0])  # remove the pairs with no intersection (the -1 values)
+    start = time.perf_counter()
+    found = np.min(intersections, axis=(1, 2)) >= 0  # remove the pairs with no intersection (the -1 values)
+    ind1, ind2, intersections = ind1[found], ind2[found], intersections[found]
+    # match the tetragons based on the intersection length, among the tetragons that intersect any other
+    rows, ind1 = np.unique(ind1, return_inverse=True)
+    cols, ind2 = np.unique(ind2, return_inverse=True)
+    l = np.zeros([len(rows), len(cols)])  # length of each intersection
+    l[ind1, ind2] = np.sqrt(np.sum((intersections[:, 0] - intersections[:, 1]) ** 2, -1))
+    pair = np.full([len(rows), len(cols)], -1)
+    pair[ind1, ind2] = np.arange(len(intersections))
+    inds = linear_sum_assignment(l, maximize=True)
+    stats['time_match'] = time.perf_counter() - start
+    pair = pair[inds[0], inds[1]]
+    overlap = intersections[pair[pair >= 0]]
 
     # the start and end of each segment are sometimes swapped
     # we replace the start and end points by the center of each segment
@@ -97,4 +407,13 @@ def compute_polygon_intersection(polygons, spacing=None):
     overlap = np.array([overlap[ind[0]]] +
                        centers +
                        [overlap[ind[1]]])  # furtherst points + centers of remaining intersections
+    if return_stats:
+        return overlap, stats
     return overlap
+
+
+def _get_tetragons(near_points, far_points):
+    # tetragons between each pair of consecutive rays: N - 1 x 4 x 3
+    near_points = np.array(near_points, dtype=float)
+    far_points = np.array(far_points, dtype=float)
+    return np.stack([near_points[:-1], near_points[1:], far_points[1:], far_points[:-1]], axis=1)
@@ -1,9 +1,18 @@
+import json
+import os
+import struct
+import zipfile
+
+import numpy as np
 import pandas as pd
 
 from .const import COLS, COL_NAME
 
+ANNOTATION_EXTENSIONS = ('.csv', '.npz')
+METADATA_PREFIX = 'metadata_'  # prefix of the per-path metadata columns in npz files
+
 
-def annotation_to_pandas(data: list) -> pd.DataFrame:
+def annotation_to_pandas(data: list, labels: list = None) -> pd.DataFrame:
     """
     Convert list of paths to a pandas table with coordinates.
 
@@ -12,6 +21,8 @@ def annotation_to_pandas(data: list) -> pd.DataFrame:
     data : list
         List of paths, each of which is a list of coordinates of shape N x 3,
             where N is the number of points in the path.
+    labels : list, optional
+        ID of each path. If None, the paths are numbered from 0.
 
     Returns
     -------
@@ -19,12 +30,13 @@ def annotation_to_pandas(data: list) -> pd.DataFrame:
         pandas DataFrame with coordinates
     """
 
-    df = pd.DataFrame()
-    if len(data) > 0:
-        for i, d in enumerate(data):
-            cur_df = pd.DataFrame(d, columns=COLS)
-            cur_df[COL_NAME] = i
-            df = pd.concat([df, cur_df], ignore_index=True)
+    if len(data) == 0:
+        return pd.DataFrame()
+    data = [np.asarray(d) for d in data]
+    lengths = [len(d) for d in data]
+    # one table for all paths, with the ID of each path repeated for its points
+    df = pd.DataFrame(np.concatenate([d.reshape(-1, len(COLS)) for d in data]), columns=COLS)
+    df[COL_NAME] = np.repeat(np.arange(len(data)) if labels is None else np.asarray(labels), lengths)
     return df
 
 
@@ -42,11 +54,140 @@ def pandas_to_annotations(df: pd.DataFrame) -> list:
     list:
         List of paths, each of shape N x 3
     """
-    data = []
-    labels = []
-    if len(df) > 0:
-        for s in df[COL_NAME].unique():
-            d = df[df[COL_NAME] == s][COLS].values
-            data.append(d)
-            labels.append(s)
-    return data, labels
+    if len(df) == 0:
+        return [], []
+    # IDs in the order of appearance; points of each path in their original order
+    codes, labels = pd.factorize(df[COL_NAME].to_numpy(), use_na_sentinel=False)
+    order = np.argsort(codes, kind='stable')
+    data = np.split(df[COLS].to_numpy()[order], np.cumsum(np.bincount(codes))[:-1])
+    return data, list(labels)
+
+
+def write_annotations(filename, data: list, labels: list = None, params: dict = None,
+                      metadata: pd.DataFrame = None):
+    """
+    Save annotations to a csv or npz file, depending on the file extension.
+
+    The npz file (uncompressed) contains:
+        "vertices": M x 3 float32 array with the points of all paths,
+        "offsets": N + 1 array with the start of each path in "vertices" (and the total number of points),
+        "labels": ID of each path,
+        "params": json string with the parameters used for annotation (e.g. `Params.to_dict()`),
+        "metadata_<name>": N values of each metadata column, aligned with "offsets".
+
+    Parameters
+    ----------
+    filename : str
+        Output file, with the extension ".csv" or ".npz".
+    data : list
+        List of paths, each of shape N x 3.
+    labels : list, optional
+        ID of each path. If None, the paths are numbered from 0.
+    params : dict, optional
+        Annotation parameters, saved to the npz file only.
+    metadata : pd.DataFrame, optional
+        Table with one row per path (e.g. the refinement parameters and the number of iterations),
+            saved to the npz file only.
+    """
+    ext = _get_extension(filename)
+    if metadata is not None and len(metadata) != len(data):
+        raise ValueError(rf"Metadata must have one row per path: {len(metadata)} rows for {len(data)} paths")
+    if ext == '.csv':
+        annotation_to_pandas(data, labels).to_csv(filename, index=False)
+    else:
+        data = [np.asarray(d, dtype=np.float32).reshape(-1, len(COLS)) for d in data]
+        vertices = np.concatenate(data) if len(data) > 0 else np.empty((0, len(COLS)), dtype=np.float32)
+        offsets = np.cumsum([0] + [len(d) for d in data])
+        labels = np.arange(len(data)) if labels is None else np.asarray(labels)
+        columns = {}
+        if metadata is not None:
+            for name in metadata.columns:
+                column = metadata[name].to_numpy()
+                # strings are stored as unicode arrays, to load without pickle
+                columns[METADATA_PREFIX + str(name)] = column.astype(str) if column.dtype == object else column
+        np.savez(filename, vertices=vertices, offsets=offsets, labels=labels,
+                 params=np.array(json.dumps({} if params is None else params)), **columns)
+
+
+def read_annotations(filename, return_params=False, return_metadata=False):
+    """
+    Load annotations from a csv or npz file, depending on the file extension.
+
+    The paths loaded from an npz file are views of one memory-mapped array with all points,
+        so that they are read from the disk only when accessed.
+
+    Parameters
+    ----------
+    filename : str
+        Input file, with the extension ".csv" or ".npz" (see `write_annotations`).
+    return_params : bool, optional
+        If True, also return the annotation parameters saved in the file (empty for csv files).
+    return_metadata : bool, optional
+        If True, also return the table of per-path metadata saved in the file (without columns for csv files).
+
+    Returns
+    -------
+    list:
+        List of paths, each of shape N x 3
+    list:
+        ID of each path.
+    dict:
+        Annotation parameters; only returned if `return_params` is True.
+    pd.DataFrame:
+        Metadata, one row per path; only returned if `return_metadata` is True.
+    """
+    ext = _get_extension(filename)
+    if ext == '.csv':
+        try:
+            data, labels = pandas_to_annotations(pd.read_csv(filename))
+        except pd.errors.EmptyDataError:  # saved without annotations
+            data, labels = [], []
+        params = {}
+        metadata = pd.DataFrame(index=range(len(data)))
+    else:
+        # plain array view of the memory map: slicing an ndarray is faster than slicing a memmap
+        vertices = _memmap_npz_member(filename, 'vertices').view(np.ndarray)
+        with np.load(filename) as f:
+            offsets = f['offsets'].tolist()
+            labels = f['labels'].tolist()
+            params = json.loads(str(f['params']))
+            metadata = pd.DataFrame({name[len(METADATA_PREFIX):]: f[name] for name in f.files
+                                     if name.startswith(METADATA_PREFIX)}, index=range(len(labels)))
+        data = [vertices[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    outputs = (data, labels)
+    if return_params:
+        outputs += (params,)
+    if return_metadata:
+        outputs += (metadata,)
+    return outputs
+
+
+def _get_extension(filename):
+    ext = os.path.splitext(str(filename))[1].lower()
+    if ext not in ANNOTATION_EXTENSIONS:
+        raise ValueError(rf"Unknown annotation file extension: {ext}; must be one of {ANNOTATION_EXTENSIONS}")
+    return ext
+
+
+def _memmap_npz_member(filename, name):
+    # memory-map an array stored without compression in an npz file
+    with zipfile.ZipFile(filename) as z:
+        info = z.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        with np.load(filename) as f:
+            return f[name]
+    with open(filename, 'rb') as f:
+        # the local file header is followed by the file name and an extra field of variable length
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if np.prod(shape) == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
@@ -0,0 +1,114 @@
+"""
+Numba-compiled kernel of the explicit active contour evolution (the "numba" backend, see `postproc.BACKENDS`).
+
+Importing this module raises an ImportError if numba is not installed.
+"""
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def evolve_snake(snake, c, grad, strides, upper, spacing, alpha, beta, gamma, coef,
+                 neighbours, starts, ends, tol, adaptive, weight, last, iterations, moving):
+    """
+    Iterations of the explicit active contour evolution, updating `snake` and the convergence state in place.
+
+    Performs the same floating point operations as `postproc._evolve_snake_steps` (with the same result),
+        but gathers the gradient, computes the forces, updates the points and clips them to the image
+        point by point, without temporary arrays.
+
+    Parameters
+    ----------
+    snake : np.ndarray
+        N x 3 array of float64 coordinates of all snakes.
+    c : np.ndarray
+        Step weight of each iteration.
+    grad : np.ndarray
+        Gradient of shape 3 x number of voxels (flattened image).
+    strides : np.ndarray
+        Strides (in voxels) of the image axes.
+    upper : np.ndarray
+        Maximal coordinate along each axis.
+    spacing : np.ndarray
+        Voxel size.
+    alpha, beta, gamma : float
+        Active contour weights.
+    coef : np.ndarray
+        N x 3 coefficients of the forces (`end_coef` at the end points).
+    neighbours : np.ndarray
+        N x 5 indices of the points i-2 to i+2 of each point, reflected at the snake ends.
+    starts, ends : np.ndarray
+        Start (inclusive) and end (exclusive) of each snake.
+    tol : float
+        Displacement (in voxels) below which a snake is converged; 0 to do all iterations.
+    adaptive : bool
+        If True, the step weight of each snake is `weight` instead of `c`,
+            and is halved each time the snake reverses its direction.
+    weight : np.ndarray
+        Step weight of each snake (adaptive schedule).
+    last : np.ndarray
+        N x 3 displacement of the points in the previous iteration (adaptive schedule).
+    iterations : np.ndarray
+        Number of iterations done for each snake.
+    moving : np.ndarray
+        Whether each snake is not converged yet.
+    """
+    n = snake.shape[0]
+    fimg = np.empty((n, 3), dtype=grad.dtype)
+    fsnake = np.empty((n, 3))
+    for it in range(len(c)):
+        if not moving.any():
+            break
+        for s in range(len(starts)):
+            if not moving[s]:
+                continue
+            for j in range(starts[s], ends[s]):
+                # gather the gradient at the rounded coordinates: image force
+                index = 0
+                for d in range(3):
+                    index += np.intp(np.rint(snake[j, d])) * strides[d]
+                for d in range(3):
+                    f = -grad[d, index]
+                    fimg[j, d] = f
+                # second and fourth derivatives: internal force
+                for d in range(3):
+                    p0 = snake[neighbours[j, 0], d] * spacing[d]
+                    p1 = snake[neighbours[j, 1], d] * spacing[d]
+                    p2 = snake[neighbours[j, 2], d] * spacing[d]
+                    p3 = snake[neighbours[j, 3], d] * spacing[d]
+                    p4 = snake[neighbours[j, 4], d] * spacing[d]
+                    d2 = (p1 + p3) - p2 * 2
+                    d4 = ((p0 - p1 * 4) + p2 * 6 - p3 * 4) + p4
+                    f = d2 * alpha + d4 * beta
+                    fsnake[j, d] = f
+            # normalize the forces, update the snake and keep it inside the image
+            fimg_norm = fimg[starts[s], 0]
+            fsnake_norm = fsnake[starts[s], 0]
+            for j in range(starts[s], ends[s]):
+                for d in range(3):
+                    fimg_norm = max(fimg_norm, fimg[j, d])
+                    fsnake_norm = max(fsnake_norm, fsnake[j, d])
+            w = weight[s] if adaptive else c[it]
+            reverse = 0.
+            moved = 0.
+            for j in range(starts[s], ends[s]):
+                dot = 0.
+                dist = 0.
+                for d in range(3):
+                    step = np.float64(fimg[j, d] / fimg_norm) * gamma + fsnake[j, d] / fsnake_norm
+                    step = step * (w * coef[j, d]) / (gamma + 1)
+                    new = min(max(snake[j, d] - step, 0.), upper[d])
+                    delta = new - snake[j, d]
+                    snake[j, d] = new
+                    dot += delta * last[j, d]
+                    dist += delta * delta
+                    last[j, d] = delta
+                reverse += dot
+                moved = max(moved, dist)
+            # convergence
+            iterations[s] += 1
+            if adaptive and reverse < 0:
+                weight[s] *= 0.5
+            if tol > 0 and moved < tol ** 2:
+                moving[s] = False
+    return snake
@@ -0,0 +1,156 @@
+import json
+import os
+
+from .io import read_annotations, write_annotations
+
+
+class Journal:
+    """
+    Append-only log of the annotation changes, to recover the annotations after a crash.
+
+    Each change is written as one line of json, so that adding, deleting or editing a filament
+        costs the same regardless of the number of annotated filaments.
+    Filaments are referred to by their index in the list of filaments.
+
+    Records:
+        {"op": "base", "file": filename}: the annotations saved to a csv or npz file
+            (the journal is restarted with this record when the annotations are saved);
+        {"op": "add", "index": i, "points": [[z, y, x], ...]}: a new filament;
+        {"op": "edit", "index": i, "points": [[z, y, x], ...]}: new coordinates of a filament;
+        {"op": "delete", "index": i}: a deleted filament.
+
+    Parameters
+    ----------
+    filename : str
+        Journal file; new records are appended to the existing file.
+    fsync : bool, optional
+        If True, each record is synchronized to the disk (safer, but slower).
+    """
+
+    def __init__(self, filename, fsync=False):
+        self.filename = filename
+        self.fsync = fsync
+        self._file = open(filename, 'a')
+
+    def add(self, index, points):
+        self._write(dict(op='add', index=int(index), points=_to_list(points)))
+
+    def edit(self, index, points):
+        self._write(dict(op='edit', index=int(index), points=_to_list(points)))
+
+    def delete(self, index):
+        self._write(dict(op='delete', index=int(index)))
+
+    def restart(self, base_file=None):
+        """
+        Clear the journal, e.g. after the annotations are saved.
+
+        Parameters
+        ----------
+        base_file : str, optional
+            File with the saved annotations, which the subsequent changes apply to.
+        """
+        self._file.close()
+        self._file = open(self.filename, 'w')
+        if base_file is not None:
+            self._write(dict(op='base', file=os.path.abspath(base_file)))
+
+    def close(self):
+        self._file.close()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+
+def replay(filename):
+    """
+    Rebuild the annotations from a journal.
+
+    An incomplete last record (e.g. from a crash during writing) is ignored.
+
+    Parameters
+    ----------
+    filename : str
+        Journal file (see `Journal`).
+
+    Returns
+    -------
+    list:
+        List of filaments, each of shape N x 3.
+    """
+    data = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if record['op'] == 'base':
+                data = list(read_annotations(record['file'])[0])
+            elif record['op'] == 'add':
+                data.insert(record['index'], record['points'])
+            elif record['op'] == 'edit':
+                data[record['index']] = record['points']
+            elif record['op'] == 'delete':
+                data.pop(record['index'])
+    return data
+
+
+def unsaved_changes(filename):
+    """
+    Number of changes in a journal after the annotations were last saved (after the last "base" record).
+
+    An incomplete last record (e.g. from a crash during writing) is ignored.
+
+    Parameters
+    ----------
+    filename : str
+        Journal file (see `Journal`).
+
+    Returns
+    -------
+    int:
+        Number of "add", "edit" and "delete" records after the last "base" record.
+    """
+    n = 0
+    with open(filename) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            n = 0 if record['op'] == 'base' else n + 1
+    return n
+
+
+def compact(filename, output_file, params=None):
+    """
+    Save the annotations rebuilt from a journal to a csv or npz file, and restart the journal from this file.
+
+    Parameters
+    ----------
+    filename : str
+        Journal file (see `Journal`).
+    output_file : str
+        File to save the annotations, with the extension ".csv" or ".npz".
+    params : dict, optional
+        Annotation parameters to save to the npz file.
+
+    Returns
+    -------
+    list:
+        List of filaments, each of shape N x 3.
+    """
+    data = replay(filename)
+    write_annotations(output_file, data, params=params)
+    journal = Journal(filename)
+    journal.restart(output_file)
+    journal.close()
+    return data
+
+
+def _to_list(points):
+    return [[float(c) for c in p] for p in points]
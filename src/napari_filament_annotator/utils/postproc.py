@@ -1,33 +1,151 @@
 import numpy as np
+from scipy import ndimage
+from scipy import sparse
+from scipy.sparse.linalg import splu
 from skimage.filters import sobel
 
+try:
+    import dask.array as da
+except ImportError:  # dask is only needed for lazy images
+    da = None
 
-def gradient(img, spacing=None):
+try:
+    from . import jit
+except ImportError:  # numba is only needed for the "numba" backend
+    jit = None
+
+
+def gradient(img, spacing=None, dtype=np.float32, out=None, sigma=None):
     """
     Calculate image gradient along all axes.
 
+    Lazy images (dask or zarr arrays) are filtered chunk by chunk, with an overlap between the chunks
+        large enough to reproduce the result of filtering the full image.
+
     Parameters
     ----------
-    img : np.ndarray
+    img : np.ndarray or lazy array
         Input 3D image
     spacing : tuple, list or array
         Voxel size, (z, y, x).
+    dtype : data-type, optional
+        Data type to store the gradient, e.g. np.float32 or np.float16.
+        Ignored if `out` is provided.
+    out : np.ndarray, optional
+        Array of shape 3 x image shape to store the gradient, e.g. a memory-mapped array
+            created with `allocate_gradient`.
+    sigma : float, tuple, list or array, optional
+        Gaussian sigma (in voxels) to smooth the image before calculating the gradient.
 
     Returns
     -------
-    list of np.ndarray:
-        Image gradients along all three axes.
-        List of length 3, each element having the same shape as the input image.
+    np.ndarray or dask.array.Array:
+        Image gradients along all three axes, stored in one contiguous array.
+        Array of shape 3 x image shape; element i is the gradient along axis i.
+        For lazy images, a dask array that is computed on demand (unless `out` is provided).
     """
     if spacing is None:
         spacing = np.ones(img.ndim)
-    grad = [sobel(img, axis=i) / spacing[i] for i in range(img.ndim)]
-    return grad
+    if is_lazy(img):
+        grad = _lazy_gradient(img, spacing, dtype if out is None else out.dtype, sigma)
+        if out is None:
+            return grad
+        da.store(grad, out, lock=False)
+        return out
+    if sigma is not None:
+        img = ndimage.gaussian_filter(np.asarray(img, dtype=np.float32), sigma)
+    if out is None:
+        out = allocate_gradient(img.shape, dtype)
+    for i in range(img.ndim):
+        np.divide(sobel(img, axis=i), spacing[i], out=out[i])
+    return out
+
+
+def is_lazy(img):
+    """
+    Check if the image is a lazy array (e.g. dask or zarr), which should not be loaded into memory at once.
+    """
+    return not isinstance(img, np.ndarray) and hasattr(img, 'chunks')
+
+
+def chunk_shape(img):
+    """
+    Shape of the chunks of a lazy array (the largest chunk along each axis), or None for other arrays.
+    """
+    chunks = getattr(img, 'chunks', None)
+    if chunks is None or isinstance(img, np.ndarray):
+        return None
+    return tuple(int(max(c)) if isinstance(c, tuple) else int(c) for c in chunks)
+
+
+def max_intensity(img):
+    """
+    Maximum intensity of the image.
+    For lazy arrays of an integer type, the maximum of the data type is returned, to avoid reading the whole image.
+    """
+    if is_lazy(img) and np.issubdtype(img.dtype, np.integer):
+        return np.iinfo(img.dtype).max
+    return img.max()
+
+
+def mask_bright(img, maxval):
+    """
+    Set the image intensity above `maxval` to zero.
+    Lazy arrays are masked lazily, chunk by chunk, if dask is available.
+    """
+    if is_lazy(img) and da is not None:
+        img = da.asarray(img)
+        return da.where(img > maxval, 0, img)
+    return np.where(img > maxval, 0, img)
+
+
+def _lazy_gradient(img, spacing, dtype, sigma):
+    if da is None:
+        raise ImportError("dask is required to calculate the gradient of lazy images")
+    img = da.asarray(img)
+    sigma = np.zeros(img.ndim) if sigma is None else np.ones(img.ndim) * np.array(sigma)
+    # overlap: Gaussian radius (truncate=4) + 1 for the Sobel kernel; filters use reflection at the image border
+    depth = {i: int(d) for i, d in enumerate(np.int_(4 * sigma + 0.5) + 1)}
+    overlapped = da.overlap.overlap(img, depth, boundary='none')
+    grad = overlapped.map_blocks(_block_gradient, new_axis=0, chunks=((img.ndim,),) + overlapped.chunks,
+                                 dtype=dtype, spacing=spacing, sigma=sigma, grad_dtype=dtype)
+    return da.overlap.trim_internal(grad, {0: 0, **{i + 1: d for i, d in depth.items()}}, boundary='none')
+
+
+def _block_gradient(block, spacing, sigma, grad_dtype):
+    return gradient(np.asarray(block), spacing, dtype=grad_dtype, sigma=sigma)
+
+
+def allocate_gradient(shape, dtype=np.float32, filename=None):
+    """
+    Allocate an array to store the image gradient.
+
+    Parameters
+    ----------
+    shape : tuple
+        Image shape.
+    dtype : data-type, optional
+        Data type to store the gradient, e.g. np.float32 or np.float16.
+    filename : str, optional
+        If provided, the array is memory-mapped to this file (in the .npy format),
+            so that gradients of images larger than the memory can be stored.
+
+    Returns
+    -------
+    np.ndarray:
+        Array of shape 3 x image shape.
+    """
+    shape = (len(shape),) + tuple(shape)
+    if filename is None:
+        return np.empty(shape, dtype=dtype)
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=shape)
 
 
 def snap_to_bright(snake, img=None, grad=None, spacing=None,
                    alpha=0.01, beta=0.1, gamma=1,
-                   n_iter=1000, end_coef=0.01, n_interp=5, **_):
+                   n_iter=1000, end_coef=0.01, n_interp=5, margin=10, evolution='explicit',
+                   n_levels=1, level_iter=100, backend='numpy', tol=0, schedule='linear', return_iterations=False,
+                   **_):
     """
     Snap the annotation to the brightest intensity and regularize the curve based on active contours.
 
@@ -37,9 +155,11 @@ def snap_to_bright(snake, img=None, grad=None, spacing=None,
         N x 3 array of the filament coordinates.
     img : np.ndarray
         3D input image (after smoothing, if applicable)
-    grad : list of np.ndarray
+    grad : np.ndarray, list of np.ndarray, dask.array.Array or TiledGradient
         Image gradients along all three axes.
-        List of length 3, each element having the same shape as the input image.
+        Array of shape 3 x image shape (see `gradient`), list of 3 arrays with the image shape,
+            or a lazy array or gradient provider that computes the gradient on demand
+            (see `utils.tiled.TiledGradient`).
     spacing : tuple, list or array
         Voxel size, (z, y, x).
     alpha : float
@@ -49,20 +169,88 @@ def snap_to_bright(snake, img=None, grad=None, spacing=None,
     gamma : float
         Active contour weight for the image contribution.
     n_iter : int
-        Number of iterations of the active contour.
-        Width of the annotation lines in the viewer.
+        Maximal number of iterations of the active contour.
     end_coef : float
         Coefficient (between 0 and 1) to scale the forces applied to the contour end points.
         Set to 0 to fix the end points.
     n_interp : int
         Number of points to interpolate between each annotated point.
+    margin : int
+        Margin (in voxels) around the filament bounding box, for which the gradient is requested
+            if the gradient is provided by a gradient provider or a lazy array.
+        The filament is kept within this region.
+    evolution : str
+        Active contour evolution mode:
+            "explicit" (gradient descent with a linearly decreasing step, default) or
+            "semi-implicit" (internal forces are solved implicitly; converges in tens of iterations).
+    n_levels : int
+        Number of levels of the gradient pyramid (see `gradient_pyramid`).
+        If greater than 1, the snake is first evolved on the coarse levels, from the coarsest one,
+            and each result is the initial snake for the next level; `n_iter` iterations are done at full resolution.
+        Coarse levels move the snake further per iteration, which widens the capture range.
+    level_iter : int or list of int
+        Number of iterations at each coarse level, from the coarsest one (or the same number for all levels).
+    backend : str
+        Implementation of the explicit evolution (see `BACKENDS`): "numpy" (default) or "numba"
+            (compiled, requires numba); all backends give the same result.
+    tol : float
+        Early stopping tolerance, in voxels: the evolution stops when no point moved by `tol` or more
+            in the last iteration (on each level of the gradient pyramid).
+        Set to 0 to always do `n_iter` iterations.
+    schedule : str
+        Step size schedule:
+            "linear" (the step decreases linearly with each iteration, default) or
+            "adaptive" (the step is halved each time the contour reverses its direction, i.e. oscillates
+            around the filament; combined with `tol`, the evolution stops soon after the contour settles).
+    return_iterations : bool
+        If True, the number of iterations done (on all levels) is returned as well.
 
     Returns
     -------
     np.ndarray
         M x 3 array of regularized filament coordinates.
         M is approximately equal to N * n_interp
+    int
+        Number of iterations done, if `return_iterations` is True.
+
+    """
+    return _run(snap_to_bright_steps(snake, img=img, grad=grad, spacing=spacing, alpha=alpha, beta=beta, gamma=gamma,
+                                     n_iter=n_iter, end_coef=end_coef, n_interp=n_interp, margin=margin,
+                                     evolution=evolution, n_levels=n_levels, level_iter=level_iter,
+                                     backend=backend, tol=tol, schedule=schedule,
+                                     return_iterations=return_iterations))
+
+
+def snap_to_bright_steps(snake, img=None, grad=None, spacing=None,
+                         alpha=0.01, beta=0.1, gamma=1,
+                         n_iter=1000, end_coef=0.01, n_interp=5, margin=10, evolution='explicit',
+                         n_levels=1, level_iter=100, backend='numpy', tol=0, schedule='linear',
+                         return_iterations=False, every=None, **_):
+    """
+    Snap the annotation to the brightest intensity, yielding the intermediate states of the active contour.
+
+    The evolution can be stopped at any time, keeping the last yielded state (e.g. for a live preview).
+
+    Parameters
+    ----------
+    snake, img, grad, spacing, alpha, beta, gamma, n_iter, end_coef, n_interp, margin, evolution, n_levels, level_iter,
+    backend, tol, schedule, return_iterations
+        See `snap_to_bright`.
+    every : int, optional
+        Number of iterations between the yielded states (on each level of the gradient pyramid).
+        If None, only the final state is returned.
 
+    Yields
+    ------
+    np.ndarray
+        M x 3 array of the filament coordinates after every `every` iterations.
+
+    Returns
+    -------
+    np.ndarray
+        M x 3 array of regularized filament coordinates (see `snap_to_bright`).
+    int
+        Number of iterations done, if `return_iterations` is True.
     """
     if spacing is None:
         spacing = np.ones(3)
@@ -74,41 +262,523 @@ def snap_to_bright(snake, img=None, grad=None, spacing=None,
     if not isinstance(snake, np.ndarray) or len(snake.shape) != 2 or snake.shape[1] != 3:
         raise ValueError("Input snake must be a numpy array of shape N x 3")
 
+    if evolution == 'explicit':
+        evolve = get_backend(backend)
+    elif evolution == 'semi-implicit':
+        evolve = _evolve_snake_implicit_steps
+    else:
+        raise ValueError(rf"Unknown evolution mode: {evolution}; must be 'explicit' or 'semi-implicit'")
+    if n_levels > 1:
+        evolve = _multiscale(evolve, n_levels, level_iter)
+
     snake = _interpolate(snake, npoints=n_interp)  # interpolate between the points
-    snake = _evolve_snake(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef)  # evolve the snake
+    if hasattr(grad, 'roi') or is_lazy(grad):  # only compute the gradient around the filament
+        grad, offset = _get_roi(grad, snake, margin)
+    else:
+        offset = np.zeros(3, dtype=int)
+    # evolve the snake
+    steps = evolve(snake - offset, n_iter, grad, spacing, alpha, beta, gamma, end_coef, every=every,
+                   tol=tol, schedule=schedule)
+    snake, iterations = yield from _shifted(steps, 1, offset)
+    if return_iterations:
+        return snake + offset, int(iterations[0])
+    return snake + offset
+
+
+def snap_many(snakes, img=None, grad=None, spacing=None,
+              alpha=0.01, beta=0.1, gamma=1,
+              n_iter=1000, end_coef=0.01, n_interp=5, margin=10, evolution='explicit',
+              n_levels=1, level_iter=100, backend='numpy', tol=0, schedule='linear', return_iterations=False,
+              **_):
+    """
+    Snap several annotations to the brightest intensity at once.
+
+    The snakes are stacked into one array and evolved together, with the forces normalized
+        and the end points handled for each snake separately.
+    The result for each snake is the same as from `snap_to_bright`.
+
+    Parameters
+    ----------
+    snakes : list of np.ndarray
+        List of N x 3 arrays of the filament coordinates; N can differ between filaments.
+    img, grad, spacing, alpha, beta, gamma, n_iter, end_coef, n_interp, margin, evolution, n_levels, level_iter,
+    backend, tol, schedule, return_iterations
+        See `snap_to_bright`.
+        If the gradient is provided by a gradient provider or a lazy array,
+            it is requested for the bounding box of all filaments, plus the margin.
+        Each snake stops when it converges (see `tol`); the evolution stops when all snakes converged.
 
-    return snake
+    Returns
+    -------
+    list of np.ndarray
+        List of regularized filament coordinates.
+    np.ndarray
+        Number of iterations done for each snake, if `return_iterations` is True.
+    """
+    if spacing is None:
+        spacing = np.ones(3)
+    if grad is None:
+        if img is None:
+            raise ValueError("Either image or gradient must be provided!")
+        grad = gradient(img, spacing)
+    if len(snakes) == 0:
+        return ([], np.zeros(0, dtype=int)) if return_iterations else []
+    for snake in snakes:
+        if not isinstance(snake, np.ndarray) or len(snake.shape) != 2 or snake.shape[1] != 3:
+            raise ValueError("Input snakes must be numpy arrays of shape N x 3")
+    if evolution != 'explicit':
+        results = [snap_to_bright(snake, grad=grad, spacing=spacing, alpha=alpha, beta=beta, gamma=gamma,
+                                  n_iter=n_iter, end_coef=end_coef, n_interp=n_interp, margin=margin,
+                                  evolution=evolution, n_levels=n_levels, level_iter=level_iter,
+                                  tol=tol, schedule=schedule, return_iterations=True)
+                   for snake in snakes]
+        snakes = [snake for snake, _ in results]
+        iterations = np.array([it for _, it in results])
+        return (snakes, iterations) if return_iterations else snakes
 
+    snakes = [_interpolate(snake, npoints=n_interp) for snake in snakes]  # interpolate between the points
+    offsets = np.cumsum([0] + [len(snake) for snake in snakes])
+    snake = np.concatenate(snakes)
+    offset = np.zeros(3, dtype=int)
+    if hasattr(grad, 'roi') or is_lazy(grad):  # only compute the gradient around the filaments
+        grad, offset = _get_roi(grad, snake, margin)
+    evolve = get_backend(backend)
+    if n_levels > 1:
+        evolve = _multiscale(evolve, n_levels, level_iter)
+    snake, iterations = _run(evolve(snake - offset, n_iter, grad, spacing, alpha, beta, gamma, end_coef, offsets,
+                                    tol=tol, schedule=schedule))
+    snakes = np.split(snake + offset, offsets[1:-1])
+    return (snakes, iterations) if return_iterations else snakes
 
-def _evolve_snake(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef):
+
+def gradient_pyramid(grad, n_levels, min_size=8):
+    """
+    Gradient pyramid: the gradient downsampled by a factor of 2 at each level.
+
+    Parameters
+    ----------
+    grad : np.ndarray or list of np.ndarray
+        Image gradients along all three axes (see `gradient`).
+    n_levels : int
+        Number of levels, including the full resolution.
+    min_size : int, optional
+        Axes are only downsampled if their size at the next level is at least `min_size` voxels
+            (e.g. the z axis of thin image stacks is kept at full resolution).
+
+    Returns
+    -------
+    list of np.ndarray:
+        Gradient at each level, starting from the full resolution (the input gradient).
+        Each voxel of level l is the mean of the 2 x 2 x 2 (or fewer) voxels of level l-1.
+    list of np.ndarray:
+        Downsampling factor along each axis at each level, relative to the full resolution.
+    """
+    pyramid = [grad]
+    scales = [np.ones(len(grad), dtype=int)]
+    for _ in range(n_levels - 1):
+        factors = np.array([2 if (s + 1) // 2 >= min_size else 1 for s in np.shape(pyramid[-1])[1:]])
+        pyramid.append(_downsample(np.asarray(pyramid[-1]), factors))
+        scales.append(scales[-1] * factors)
+    return pyramid, scales
+
+
+def _downsample(grad, factors):
+    # mean of blocks of the given shape; incomplete blocks are padded with the edge values
+    pad = [(0, 0)] + [(0, -s % f) for s, f in zip(grad.shape[1:], factors)]
+    grad = np.pad(grad, pad, mode='edge')
+    shape = [len(grad)]
+    for s, f in zip(grad.shape[1:], factors):
+        shape += [s // f, f]
+    return np.ascontiguousarray(grad.reshape(shape).mean(axis=(2, 4, 6), dtype=np.float32).astype(grad.dtype))
+
+
+def _multiscale(evolve, n_levels, level_iter):
+    # evolve the snake on the coarse levels of the gradient pyramid first, then at full resolution;
+    # `evolve` is a generator function (see `_evolve_snake_steps`), and so is the result
+    def evolve_multiscale(snake, n_iter, grad, spacing, *args, **kwargs):
+        pyramid, scales = gradient_pyramid(grad, n_levels)
+        spacing = np.ones(3) * np.array(spacing, dtype=float)
+        snake = np.array(snake, dtype=float)
+        iters = np.broadcast_to(level_iter, n_levels - 1)
+        total = 0  # iterations on all levels
+        for level, it in zip(range(n_levels - 1, 0, -1), iters):
+            scale = scales[level]
+            shift = (scale - 1) / 2  # voxel i of the level is centered at scale * i + shift at full resolution
+            steps = evolve((snake - shift) / scale, int(it), pyramid[level], spacing * scale, *args, **kwargs)
+            snake, iterations = yield from _shifted(steps, scale, shift)
+            snake = snake * scale + shift
+            total = total + iterations
+        snake, iterations = yield from evolve(snake, n_iter, grad, spacing, *args, **kwargs)
+        return snake, total + iterations
+
+    return evolve_multiscale
+
+
+def _shifted(steps, scale, shift):
+    # yield the states of an evolution in different coordinates (e.g. of a coarse level at full resolution)
+    while True:
+        try:
+            snake = next(steps)
+        except StopIteration as stop:
+            return stop.value
+        yield snake * scale + shift
+
+
+def _run(steps):
+    # run an evolution to the end, without the intermediate states
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+def roi_bounds(points, margin, shape):
+    """
+    Bounding box of a set of points plus a margin, clipped to the image shape.
+
+    Parameters
+    ----------
+    points : np.ndarray
+        N x 3 array of voxel coordinates.
+    margin : int
+        Margin (in voxels) to add around the bounding box.
+    shape : tuple
+        Image shape.
+
+    Returns
+    -------
+    np.ndarray:
+        Start (inclusive) and end (exclusive) voxel coordinates of the box.
+    """
+    lo = np.maximum(np.int_(np.floor(np.min(points, axis=0))) - margin, 0)
+    hi = np.minimum(np.int_(np.ceil(np.max(points, axis=0))) + margin + 1, shape)
+    return lo, hi
+
+
+def _get_roi(grad, points, margin):
+    # gradient around the points, from a gradient provider or a lazy gradient array
+    if hasattr(grad, 'roi'):
+        return grad.roi(points, margin)
+    lo, hi = roi_bounds(points, margin, grad.shape[1:])
+    return np.asarray(grad[(slice(None),) + tuple(slice(a, b) for a, b in zip(lo, hi))]), lo
+
+
+def _evolve_snake(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef, offsets=None):
+    return _run(_evolve_snake_steps(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef, offsets))[0]
+
+
+def _evolve_snake_steps(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef, offsets=None, every=None,
+                        tol=0, schedule='linear'):
+    # several snakes can be evolved at once: they are stacked in `snake` and start at `offsets[:-1]`;
+    # the state is yielded after every `every` iterations, and the final state is returned
+    # together with the number of iterations done for each snake (see `_Convergence`)
+    shape = np.array(grad[0].shape)
+    if offsets is None:
+        offsets = [0, len(snake)]
+    offsets = np.array(offsets)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
     coef = np.ones_like(snake)  # coefficient to weight end points vs all other points
-    coef[0] = end_coef
-    coef[-1] = end_coef
+    coef[starts] = end_coef
+    coef[offsets[1:] - 1] = end_coef
+    coef = coef.astype(float)
     c = np.arange(1, n_iter + 1)[::-1] / n_iter  # weight for each iteration; linearly decrease with each iteration
+
+    # make sure snake coordinates are not outside image
+    snake = _fit_to_image_shape(np.array(snake, dtype=float), shape)
+
+    # index of the snake for each point, and indices to pad each snake by reflecting 2 points at each end
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    pad_index, inner = _get_padding(offsets)
+
+    # work buffers, reused in all iterations
+    n = len(snake)
+    strides = np.array([np.prod(shape[i + 1:]) for i in range(len(shape))], dtype=np.intp)
+    rounded = np.empty_like(snake)
+    coord = np.empty(snake.shape, dtype=np.intp)
+    index = np.empty(n, dtype=np.intp)
+    gathered = np.empty((len(shape), n), dtype=grad[0].dtype)
+    fimg = np.empty(snake.shape, dtype=grad[0].dtype)
+    fimg_max = np.empty(n, dtype=grad[0].dtype)
+    fimg_norm = np.empty(len(lengths), dtype=grad[0].dtype)
+    scaled = np.empty_like(snake)
+    padded = np.empty((len(pad_index), snake.shape[1]))
+    d2_padded = np.empty((len(pad_index) - 4, snake.shape[1]))
+    d4_padded = np.empty_like(d2_padded)
+    tmp_padded = np.empty_like(d2_padded)
+    d2 = np.empty_like(snake)
+    d4 = np.empty_like(snake)
+    fsnake = np.empty_like(snake)
+    fsnake_max = np.empty(n)
+    fsnake_norm = np.empty(len(lengths))
+    tmp = np.empty_like(snake)
+    convergence = _Convergence(snake, offsets, tol, schedule)
+
     for it in range(n_iter):
-        coord = tuple(np.int_(np.round_(snake)).transpose())
+        # gather the gradient at the current (rounded) coordinates
+        np.rint(snake, out=rounded)
+        np.copyto(coord, rounded, casting='unsafe')
+        np.dot(coord, strides, out=index)
+        _gather(grad, index, gathered)
 
         # normalize image force, based on the gradient at the current coordinate
-        fimg = np.array([grad[i][coord] for i in range(len(grad))])
-        fimg = - fimg.transpose()
-        fimg = fimg / fimg.max()
+        np.negative(gathered.transpose(), out=fimg)
+        _normalize(fimg, starts, segment, fimg_max, fimg_norm)
 
         # normalized snake (internal) force
-        d2, d4 = _get_derivatives_2_4(snake * spacing)
-        fsnake = d2 * alpha + d4 * beta
-        fsnake = fsnake / np.max(fsnake)
+        np.multiply(snake, spacing, out=scaled)
+        np.take(scaled, pad_index, axis=0, out=padded)
+        _get_derivatives_2_4(padded, d2_padded, d4_padded, tmp_padded)
+        np.take(d2_padded, inner, axis=0, out=d2)
+        np.take(d4_padded, inner, axis=0, out=d4)
+        np.multiply(d2, alpha, out=fsnake)
+        np.multiply(d4, beta, out=tmp)
+        fsnake += tmp
+        _normalize(fsnake, starts, segment, fsnake_max, fsnake_norm)
 
-        # update the snake with the final force
-        snake = snake - c[it] * coef * (fimg * gamma + fsnake) / (gamma + 1)
+        # update the snake with the final force, weighting the image force in float64
+        np.copyto(tmp, fimg)
+        tmp *= gamma
+        tmp += fsnake
+        if convergence.adaptive:
+            np.multiply(coef, convergence.weight[segment][:, None], out=d2)
+        else:
+            np.multiply(c[it], coef, out=d2)
+        tmp *= d2
+        tmp /= gamma + 1
+        convergence.start(snake)
+        snake -= tmp
         # make sure snake coordinates are not outside image
-        snake = _fit_to_image_shape(snake, grad[0].shape)
-    return snake
+        _fit_to_image_shape(snake, shape, out=snake)
+        if convergence.update(snake):
+            break
+        if every and (it + 1) % every == 0 and it + 1 < n_iter:
+            yield snake.copy()
+    return snake, convergence.iterations
+
+
+class _Convergence:
+    # early stopping and adaptive step size of the active contour evolution, for each of the stacked snakes
+    #   tol: a snake is converged (and not moved anymore) when none of its points moved by `tol` voxels
+    #       or more in the last iteration; 0 to always do all iterations
+    #   schedule: "linear" (the step weight decreases linearly from 1 to 1 / n_iter) or
+    #       "adaptive" (the step weight starts at 1 and is halved each time the snake reverses its direction,
+    #       i.e. when it oscillates around the filament)
+    def __init__(self, snake, offsets, tol, schedule):
+        if schedule not in ('linear', 'adaptive'):
+            raise ValueError(rf"Unknown step schedule: {schedule}; must be 'linear' or 'adaptive'")
+        self.tol = tol
+        self.adaptive = schedule == 'adaptive'
+        self.starts = np.array(offsets[:-1])
+        self.segment = np.repeat(np.arange(len(self.starts)), np.diff(offsets))
+        self.weight = np.ones(len(self.starts))  # step weight of each snake (adaptive schedule)
+        self.iterations = np.zeros(len(self.starts), dtype=int)
+        self.moving = np.ones(len(self.starts), dtype=bool)
+        self.track = tol > 0 or self.adaptive
+        if self.track:
+            self.previous = np.empty_like(snake)
+            self.delta = np.zeros_like(snake)
+            self.last = np.zeros_like(snake)
+            self.tmp = np.empty_like(snake)
+            self.row = np.empty(len(snake))
+
+    def start(self, snake):
+        # keep the coordinates before the iteration
+        if self.track:
+            np.copyto(self.previous, snake)
 
+    def update(self, snake):
+        # count the iteration, restore the converged snakes and update the step weights;
+        # return True if all snakes are converged
+        self.iterations[self.moving] += 1
+        if not self.track:
+            return False
+        np.subtract(snake, self.previous, out=self.delta)
+        if not self.moving.all():
+            frozen = ~self.moving[self.segment]
+            np.copyto(snake, self.previous, where=frozen[:, None])
+            self.delta[frozen] = 0
+        if self.adaptive:
+            # the sums are accumulated in the order of the points, as in `jit.evolve_snake`
+            np.multiply(self.delta, self.last, out=self.tmp)
+            reverse = np.bincount(self.segment, _sum_coordinates(self.tmp, self.row),
+                                  minlength=len(self.starts)) < 0
+            self.weight[reverse] *= 0.5
+            np.copyto(self.last, self.delta)
+        if self.tol > 0:
+            np.multiply(self.delta, self.delta, out=self.tmp)
+            moved = np.maximum.reduceat(_sum_coordinates(self.tmp, self.row), self.starts)
+            self.moving &= moved >= self.tol ** 2
+            return not self.moving.any()
+        return False
 
-def _fit_to_image_shape(snake, shape):
-    shape = np.array(shape) - 1
-    snake = np.array([np.max([[0, 0, 0], np.min([shape, snake[i]], axis=0)], axis=0) for i in range(len(snake))])
-    return snake
+
+def _sum_coordinates(x, out):
+    # sum of the 3 coordinates of each point, in a fixed order
+    np.add(x[:, 0], x[:, 1], out=out)
+    out += x[:, 2]
+    return out
+
+
+def _evolve_snake_jit_steps(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef, offsets=None, every=None,
+                            tol=0, schedule='linear'):
+    # same as `_evolve_snake_steps`, with the iterations compiled by numba (see `jit.evolve_snake`)
+    grad = np.asarray(grad)
+    if grad.dtype == np.float16:  # not supported by numba
+        return (yield from _evolve_snake_steps(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef,
+                                               offsets, every=every, tol=tol, schedule=schedule))
+    shape = np.array(grad.shape[1:])
+    if offsets is None:
+        offsets = [0, len(snake)]
+    offsets = np.array(offsets)
+    coef = np.ones_like(snake)  # coefficient to weight end points vs all other points
+    coef[offsets[:-1]] = end_coef
+    coef[offsets[1:] - 1] = end_coef
+    coef = coef.astype(float)
+    c = np.arange(1, n_iter + 1)[::-1] / n_iter  # weight for each iteration; linearly decrease with each iteration
+    snake = _fit_to_image_shape(np.array(snake, dtype=float), shape)
+    convergence = _Convergence(snake, offsets, tol, schedule)
+
+    # indices of the 2 neighbours on each side of each point, reflected at the snake ends
+    pad_index, inner = _get_padding(offsets)
+    neighbours = pad_index[inner[:, None] + np.arange(5)]
+    strides = np.array([np.prod(shape[i + 1:]) for i in range(len(shape))], dtype=np.intp)
+    args = (grad.reshape(len(grad), -1), strides, np.float64(shape - 1), np.ones(3) * np.array(spacing, dtype=float),
+            float(alpha), float(beta), float(gamma), coef, neighbours,
+            offsets[:-1], offsets[1:], float(tol), convergence.adaptive, convergence.weight, np.zeros_like(snake),
+            convergence.iterations, convergence.moving)
+
+    every = every or max(n_iter, 1)
+    for start in range(0, n_iter, every):
+        jit.evolve_snake(snake, c[start:start + every], *args)
+        if not convergence.moving.any():
+            break
+        if start + every < n_iter:
+            yield snake.copy()
+    return snake, convergence.iterations
+
+
+BACKENDS = {'numpy': _evolve_snake_steps}  # implementations of the explicit evolution
+if jit is not None:
+    BACKENDS['numba'] = _evolve_snake_jit_steps
+
+
+def register_backend(name, evolve_steps):
+    """
+    Register an implementation of the explicit active contour evolution.
+
+    Parameters
+    ----------
+    name : str
+        Backend name, as passed to `snap_to_bright` and `snap_many`.
+    evolve_steps : callable
+        Generator function with the signature and results of `_evolve_snake_steps`:
+            yields the intermediate states, and returns the final state and the number of iterations of each snake.
+    """
+    BACKENDS[name] = evolve_steps
+
+
+def get_backend(name):
+    """
+    Implementation of the explicit active contour evolution registered as `name` (see `BACKENDS`).
+    """
+    if name not in BACKENDS:
+        if name == 'numba':
+            raise ValueError("The 'numba' backend requires numba to be installed")
+        raise ValueError(rf"Unknown backend: {name}; must be one of {list(BACKENDS)}")
+    return BACKENDS[name]
+
+
+def _normalize(force, starts, segment, row_max, norm):
+    # divide the force of each snake by its maximum
+    if len(starts) == 1:
+        force /= force.max()
+    else:
+        np.max(force, axis=1, out=row_max)
+        np.maximum.reduceat(row_max, starts, out=norm)
+        np.take(norm, segment, out=row_max)
+        force /= row_max[:, None]
+
+
+def _get_padding(offsets):
+    # indices to pad each snake with 2 reflected points at each end: x2, x1, x0, ..., x[n-1], x[n-2], x[n-3]
+    # and the positions of the original points in the derivatives computed from the padded array
+    pad_index = []
+    inner = []
+    for i in range(len(offsets) - 1):
+        n = offsets[i + 1] - offsets[i]
+        pad_index.append(offsets[i] + np.concatenate([[2, 1], np.arange(n), [n - 2, n - 3]]))
+        inner.append(offsets[i] + 4 * i + np.arange(n))
+    return np.concatenate(pad_index), np.concatenate(inner)
+
+
+def _evolve_snake_implicit(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef):
+    return _run(_evolve_snake_implicit_steps(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef))[0]
+
+
+def _evolve_snake_implicit_steps(snake, n_iter, grad, spacing, alpha, beta, gamma, end_coef, every=None,
+                                 tol=0, schedule='linear'):
+    # semi-implicit update: (I + coef * A) x_new = x + coef * f_image, where A is the internal energy matrix
+    # coordinates are scaled to isotropic units of the smallest voxel size
+    shape = np.array(grad[0].shape)
+    spacing = np.array(spacing, dtype=float)
+    scale = spacing / spacing.min()
+    coef = np.ones(len(snake))  # coefficient to weight end points vs all other points
+    coef[0] = end_coef
+    coef[-1] = end_coef
+    c = np.arange(1, n_iter + 1)[::-1] / n_iter  # weight for each iteration; linearly decrease with each iteration
+
+    # factorize the pentadiagonal system once
+    internal = _internal_energy_matrix(len(snake), alpha, beta)
+    lu = splu((sparse.identity(len(snake)) + sparse.diags(coef) @ internal).tocsc())
+
+    snake = _fit_to_image_shape(np.array(snake, dtype=float), shape)
+    strides = np.array([np.prod(shape[i + 1:]) for i in range(len(shape))], dtype=np.intp)
+    gathered = np.empty((len(shape), len(snake)), dtype=grad[0].dtype)
+    convergence = _Convergence(snake, [0, len(snake)], tol, schedule)
+    for it in range(n_iter):
+        _gather(grad, np.dot(np.int_(np.rint(snake)), strides), gathered)
+        fimg = gathered.transpose().astype(float)
+        fimg = fimg / np.abs(fimg).max()
+        weight = convergence.weight[0] if convergence.adaptive else c[it]
+        rhs = snake * scale + weight * coef[:, None] * fimg * gamma / (gamma + 1)
+        convergence.start(snake)
+        snake = _fit_to_image_shape(lu.solve(rhs) / scale, shape)
+        if convergence.update(snake):
+            break
+        if every and (it + 1) % every == 0 and it + 1 < n_iter:
+            yield snake
+    return snake, convergence.iterations
+
+
+def _internal_energy_matrix(n, alpha, beta):
+    # -alpha * d2 + beta * d4 as a banded matrix, with the end points reflected as in `_get_derivatives_2_4`
+    stencil = {-2: beta, -1: -alpha - 4 * beta, 0: 2 * alpha + 6 * beta, 1: -alpha - 4 * beta, 2: beta}
+    rows = []
+    cols = []
+    values = []
+    for offset, value in stencil.items():
+        i = np.arange(n)
+        j = np.abs(i + offset)  # reflect at the start
+        j = np.where(j > n - 1, 2 * (n - 1) - j, j)  # reflect at the end
+        rows.append(i)
+        cols.append(j)
+        values.append(np.full(n, value, dtype=float))
+    return sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
+
+
+def _gather(grad, index, out):
+    # gather all gradient components at the flat voxel indices
+    if isinstance(grad, np.ndarray) and grad.flags.c_contiguous:
+        np.take(grad.reshape(len(grad), -1), index, axis=1, out=out)
+    else:
+        for i in range(len(grad)):
+            out[i] = grad[i].reshape(-1)[index]
+
+
+def _fit_to_image_shape(snake, shape, out=None):
+    return np.clip(snake, 0, np.array(shape) - 1, out=out)
 
 
 def _interpolate(x, npoints=5):
@@ -150,8 +820,17 @@ def _get_derivatives_1_2(x):
     return d1[2:-2], d2[2:-2]
 
 
-def _get_derivatives_2_4(x):
-    x = np.concatenate([x[1:3][::-1], x, x[-3:-1][::-1]])
-    d2 = np.roll(x, 1, 0) + np.roll(x, -1, 0) - 2 * x
-    d4 = np.roll(x, 2, 0) - 4 * np.roll(x, 1, 0) + 6 * x - 4 * np.roll(x, -1, 0) + np.roll(x, -2, 0)
-    return d2[2:-2], d4[2:-2]
+def _get_derivatives_2_4(padded, d2, d4, tmp):
+    # second and fourth derivatives from the stencils [1, -2, 1] and [1, -4, 6, -4, 1]
+    # computed for rows 2 to -2 of the padded coordinates
+    np.add(padded[1:-3], padded[3:-1], out=d2)
+    np.multiply(padded[2:-2], 2, out=tmp)
+    d2 -= tmp
+    np.multiply(padded[1:-3], 4, out=tmp)
+    np.subtract(padded[:-4], tmp, out=d4)
+    np.multiply(padded[2:-2], 6, out=tmp)
+    d4 += tmp
+    np.multiply(padded[3:-1], 4, out=tmp)
+    d4 -= tmp
+    d4 += padded[4:]
+    return d2, d4
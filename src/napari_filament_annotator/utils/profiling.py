@@ -0,0 +1,125 @@
+import contextlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class Profiler:
+    """
+    Timing of the annotation stages and counters of the work done (e.g. tetragon pairs, iterations).
+
+    Each stage is timed with the `stage` context manager; all measurements of the session are kept
+        to report the latency percentiles, and the measurements since the last `summary` are shown as
+        the latest breakdown.
+    If disabled, the stages are not timed and the counters are not updated.
+    Stages can be recorded from worker threads (e.g. background refinement).
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether to record the measurements.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.times = OrderedDict()  # stage: list of durations, in seconds
+        self.counts = OrderedDict()  # counter: total value
+        self._latest = OrderedDict()  # stages and counters since the last summary
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        Context manager to time a stage.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        """
+        Record the duration of a stage that was timed elsewhere.
+        """
+        if self.enabled:
+            with self._lock:
+                self.times.setdefault(name, []).append(seconds)
+                self._latest[name] = self._latest.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        """
+        Increase a counter by `n`.
+        """
+        if self.enabled:
+            with self._lock:
+                self.counts[name] = self.counts.get(name, 0) + int(n)
+                self._latest[name] = self._latest.get(name, 0) + int(n)
+
+    def summary(self):
+        """
+        Breakdown of the stages and counters since the last summary, as a single line.
+
+        Returns
+        -------
+        str:
+            E.g. "polygon_intersection: 3.1 ms, snap_to_bright: 80.4 ms, tetragon_pairs: 25".
+        """
+        with self._lock:
+            latest = list(self._latest.items())
+            self._latest.clear()
+        items = []
+        for name, value in latest:
+            if name in self.times:
+                items.append(rf"{name}: {value * 1000:.1f} ms")
+            else:
+                items.append(rf"{name}: {value}")
+        return ', '.join(items)
+
+    def report(self, **info):
+        """
+        Aggregates of the session: number of calls and latencies of each stage, and counter totals.
+
+        Parameters
+        ----------
+        info : dict
+            Additional values to report, e.g. the gradient memory footprint.
+
+        Returns
+        -------
+        dict:
+            Json-serializable report; latencies are in milliseconds.
+        """
+        with self._lock:
+            stage_times = [(name, list(values)) for name, values in self.times.items()]
+            counts = dict(self.counts)
+        stages = OrderedDict()
+        for name, times in stage_times:
+            times = np.array(times) * 1000
+            stages[name] = dict(count=len(times),
+                                total_ms=float(times.sum()),
+                                mean_ms=float(times.mean()),
+                                p50_ms=float(np.percentile(times, 50)),
+                                p95_ms=float(np.percentile(times, 95)),
+                                max_ms=float(times.max()))
+        return dict(stages=stages, counts=counts, **info)
+
+    def save(self, filename, **info):
+        """
+        Save the session report (see `report`) to a json file.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.report(**info), f, indent=4)
@@ -0,0 +1,249 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+
+class FilamentIndex:
+    """
+    Spatial index over the vertices of annotated filaments, to find the nearest filament to a point
+        and filaments that duplicate each other.
+
+    The vertices are kept in a KD-tree, which is rebuilt lazily: filaments added or edited since the last rebuild
+        are kept in a small separate tree, and the vertices of deleted or edited filaments are marked as outdated,
+        until these changes exceed `rebuild_fraction` of the indexed vertices.
+
+    Parameters
+    ----------
+    spacing : tuple, list or array, optional
+        Voxel size, (z, y, x); distances are measured in these units.
+    step : float, optional
+        If provided, the filaments are resampled so that the vertices are at most `step` apart (in `spacing` units),
+            and the distance to the nearest vertex approximates the distance to the filament within `step` / 2.
+    rebuild_fraction : float, optional
+        Fraction of recently changed vertices at which the KD-tree is rebuilt.
+    """
+
+    def __init__(self, spacing=None, step=None, rebuild_fraction=0.1):
+        self.spacing = np.ones(3) if spacing is None else np.array(spacing, dtype=float)[-3:]
+        self.step = step
+        self.rebuild_fraction = rebuild_fraction
+        self.filaments = {}  # filament key: scaled vertices
+        self._main = _Tree()  # filaments indexed at the last rebuild
+        self._ranges = {}  # filament key: range of its vertices in the main tree
+        self._pending = {}  # filaments added or edited after the last rebuild
+        self._recent = None  # tree of the pending filaments, built on demand
+        self._n_changed = 0  # vertices added, edited or deleted after the last rebuild
+
+    def __len__(self):
+        return len(self.filaments)
+
+    def add(self, key, points):
+        """
+        Add a filament, or replace the vertices of an existing one.
+
+        Parameters
+        ----------
+        key : int
+            Filament key (non-negative), e.g. its index in the list of filaments.
+        points : np.ndarray
+            N x 3 array of the filament coordinates, in voxels.
+        """
+        self._add(key, points)
+        self._maybe_rebuild()
+
+    def add_many(self, keys, filaments):
+        """
+        Add many filaments at once (e.g. loaded from a file), rebuilding the KD-tree at most once.
+
+        Parameters
+        ----------
+        keys : list of int
+            Filament keys.
+        filaments : list
+            List of filaments, each of shape N x 3.
+        """
+        for key, points in zip(keys, filaments):
+            self._add(key, points)
+        self._maybe_rebuild()
+
+    def remove(self, key):
+        """
+        Remove a filament; missing keys are ignored.
+        """
+        self._remove(key)
+        self._maybe_rebuild()
+
+    def _add(self, key, points):
+        key = int(key)
+        self._remove(key)
+        vertices = np.asarray(points, dtype=float)[:, -3:] * self.spacing
+        if self.step is not None:
+            vertices = _densify(vertices, self.step)
+        self.filaments[key] = vertices
+        self._pending[key] = vertices
+        self._recent = None
+        self._n_changed += len(vertices)
+
+    def _remove(self, key):
+        key = int(key)
+        if key not in self.filaments:
+            return
+        vertices = self.filaments.pop(key)
+        if key in self._pending:
+            self._pending.pop(key)
+            self._recent = None
+        else:
+            self._main.valid[slice(*self._ranges.pop(key))] = False
+        self._n_changed += len(vertices)
+
+    def clear(self):
+        self.__init__(self.spacing, self.step, self.rebuild_fraction)
+
+    def rebuild(self):
+        """
+        Rebuild the KD-tree from all current filaments.
+        """
+        self._main = _Tree(self.filaments)
+        stops = np.cumsum([len(v) for v in self.filaments.values()])
+        self._ranges = {key: (stop - len(v), stop) for (key, v), stop in zip(self.filaments.items(), stops)}
+        self._pending = {}
+        self._recent = None
+        self._n_changed = 0
+
+    def nearest(self, points):
+        """
+        Find the nearest filament to each of the given points.
+
+        Parameters
+        ----------
+        points : np.ndarray
+            M x 3 array of coordinates (or a single point), in voxels.
+
+        Returns
+        -------
+        np.ndarray:
+            Key of the nearest filament for each point (-1 if the index is empty).
+        np.ndarray:
+            Distance to the nearest filament vertex, in `spacing` units (inf if the index is empty).
+        """
+        points = np.asarray(points, dtype=float)
+        single = points.ndim == 1
+        points = np.atleast_2d(points)[:, -3:] * self.spacing
+        keys, dist = self._main.nearest(points)
+        if len(self._pending) > 0:
+            if self._recent is None:
+                self._recent = _Tree(self._pending)
+            recent_keys, recent_dist = self._recent.nearest(points)
+            closer = recent_dist < dist
+            keys[closer] = recent_keys[closer]
+            dist[closer] = recent_dist[closer]
+        if single:
+            return keys[0], dist[0]
+        return keys, dist
+
+    def duplicates(self, tolerance, min_overlap=0.8, chunk_size=2 ** 14):
+        """
+        Report pairs of filaments that overlap within a distance tolerance.
+
+        A filament overlaps another one by the fraction of its vertices that are closer than `tolerance`
+            to a vertex of the other filament.
+        The vertices should be sampled more densely than the tolerance (see `step`).
+
+        Parameters
+        ----------
+        tolerance : float
+            Distance tolerance, in `spacing` units.
+        min_overlap : float, optional
+            Minimal overlap to report a pair of filaments.
+        chunk_size : int, optional
+            Number of vertices queried at once, to limit the memory usage.
+
+        Returns
+        -------
+        pd.DataFrame:
+            Table with the keys of the overlapping filament ('filament') and of the filament it overlaps
+                ('other'), and the overlap fraction ('overlap'); sorted by decreasing overlap.
+        """
+        self.rebuild()
+        report = pd.DataFrame({'filament': np.zeros(0, dtype=np.int64), 'other': np.zeros(0, dtype=np.int64),
+                               'overlap': np.zeros(0)})
+        tree, vertex_keys = self._main.tree, self._main.keys
+        n = len(vertex_keys)
+        if n == 0:
+            return report
+        nkeys = vertex_keys.max() + 1
+        codes = []  # (vertex, other filament) pairs, encoded as vertex * nkeys + other
+        for start in range(0, n, chunk_size):
+            # all vertices within the tolerance, however many of them belong to the same filament
+            neighbours = tree.query_ball_point(tree.data[start:start + chunk_size], tolerance)
+            counts = np.fromiter(map(len, neighbours), dtype=np.intp, count=len(neighbours))
+            ind = np.fromiter(itertools.chain.from_iterable(neighbours), dtype=np.intp, count=counts.sum())
+            vertex = np.repeat(np.arange(start, start + len(neighbours)), counts)
+            other = vertex_keys[ind]
+            different = other != vertex_keys[vertex]
+            # each vertex is counted once per overlapping filament
+            codes.append(np.unique(vertex[different] * nkeys + other[different]))
+        codes = np.concatenate(codes)
+        if len(codes) == 0:
+            return report
+        pairs, counts = np.unique(vertex_keys[codes // nkeys] * nkeys + codes % nkeys, return_counts=True)
+        filament, other = pairs // nkeys, pairs % nkeys
+        overlap = counts / np.bincount(vertex_keys, minlength=nkeys)[filament]
+        report = pd.DataFrame({'filament': filament, 'other': other, 'overlap': overlap})
+        report = report[report['overlap'] >= min_overlap]
+        return report.sort_values('overlap', ascending=False, kind='stable').reset_index(drop=True)
+
+    def _maybe_rebuild(self):
+        if self._n_changed > self.rebuild_fraction * max(len(self._main.keys), 1000):
+            self.rebuild()
+
+
+class _Tree:
+    # KD-tree over the vertices of a set of filaments, with a mask of the vertices that are still valid
+    def __init__(self, filaments=None):
+        filaments = {} if filaments is None else filaments
+        self.keys = np.zeros(0, dtype=np.int64)  # filament key of each vertex
+        self.tree = None
+        if len(filaments) > 0:
+            self.keys = np.repeat(np.array(list(filaments.keys()), dtype=np.int64),
+                                  [len(v) for v in filaments.values()])
+            self.tree = cKDTree(np.concatenate(list(filaments.values())))
+        self.valid = np.ones(len(self.keys), dtype=bool)
+
+    def nearest(self, points):
+        # nearest valid vertex; the number of neighbours is increased until a valid one is found
+        n = len(self.keys)
+        keys = np.full(len(points), -1, dtype=np.int64)
+        dist = np.full(len(points), np.inf)
+        todo = np.arange(len(points))
+        k = 1
+        while n > 0 and len(todo) > 0:
+            k = min(k, n)
+            d, ind = self.tree.query(points[todo], k=k)
+            d = d.reshape(len(todo), k)
+            ind = ind.reshape(len(todo), k)
+            valid = self.valid[ind]
+            found = valid.any(1)
+            rows = np.nonzero(found)[0]
+            first = valid[rows].argmax(1)
+            keys[todo[rows]] = self.keys[ind[rows, first]]
+            dist[todo[rows]] = d[rows, first]
+            if k == n:
+                break
+            todo = todo[~found]
+            k *= 4
+        return keys, dist
+
+
+def _densify(points, step):
+    # add vertices along the segments, so that the vertices are at most `step` apart
+    if len(points) < 2:
+        return points
+    lengths = np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1))
+    n = np.maximum(np.int_(np.ceil(lengths / step)), 1)
+    segment = np.repeat(np.arange(len(n)), n)
+    t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / n[segment]
+    dense = points[segment] + t[:, np.newaxis] * (points[segment + 1] - points[segment])
+    return np.concatenate([dense, points[-1:]])
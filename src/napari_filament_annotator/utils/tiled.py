@@ -0,0 +1,228 @@
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy import ndimage
+
+from .postproc import gradient, chunk_shape, roi_bounds, is_lazy
+
+
+class TiledGradient:
+    """
+    Gradient of a smoothed image, computed on demand for image tiles.
+
+    The image is split into tiles of a fixed shape.
+    The Gaussian smoothing and the Sobel gradient are calculated only for the tiles that are requested,
+        using a halo around each tile to reproduce the result of filtering the full image.
+    Computed tiles are kept in an LRU cache, limited by a memory budget.
+    The image can be a lazy array (e.g. dask or zarr): only the chunks overlapping the requested tiles are loaded.
+    Optionally, computed tiles are also written to a full-size gradient array (e.g. memory-mapped to disk),
+        from which they are read back instead of being computed again after they leave the cache.
+
+    Parameters
+    ----------
+    img : array-like
+        Input 3D image.
+    sigma : float, tuple, list or array, optional
+        Gaussian sigma (in voxels) to smooth the image, per axis.
+    spacing : tuple, list or array, optional
+        Voxel size, (z, y, x).
+    tile_shape : tuple, optional
+        Shape of the tiles, in voxels.
+        Default is (32, 128, 128), enlarged to a multiple of the chunk shape for lazy arrays.
+    max_bytes : int, optional
+        Memory budget of the tile cache, in bytes.
+    dtype : data-type, optional
+        Data type to store the gradient, e.g. np.float32 or np.float16.
+    store : np.ndarray, optional
+        Array of shape 3 x image shape to keep all computed tiles (see `postproc.allocate_gradient`).
+    maxval : float, optional
+        If provided, voxels brighter than `maxval` are masked out: the gradient is set to zero
+            wherever the filters reach a masked voxel.
+        Masking is applied to the requested regions only, so `maxval` can be changed without recomputing the tiles.
+    """
+
+    def __init__(self, img, sigma=None, spacing=None, tile_shape=None, max_bytes=2 ** 30,
+                 dtype=np.float32, store=None, maxval=None):
+        self.img = img
+        self.shape = tuple(img.shape)
+        ndim = len(self.shape)
+        if tile_shape is None:
+            tile_shape = _default_tile_shape(img)
+        self.sigma = np.zeros(ndim) if sigma is None else np.ones(ndim) * np.array(sigma)
+        self.spacing = np.ones(ndim) if spacing is None else np.array(spacing)
+        self.tile_shape = np.array(tile_shape[-ndim:])
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.store = None
+        self.maxval = maxval
+        # halo needed to reproduce the full-image filters: Gaussian radius (truncate=4) + 1 for the Sobel kernel
+        self.halo = np.int_(4 * self.sigma + 0.5) + 1
+        self.ntiles = tuple(np.int_(np.ceil(np.array(self.shape) / self.tile_shape)))
+        self.computed = np.zeros(self.ntiles, dtype=bool)  # tiles written to the store
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()  # tiles may be requested from a worker thread
+        self.nbytes = 0
+        if store is not None:
+            self.set_store(store)
+
+    def set_store(self, store, computed=None):
+        """
+        Keep all computed tiles in a full-size gradient array.
+
+        Parameters
+        ----------
+        store : np.ndarray
+            Array of shape 3 x image shape, e.g. memory-mapped to disk.
+        computed : np.ndarray, optional
+            Mask of the tiles that are already in the store (e.g. from a previous session).
+        """
+        with self._lock:
+            self.store = store
+            self.dtype = store.dtype
+            self.computed = np.zeros(self.ntiles, dtype=bool) if computed is None else computed
+            for index, grad in self._cache.items():  # keep the tiles computed so far
+                if not self.computed[index]:
+                    store[self._tile_slices(index)] = grad
+                    self.computed[index] = True
+
+    def tile(self, index):
+        """
+        Return the gradient of one tile, computing it if it is not cached.
+
+        Parameters
+        ----------
+        index : tuple
+            Tile index along each axis.
+
+        Returns
+        -------
+        np.ndarray:
+            Gradient of shape 3 x tile shape (smaller at the image border).
+        """
+        index = tuple(index)
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+            if self.computed[index]:
+                grad = np.array(self.store[self._tile_slices(index)])
+            else:
+                grad = self._compute_tile(index)
+                if self.store is not None:
+                    self.store[self._tile_slices(index)] = grad
+                    self.computed[index] = True
+            self._cache[index] = grad
+            self.nbytes += grad.nbytes
+            while self.nbytes > self.max_bytes and len(self._cache) > 1:
+                _, old = self._cache.popitem(last=False)
+                self.nbytes -= old.nbytes
+            return grad
+
+    def precompute(self):
+        """
+        Compute the gradient tiles in advance, as many as fit into the memory budget.
+        All tiles are computed if they are kept in a store, unless the image is lazy
+            (which may be too large to be read in full).
+
+        Yields
+        ------
+        tuple:
+            Number of computed tiles and the total number of tiles to compute.
+        """
+        tile_bytes = len(self.shape) * np.prod(self.tile_shape) * self.dtype.itemsize
+        indices = list(itertools.product(*[range(n) for n in self.ntiles]))
+        if self.store is None or is_lazy(self.img):  # otherwise, all tiles are kept in the store
+            indices = indices[:max(int(self.max_bytes // tile_bytes), 1)]
+        for i, index in enumerate(indices):
+            if not self.computed[index]:
+                self.tile(index)
+            yield i + 1, len(indices)
+
+    def region(self, lo, hi):
+        """
+        Gradient for a box of the image.
+
+        Parameters
+        ----------
+        lo, hi : tuple, list or array
+            Start (inclusive) and end (exclusive) voxel coordinates of the box.
+
+        Returns
+        -------
+        np.ndarray:
+            Gradient of shape 3 x (hi - lo).
+        """
+        lo = np.maximum(np.int_(lo), 0)
+        hi = np.minimum(np.int_(hi), self.shape)
+        out = np.empty((len(self.shape),) + tuple(hi - lo), dtype=self.dtype)
+        first = lo // self.tile_shape
+        last = (hi - 1) // self.tile_shape
+        for index in itertools.product(*[range(f, l + 1) for f, l in zip(first, last)]):
+            tlo = np.array(index) * self.tile_shape
+            grad = self.tile(index)
+            src_lo = np.maximum(lo, tlo)
+            src_hi = np.minimum(hi, tlo + grad.shape[1:])
+            src = (slice(None),) + tuple(slice(a, b) for a, b in zip(src_lo - tlo, src_hi - tlo))
+            dst = (slice(None),) + tuple(slice(a, b) for a, b in zip(src_lo - lo, src_hi - lo))
+            out[dst] = grad[src]
+        if self.maxval is not None:
+            out[:, self._masked(lo, hi)] = 0
+        return out
+
+    def roi(self, points, margin=10):
+        """
+        Gradient for the bounding box of a set of points plus a margin.
+
+        Parameters
+        ----------
+        points : np.ndarray
+            N x 3 array of voxel coordinates.
+        margin : int, optional
+            Margin (in voxels) to add around the bounding box.
+
+        Returns
+        -------
+        np.ndarray:
+            Gradient of the region, of shape 3 x region shape.
+        np.ndarray:
+            Coordinates of the region start, to convert between image and region coordinates.
+        """
+        lo, hi = roi_bounds(points, margin, self.shape)
+        return self.region(lo, hi), lo
+
+    def _tile_slices(self, index):
+        tlo = np.array(index) * self.tile_shape
+        thi = np.minimum(tlo + self.tile_shape, self.shape)
+        return (slice(None),) + tuple(slice(a, b) for a, b in zip(tlo, thi))
+
+    def _masked(self, lo, hi):
+        # voxels whose gradient depends on a voxel brighter than maxval
+        mlo = np.maximum(lo - self.halo, 0)
+        mhi = np.minimum(hi + self.halo, self.shape)
+        bright = np.asarray(self.img[tuple(slice(a, b) for a, b in zip(mlo, mhi))]) > self.maxval
+        masked = ndimage.maximum_filter(bright.astype(np.uint8), size=2 * self.halo + 1) > 0
+        return masked[tuple(slice(a, b) for a, b in zip(lo - mlo, hi - mlo))]
+
+    def _compute_tile(self, index):
+        tlo = np.array(index) * self.tile_shape
+        thi = np.minimum(tlo + self.tile_shape, self.shape)
+        # read the tile with a halo, clipped at the image border, where the filters use reflection as usual
+        lo = np.maximum(tlo - self.halo, 0)
+        hi = np.minimum(thi + self.halo, self.shape)
+        img = np.asarray(self.img[tuple(slice(a, b) for a, b in zip(lo, hi))], dtype=np.float32)
+        grad = gradient(img, self.spacing, dtype=self.dtype, sigma=self.sigma)
+        crop = (slice(None),) + tuple(slice(a, b) for a, b in zip(tlo - lo, thi - lo))
+        return np.ascontiguousarray(grad[crop])
+
+
+def _default_tile_shape(img, min_shape=(32, 128, 128)):
+    # align the tiles to the chunks of lazy arrays, so that each chunk is read for as few tiles as possible
+    min_shape = np.array(min_shape[-img.ndim:])
+    chunks = chunk_shape(img)
+    if chunks is None:
+        return tuple(min_shape)
+    chunks = np.array(chunks)
+    # multiple of the chunk shape along the axes with small chunks
+    return tuple(np.where(chunks < min_shape, chunks * np.int_(np.ceil(min_shape / chunks)), min_shape))